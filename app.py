@@ -1,20 +1,56 @@
-from flask import Flask, render_template, request, jsonify, send_file
+from flask import Flask, render_template, request, jsonify, g, has_app_context, Response, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+import click
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.pool import PoolError
 import json
+import codecs
 import csv
+import gzip
+import atexit
+import bisect
+import hashlib
 import io
+import itertools
+import math
 import os
-from datetime import datetime
+import queue
+import select
+import threading
+import time
+import uuid
+import zlib
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from werkzeug.utils import secure_filename
+import numpy as np
 
 # --- Integração com Cloudinary ---
 import cloudinary
 import cloudinary.uploader
 import cloudinary.api
 
+# Brotli é opcional: sem o pacote as respostas saem só com gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 
+class JSONProviderMaprix(DefaultJSONProvider):
+    # Datas em ISO 8601 (o padrão do Flask é o formato HTTP, que descarta o fuso)
+    @staticmethod
+    def default(o):
+        if hasattr(o, 'isoformat'): return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
+app.json = JSONProviderMaprix(app)
+
 # Configuração do Cloudinary (Pega das variáveis de ambiente da Vercel)
 cloudinary.config(
     cloud_name = os.getenv('CLOUD_NAME'),
@@ -25,25 +61,749 @@ cloudinary.config(
 # Pegar a URL do banco PostgreSQL
 DATABASE_URL = os.getenv('DATABASE_URL')
 
+# Pool de conexões (um por processo/worker do gunicorn).
+# No modo serverless (Vercel) o pool guarda no máximo 1 conexão, valida antes de
+# cada uso e fecha a conexão ociosa rapidamente, pois a função pode ser congelada.
+DB_SERVERLESS = os.getenv('DB_SERVERLESS', '1' if os.getenv('VERCEL') else '0') == '1'
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '0' if DB_SERVERLESS else '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '1' if DB_SERVERLESS else '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))                # Espera máxima por conexão livre (s)
+DB_POOL_MAX_LIFETIME = float(os.getenv('DB_POOL_MAX_LIFETIME', '1800'))    # Recicla conexões mais velhas (s)
+DB_POOL_IDLE_TIMEOUT = float(os.getenv('DB_POOL_IDLE_TIMEOUT', '60' if DB_SERVERLESS else '600'))
+DB_POOL_PING_APOS = float(os.getenv('DB_POOL_PING_APOS', '0' if DB_SERVERLESS else '30'))  # SELECT 1 se ociosa há mais que isso
+
+# Ingestão de posições: máximo de linhas por INSERT multi-linha
+INGEST_LOTE_MAX = int(os.getenv('INGEST_LOTE_MAX', '1000'))
+
+# Ingestão write-behind (INGEST_ASSINCRONO=1): o /api/registrar responde 202 e uma thread
+# por worker grava a fila a cada INGEST_FLUSH_MS ou ao juntar INGEST_FLUSH_LINHAS pontos.
+# Com a fila cheia (INGEST_FILA_MAX) a requisição espera até INGEST_FILA_ESPERA s e recebe 503.
+# Ignorado no modo serverless, onde a função congela após a resposta.
+INGEST_ASSINCRONO = os.getenv('INGEST_ASSINCRONO', '0') == '1' and not DB_SERVERLESS
+INGEST_FLUSH_MS = float(os.getenv('INGEST_FLUSH_MS', '200'))
+INGEST_FLUSH_LINHAS = int(os.getenv('INGEST_FLUSH_LINHAS', '500'))
+INGEST_FILA_MAX = int(os.getenv('INGEST_FILA_MAX', '10000'))
+INGEST_FILA_ESPERA = float(os.getenv('INGEST_FILA_ESPERA', '0.5'))
+
+# Sincronização da fila offline do operador: pontos por lote do /api/sincronizar
+SYNC_LOTE_MAX = int(os.getenv('SYNC_LOTE_MAX', '200'))
+
+# Paginação do /api/locais (delta por since_id)
+LOCAIS_PAGINA_PADRAO = 5000
+LOCAIS_PAGINA_MAX = 50000
+
+# Métricas em /metrics (Prometheus, por worker). METRICAS_LENTA_MS > 0 registra no log as
+# requisições mais lentas que isso, com até METRICAS_LENTA_MAX_SQL comandos SQL executados.
+METRICAS_LENTA_MS = float(os.getenv('METRICAS_LENTA_MS', '0'))
+METRICAS_LENTA_MAX_SQL = 50
+
+# Formato compacto do /api/locais (?formato=colunar|binario): coordenadas em inteiros
+# de 1/ESCALA_COORD grau (1e6 = ~11 cm)
+ESCALA_COORD = 10 ** 6
+
+# Compressão das respostas JSON (gzip, ou brotli se o cliente aceitar e o pacote existir)
+COMPRESSAO_MIN = int(os.getenv('COMPRESSAO_MIN', '1024'))   # Bytes; abaixo disso não compensa
+COMPRESSAO_NIVEL_GZIP = int(os.getenv('COMPRESSAO_NIVEL_GZIP', '6'))
+COMPRESSAO_NIVEL_BROTLI = int(os.getenv('COMPRESSAO_NIVEL_BROTLI', '5'))
+
+# Paginação do /api/checklists/all (keyset por id decrescente)
+CHECKLISTS_PAGINA_PADRAO = 50
+CHECKLISTS_PAGINA_MAX = 500
+
+# Respostas em streaming: linhas buscadas por vez no cursor server-side
+STREAM_CHUNK = int(os.getenv('STREAM_CHUNK', '2000'))
+
+# Trajetos simplificados guardados em memória (LRU por worker)
+TRAJETO_CACHE_MAX = int(os.getenv('TRAJETO_CACHE_MAX', '256'))
+# Sem inicio, o trajeto cobre só os últimos TRAJETO_DIAS_PADRAO dias
+TRAJETO_DIAS_PADRAO = float(os.getenv('TRAJETO_DIAS_PADRAO', '7'))
+
+# Frota num instante e reprodução: ativo cujo último ponto antes do instante é mais velho
+# que FROTA_MAX_IDADE segundos fica fora do quadro; a reprodução gera no máximo
+# REPRODUCAO_MAX_QUADROS quadros por pedido
+FROTA_MAX_IDADE = float(os.getenv('FROTA_MAX_IDADE', str(7 * 86400)))
+REPRODUCAO_MAX_QUADROS = int(os.getenv('REPRODUCAO_MAX_QUADROS', '1440'))
+
+# Clusters do mapa: chave espacial Z-order (geokey) com GEO_BITS bits por eixo.
+# A partir de CLUSTER_ZOOM_PONTOS o viewport devolve pontos crus (até CLUSTER_MAX_PONTOS).
+GEO_BITS = 26
+CLUSTER_ZOOM_PONTOS = int(os.getenv('CLUSTER_ZOOM_PONTOS', '16'))
+CLUSTER_MAX_PONTOS = int(os.getenv('CLUSTER_MAX_PONTOS', '5000'))
+
+# Ativos próximos (/api/proximos): índice em grade sobre a última posição de cada ativo,
+# por worker, recarregado de posicoes_atuais a cada PROXIMOS_RECARGA segundos
+PROXIMOS_CELULA_GRAUS = float(os.getenv('PROXIMOS_CELULA_GRAUS', '0.01'))  # ~1,1 km
+PROXIMOS_RECARGA = float(os.getenv('PROXIMOS_RECARGA', '5'))
+PROXIMOS_K_MAX = 100
+PROXIMOS_RAIO_MAX = 500000.0
+
+# Cache dos cadastros (tipos, ativos, áreas, regiões, configs) por worker, em segundos.
+# As rotas de escrita invalidam na hora; o TTL limita a defasagem entre workers.
+CACHE_TTL = float(os.getenv('CACHE_TTL', '30'))
+
+# Fotos do checklist: uploads paralelos para o Cloudinary, fora da transação.
+# FOTO_UPLOAD_ASSINCRONO=1 grava o checklist na hora e preenche foto_path depois
+# (ignorado no modo serverless, onde a função congela após a resposta).
+FOTO_UPLOAD_WORKERS = int(os.getenv('FOTO_UPLOAD_WORKERS', '4'))
+FOTO_UPLOAD_TIMEOUT = float(os.getenv('FOTO_UPLOAD_TIMEOUT', '20'))     # Por tentativa (s)
+FOTO_UPLOAD_TENTATIVAS = int(os.getenv('FOTO_UPLOAD_TENTATIVAS', '3'))
+FOTO_UPLOAD_ESPERA = float(os.getenv('FOTO_UPLOAD_ESPERA', '60'))       # Espera máxima da requisição (s)
+FOTO_UPLOAD_ASSINCRONO = os.getenv('FOTO_UPLOAD_ASSINCRONO', '0') == '1'
+
+# Eventos em tempo real (SSE) alimentados por LISTEN/NOTIFY: um listener por worker.
+# Cada cliente ocupa uma thread enquanto conectado (gunicorn com worker gthread);
+# a conexão é encerrada após SSE_DURACAO_MAX e o navegador reconecta sozinho.
+SSE_MAX_CLIENTES = int(os.getenv('SSE_MAX_CLIENTES', '50'))
+SSE_DURACAO_MAX = float(os.getenv('SSE_DURACAO_MAX', '25' if DB_SERVERLESS else '300'))
+SSE_PING = float(os.getenv('SSE_PING', '15'))       # Comentário de keep-alive (s)
+SSE_FILA_MAX = int(os.getenv('SSE_FILA_MAX', '100'))  # Eventos pendentes por cliente antes de pedir resync
+
+# Importação CSV: linhas válidas acumuladas antes de gravar; linhas rejeitadas
+# guardadas no relatório (as que passarem do limite só entram na contagem)
+IMPORT_CHUNK = int(os.getenv('IMPORT_CHUNK', '5000'))
+IMPORT_REJEITADAS_MAX = int(os.getenv('IMPORT_REJEITADAS_MAX', '10000'))
+
+# Restauração de backup: linhas por COPY na tabela de staging
+RESTORE_LOTE = int(os.getenv('RESTORE_LOTE', '10000'))
+
+# Datas antigas gravadas como texto sem fuso (migração 8 e restore de backups 2.0) são lidas nesse fuso
+MIGRACAO_FUSO = os.getenv('MIGRACAO_FUSO', 'UTC')
+
+# Histórico (registros) particionado por mês em UTC. As partições do mês corrente e das
+# PARTICOES_A_FRENTE seguintes são criadas sozinhas. Partições com mais de RETENCAO_MESES
+# meses são exportadas para ARQUIVO_DIR (NDJSON gzip) e removidas do banco; 0 = nunca.
+PARTICOES_A_FRENTE = int(os.getenv('PARTICOES_A_FRENTE', '2'))
+RETENCAO_MESES = int(os.getenv('RETENCAO_MESES', '0'))
+ARQUIVO_DIR = os.getenv('ARQUIVO_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'arquivo'))
+
+# Resumo diário por equipamento (km, pontos por turno, tempo parado/em movimento),
+# mantido a cada ingestão. Dias contados no fuso RESUMO_FUSO; os turnos começam nas
+# horas de RESUMO_TURNOS.
+RESUMO_FUSO = os.getenv('RESUMO_FUSO', 'America/Sao_Paulo')
+RESUMO_TURNOS = sorted(int(h) for h in os.getenv('RESUMO_TURNOS', '6,14,22').split(','))
+RESUMO_RAIO_PARADO = float(os.getenv('RESUMO_RAIO_PARADO', '25'))  # Dentro desse raio (m) o ativo está parado
+RESUMO_LACUNA_MAX = float(os.getenv('RESUMO_LACUNA_MAX', '600'))   # Intervalos maiores (s) não contam tempo
+# Dias marcados para refazer: o /api/resumos refaz no máximo RESUMO_RECALCULO_LEITURA dias
+# (os que não estiverem travados) e o resto fica com uma thread em segundo plano do worker
+RESUMO_RECALCULO_LEITURA = int(os.getenv('RESUMO_RECALCULO_LEITURA', '50'))
+
 # ==========================================
 # 1. CONFIGURAÇÃO E BANCO DE DADOS
 # ==========================================
 
+class ConexaoEmprestada:
+    """Conexão retirada do pool. Repassa tudo para a conexão psycopg2 real.
+    close() devolve ao pool, exceto na conexão da requisição (devolvida no teardown)."""
+
+    def __init__(self, pool, raw, criada_em, da_requisicao=False):
+        self._pool = pool
+        self._raw = raw
+        self.criada_em = criada_em
+        self.da_requisicao = da_requisicao
+        self.devolvida = False
+
+    def __getattr__(self, nome):
+        return getattr(self._raw, nome)
+
+    def close(self):
+        if not self.da_requisicao:
+            self.devolver()
+
+    def devolver(self):
+        if not self.devolvida:
+            self.devolvida = True
+            self._pool.devolver(self)
+
+class PoolConexoes:
+    """Pool thread-safe com espera limitada, health check e reciclagem por idade."""
+
+    def __init__(self, dsn, minimo, maximo, timeout, max_lifetime, idle_timeout, ping_apos):
+        self.dsn = dsn
+        self.minimo = minimo
+        self.maximo = max(1, maximo)
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.idle_timeout = idle_timeout
+        self.ping_apos = ping_apos
+        self._cond = threading.Condition()
+        self._livres = deque()  # (conn, criada_em, devolvida_em)
+        self._total = 0         # Conexões abertas ou sendo abertas
+        self._pid = os.getpid()
+        self.stats = {
+            'checkouts': 0, 'espera_total': 0.0, 'espera_max': 0.0, 'timeouts': 0,
+            'criadas': 0, 'recicladas': 0, 'descartadas': 0
+        }
+
+    def _verificar_fork(self):
+        # Conexões herdadas de outro processo (fork do gunicorn) não podem ser usadas
+        if os.getpid() != self._pid:
+            self._livres.clear()
+            self._total = 0
+            self._pid = os.getpid()
+
+    def _conectar(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=CursorMedido)
+        with self._cond:
+            self.stats['criadas'] += 1
+        return conn
+
+    @staticmethod
+    def _fechar(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _ping(conn):
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _validar(self, item):
+        if item is not None:
+            conn, criada_em, devolvida_em = item
+            agora = time.monotonic()
+            if conn.closed or agora - criada_em > self.max_lifetime:
+                motivo = 'recicladas'
+            elif agora - devolvida_em >= self.ping_apos and not self._ping(conn):
+                motivo = 'descartadas'
+            else:
+                return conn, criada_em
+            self._fechar(conn)
+            with self._cond:
+                self.stats[motivo] += 1
+        return self._conectar(), time.monotonic()
+
+    def obter(self, da_requisicao=False):
+        inicio = time.monotonic()
+        with self._cond:
+            self._verificar_fork()
+            while not self._livres and self._total >= self.maximo:
+                restante = inicio + self.timeout - time.monotonic()
+                if restante <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolError(f"Nenhuma conexão livre em {self.timeout:g}s (máx. {self.maximo})")
+                self._cond.wait(restante)
+            if self._livres:
+                item = self._livres.pop()  # LIFO: reaproveita a conexão mais recente
+            else:
+                item = None
+                self._total += 1
+            espera = time.monotonic() - inicio
+            self.stats['checkouts'] += 1
+            self.stats['espera_total'] += espera
+            self.stats['espera_max'] = max(self.stats['espera_max'], espera)
+        try:
+            conn, criada_em = self._validar(item)
+        except Exception:
+            with self._cond:
+                self._total -= 1
+                self._cond.notify()
+            raise
+        return ConexaoEmprestada(self, conn, criada_em, da_requisicao)
+
+    def devolver(self, emprestada):
+        conn = emprestada._raw
+        descartar = bool(conn.closed) or time.monotonic() - emprestada.criada_em > self.max_lifetime
+        if not descartar and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # Transação esquecida aberta (erro no meio da rota): desfaz antes de reaproveitar
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                descartar = True
+        if not descartar and conn.autocommit:
+            conn.autocommit = False
+
+        fechar = [conn] if descartar else []
+        with self._cond:
+            if os.getpid() != self._pid:
+                return
+            agora = time.monotonic()
+            if descartar:
+                self._total -= 1
+                self.stats['recicladas'] += 1
+            else:
+                self._livres.append((conn, emprestada.criada_em, agora))
+            # Fecha as ociosas há muito tempo (mais antigas ficam no início da fila)
+            while self._total > self.minimo and self._livres and agora - self._livres[0][2] > self.idle_timeout:
+                fechar.append(self._livres.popleft()[0])
+                self._total -= 1
+            self._cond.notify()
+        for c in fechar:
+            self._fechar(c)
+
+    def estatisticas(self):
+        with self._cond:
+            s = dict(self.stats)
+            livres, total = len(self._livres), self._total
+        return {
+            "serverless": DB_SERVERLESS,
+            "tamanho_min": self.minimo,
+            "tamanho_max": self.maximo,
+            "abertas": total,
+            "livres": livres,
+            "em_uso": total - livres,
+            "checkouts": s['checkouts'],
+            "espera_media_ms": round(1000 * s['espera_total'] / s['checkouts'], 3) if s['checkouts'] else 0.0,
+            "espera_max_ms": round(1000 * s['espera_max'], 3),
+            "timeouts": s['timeouts'],
+            "criadas": s['criadas'],
+            "recicladas": s['recicladas'],
+            "descartadas": s['descartadas']
+        }
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    global _db_pool
+    if _db_pool is None:
+        with _db_pool_lock:
+            if _db_pool is None:
+                _db_pool = PoolConexoes(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT,
+                                        DB_POOL_MAX_LIFETIME, DB_POOL_IDLE_TIMEOUT, DB_POOL_PING_APOS)
+    return _db_pool
+
 def get_db_connection():
-    # Conecta ao Postgres usando a URL
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    return conn
+    # Dentro de uma requisição todas as chamadas compartilham a mesma conexão do pool,
+    # devolvida no teardown. Fora dela (CLI, threads) é devolvida no close().
+    if has_app_context():
+        if 'db_conn' not in g:
+            g.db_conn = get_db_pool().obter(da_requisicao=True)
+        return g.db_conn
+    return get_db_pool().obter()
+
+@app.teardown_appcontext
+def devolver_conexao(exc):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        conn.devolver()
+
+@app.errorhandler(PoolError)
+def pool_esgotado(e):
+    return jsonify({"erro": f"Banco ocupado, tente novamente. ({e})"}), 503
+
+def json_padrao(o):
+    # Datas em ISO 8601; demais tipos (Decimal etc.) como texto
+    if hasattr(o, 'isoformat'): return o.isoformat()
+    return str(o)
+
+def ler_em_chunks(conn, sql, params=None, chunk=None):
+    """Executa a consulta em um cursor nomeado (server-side) e devolve listas de até
+    `chunk` linhas. Só um chunk fica em memória por vez."""
+    chunk = chunk or STREAM_CHUNK
+    cur = conn.cursor(name=f"maprix_{uuid.uuid4().hex}")
+    cur.itersize = chunk
+    try:
+        cur.execute(sql, params)
+        while True:
+            linhas = cur.fetchmany(chunk)
+            if not linhas: break
+            yield linhas
+    finally:
+        cur.close()
+
+def array_json(chunks, converter=dict):
+    """Escreve um array JSON pedaço a pedaço a partir de listas de linhas"""
+    yield '['
+    primeiro = True
+    for linhas in chunks:
+        if not linhas: continue
+        parte = ','.join(json.dumps(converter(l), default=json_padrao) for l in linhas)
+        yield parte if primeiro else ',' + parte
+        primeiro = False
+    yield ']'
+
+def formato_stream():
+    return 'ndjson' if request.args.get('formato') == 'ndjson' else 'json'
+
+def stream_json(chunks, formato='json', converter=dict):
+    """Resposta enviada conforme os chunks chegam: array JSON ou NDJSON (um objeto por linha).
+    `chunks` deve ser um gerador (só consulta quando o corpo começa a ser enviado). Com
+    stream_with_context o contexto da requisição vive até o último chunk: o teardown, e com
+    ele a devolução da conexão da requisição ao pool, só roda depois do corpo inteiro, então
+    um cliente lento segura a conexão durante todo o envio."""
+    if formato == 'ndjson':
+        corpo = (''.join(json.dumps(converter(l), default=json_padrao) + '\n' for l in linhas) for linhas in chunks)
+        mimetype = 'application/x-ndjson'
+    else:
+        corpo = array_json(chunks, converter)
+        mimetype = 'application/json'
+    return Response(stream_with_context(corpo), mimetype=mimetype)
+
+# --- MÉTRICAS (PROMETHEUS) ---
+# Por worker: latência por rota (histograma), comandos SQL e tempo no banco por rota,
+# bytes de resposta e tempo de upload no Cloudinary, expostos em /metrics com os
+# contadores do pool, cache, SSE e uploads. Os comandos são contados pelo cursor
+# (CursorMedido) e somados na coleta da requisição da thread atual; fora de uma
+# requisição (listener, uploads em segundo plano) entram na rota "(fundo)".
+
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BUCKETS_COMANDOS = (1, 2, 5, 10, 20, 50, 100, 500)
+
+class Metricas:
+    """Contadores e histogramas com labels, exportados no formato texto do Prometheus"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tipos = OrderedDict()  # nome -> (tipo, ajuda, buckets)
+        self._valores = {}           # (nome, labels) -> valor | [contagens por bucket..., soma, n]
+
+    def declarar(self, nome, tipo, ajuda, buckets=None):
+        self._tipos[nome] = (tipo, ajuda, buckets)
+
+    def somar(self, nome, valor=1, **labels):
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            self._valores[chave] = self._valores.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **labels):
+        limites = self._tipos[nome][2]
+        chave = (nome, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._valores.get(chave)
+            if h is None:
+                h = self._valores[chave] = [0] * (len(limites) + 3)
+            h[bisect.bisect_left(limites, valor)] += 1  # Último índice útil = +Inf
+            h[-2] += valor
+            h[-1] += 1
+
+    @staticmethod
+    def _labels(pares):
+        if not pares: return ''
+        esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in pares) + '}'
+
+    def exportar(self, extras=()):
+        """extras: (nome, ajuda, valor) de medidas instantâneas (gauges)"""
+        with self._lock:
+            valores = {k: (list(v) if isinstance(v, list) else v) for k, v in self._valores.items()}
+        linhas = []
+        for nome, (tipo, ajuda, limites) in self._tipos.items():
+            linhas += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} {tipo}"]
+            for (n, pares), v in sorted(valores.items(), key=lambda i: i[0]):
+                if n != nome: continue
+                if tipo != 'histogram':
+                    linhas.append(f"{nome}{self._labels(pares)} {v:g}")
+                    continue
+                acumulado = 0
+                for limite, qtd in zip(list(limites) + ['+Inf'], v[:-2]):
+                    acumulado += qtd
+                    linhas.append(f"{nome}_bucket{self._labels(pares + (('le', f'{limite:g}' if limite != '+Inf' else limite),))} {acumulado}")
+                linhas.append(f"{nome}_sum{self._labels(pares)} {v[-2]:g}")
+                linhas.append(f"{nome}_count{self._labels(pares)} {v[-1]}")
+        for nome, ajuda, valor in extras:
+            linhas += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} gauge", f"{nome} {float(valor):g}"]
+        return '\n'.join(linhas) + '\n'
+
+metricas = Metricas()
+metricas.declarar('maprix_http_duracao_segundos', 'histogram', 'Latência das requisições por rota.', BUCKETS_LATENCIA)
+metricas.declarar('maprix_http_bytes_resposta_total', 'counter', 'Bytes enviados nas respostas por rota.')
+metricas.declarar('maprix_db_comandos_total', 'counter', 'Comandos SQL executados por rota.')
+metricas.declarar('maprix_db_segundos_total', 'counter', 'Tempo gasto em comandos SQL por rota.')
+metricas.declarar('maprix_db_comandos_por_requisicao', 'histogram', 'Comandos SQL por requisição.', BUCKETS_COMANDOS)
+metricas.declarar('maprix_cloudinary_upload_segundos', 'histogram', 'Duração dos uploads no Cloudinary.', BUCKETS_LATENCIA)
+
+_coleta = threading.local()  # Coleta da requisição em andamento nesta thread
+
+def registrar_sql(sql, segundos):
+    c = getattr(_coleta, 'atual', None)
+    if c is None:
+        metricas.somar('maprix_db_comandos_total', rota='(fundo)')
+        metricas.somar('maprix_db_segundos_total', segundos, rota='(fundo)')
+        return
+    c['sql_n'] += 1
+    c['sql_s'] += segundos
+    if METRICAS_LENTA_MS and len(c['comandos']) < METRICAS_LENTA_MAX_SQL:
+        c['comandos'].append((sql, segundos))
+
+class CursorMedido(RealDictCursor):
+    """RealDictCursor que cronometra cada comando (inclusive os FETCH dos cursores nomeados)"""
+
+    def execute(self, query, vars=None):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            registrar_sql(query, time.perf_counter() - inicio)
+
+    def executemany(self, query, vars_list):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            registrar_sql(query, time.perf_counter() - inicio)
+
+    def copy_expert(self, sql, file, size=8192):
+        inicio = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            registrar_sql(sql, time.perf_counter() - inicio)
+
+    def fetchmany(self, size=None):
+        if not self.name: return super().fetchmany(size)
+        inicio = time.perf_counter()
+        try:
+            return super().fetchmany(size)
+        finally:
+            registrar_sql(f"FETCH {size} FROM {self.name}", time.perf_counter() - inicio)
+
+def upload_cloudinary(arquivo, destino, **opcoes):
+    """cloudinary.uploader.upload cronometrado por destino e resultado"""
+    inicio = time.perf_counter()
+    resultado = 'erro'
+    try:
+        res = cloudinary.uploader.upload(arquivo, **opcoes)
+        resultado = 'ok'
+        return res
+    finally:
+        segundos = time.perf_counter() - inicio
+        metricas.observar('maprix_cloudinary_upload_segundos', segundos, destino=destino, resultado=resultado)
+        c = getattr(_coleta, 'atual', None)
+        if c is not None: c['externo_s'] += segundos
+
+@app.before_request
+def iniciar_coleta():
+    _coleta.atual = {'inicio': time.perf_counter(), 'sql_n': 0, 'sql_s': 0.0, 'externo_s': 0.0, 'comandos': []}
+
+def finalizar_coleta(c, rota, metodo, status, tamanho):
+    if getattr(_coleta, 'atual', None) is c: _coleta.atual = None
+    segundos = time.perf_counter() - c['inicio']
+    metricas.observar('maprix_http_duracao_segundos', segundos, rota=rota, metodo=metodo, status=status)
+    metricas.somar('maprix_http_bytes_resposta_total', tamanho, rota=rota)
+    metricas.somar('maprix_db_comandos_total', c['sql_n'], rota=rota)
+    metricas.somar('maprix_db_segundos_total', c['sql_s'], rota=rota)
+    metricas.observar('maprix_db_comandos_por_requisicao', c['sql_n'], rota=rota)
+    if METRICAS_LENTA_MS and segundos * 1000 >= METRICAS_LENTA_MS:
+        texto = lambda q: ' '.join((q.decode('utf-8', 'replace') if isinstance(q, bytes) else str(q)).split())[:500]
+        app.logger.warning(json.dumps({
+            "evento": "requisicao_lenta", "rota": rota, "metodo": metodo, "status": status,
+            "ms": round(segundos * 1000, 1), "bytes": tamanho, "sql_n": c['sql_n'],
+            "sql_ms": round(c['sql_s'] * 1000, 1), "externo_ms": round(c['externo_s'] * 1000, 1),
+            "comandos": [{"sql": texto(q), "ms": round(s * 1000, 2)} for q, s in c['comandos']]
+        }, ensure_ascii=False))
+
+def medir_stream(partes, c, rota, metodo, status):
+    # Respostas em streaming: o tempo e os bytes só fecham quando o corpo termina
+    total = 0
+    try:
+        for parte in partes:
+            total += len(parte)
+            yield parte
+    finally:
+        if hasattr(partes, 'close'): partes.close()
+        finalizar_coleta(c, rota, metodo, status, total)
+
+@app.after_request
+def medir_resposta(resp):
+    # Registrado antes da compressão: o Flask roda os after_request na ordem inversa,
+    # então os bytes medidos são os que vão para a rede
+    c = getattr(_coleta, 'atual', None)
+    if c is None: return resp
+    if resp.mimetype == 'text/event-stream':
+        _coleta.atual = None  # Conexão longa do SSE: fora do histograma
+        return resp
+    rota = request.url_rule.rule if request.url_rule else '(sem rota)'
+    status = str(resp.status_code)
+    if resp.is_streamed:
+        resp.response = medir_stream(resp.response, c, rota, request.method, status)
+    else:
+        finalizar_coleta(c, rota, request.method, status, resp.calculate_content_length() or 0)
+    return resp
+
+def medidas_instantaneas():
+    """Contadores já existentes (pool, cache, SSE, uploads, fila de ingestão) como gauges do /metrics"""
+    with _upload_lock:
+        uploads = dict(upload_stats)
+    grupos = [
+        ('pool', 'Pool de conexões', get_db_pool().estatisticas()),
+        ('cache', 'Cache de cadastros', cache_referencia.estatisticas()),
+        ('sse', 'Eventos em tempo real', canal_eventos.estatisticas()),
+        ('upload', 'Uploads de fotos', uploads),
+        ('ingest', 'Fila de ingestão', fila_ingestao.estatisticas()),
+        ('proximos', 'Índice de ativos próximos', indice_proximos.estatisticas()),
+    ]
+    return [(f"maprix_{prefixo}_{chave}", f"{ajuda}: {chave}.", valor)
+            for prefixo, ajuda, dados in grupos for chave, valor in dados.items()
+            if isinstance(valor, (int, float))]
+
+@app.route('/metrics')
+def exportar_metricas():
+    return Response(metricas.exportar(medidas_instantaneas()), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# --- COMPRESSÃO DAS RESPOSTAS ---
+# Respostas JSON/NDJSON (e o binário do /api/locais) saem com gzip ou brotli conforme o
+# Accept-Encoding. Streams são comprimidos pedaço a pedaço; SSE e backup (já gzip) ficam de fora.
+TIPOS_COMPRIMIVEIS = {'application/json', 'application/x-ndjson', 'application/x-maprix-colunar'}
+
+def novo_compressor(codificacao):
+    """(comprimir(bytes), finalizar()) para a codificação escolhida"""
+    if codificacao == 'br':
+        c = brotli.Compressor(quality=COMPRESSAO_NIVEL_BROTLI)
+        return c.process, c.finish
+    c = zlib.compressobj(COMPRESSAO_NIVEL_GZIP, zlib.DEFLATED, 31)  # wbits 31 = cabeçalho gzip
+    return c.compress, c.flush
+
+def comprimir_stream(partes, codificacao):
+    comprimir, finalizar = novo_compressor(codificacao)
+    try:
+        for parte in partes:
+            saida = comprimir(parte.encode('utf-8') if isinstance(parte, str) else parte)
+            if saida: yield saida
+        yield finalizar()
+    finally:
+        if hasattr(partes, 'close'): partes.close()
+
+@app.after_request
+def comprimir_resposta(resp):
+    if (resp.mimetype not in TIPOS_COMPRIMIVEIS or resp.direct_passthrough or resp.status_code in (204, 304)
+            or 'Content-Encoding' in resp.headers):
+        return resp
+    codificacao = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    resp.vary.add('Accept-Encoding')
+    if not codificacao:
+        return resp
+    if resp.is_streamed:
+        resp.response = comprimir_stream(resp.response, codificacao)
+        resp.headers.pop('Content-Length', None)
+    else:
+        corpo = resp.get_data()
+        if len(corpo) < COMPRESSAO_MIN:
+            return resp
+        comprimir, finalizar = novo_compressor(codificacao)
+        resp.set_data(comprimir(corpo) + finalizar())
+    resp.headers['Content-Encoding'] = codificacao
+    # Mesmo conteúdo em outra codificação: ETag fraca (o 304 compara de forma fraca)
+    etag, _ = resp.get_etag()
+    if etag: resp.set_etag(etag, weak=True)
+    return resp
+
+class CacheReferencia:
+    """Respostas prontas (corpo JSON + ETag) dos dados de cadastro, por grupo e chave."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entradas = {}  # (grupo, *args) -> [expira_em, corpo, etag, last_modified]
+        self.stats = {'hits': 0, 'misses': 0, 'invalidacoes': 0, 'nao_modificados': 0}
+
+    def obter(self, chave):
+        with self._lock:
+            e = self._entradas.get(chave)
+            if e is not None and e[0] > time.monotonic():
+                self.stats['hits'] += 1
+                return e
+            self.stats['misses'] += 1
+            return None
+
+    def guardar(self, chave, corpo):
+        etag = hashlib.sha1(corpo).hexdigest()
+        agora = datetime.now(timezone.utc).replace(microsecond=0)
+        with self._lock:
+            anterior = self._entradas.get(chave)
+            # Conteúdo igual ao expirado: mantém o Last-Modified original
+            last_modified = anterior[3] if anterior is not None and anterior[2] == etag else agora
+            e = [time.monotonic() + self.ttl, corpo, etag, last_modified]
+            self._entradas[chave] = e
+        return e
+
+    def invalidar(self, *grupos):
+        with self._lock:
+            for chave in list(self._entradas):
+                if not grupos or chave[0] in grupos:
+                    self._entradas[chave][0] = 0  # Expira, mas guarda ETag/Last-Modified
+            self.stats['invalidacoes'] += 1
+
+    def contar_304(self):
+        with self._lock:
+            self.stats['nao_modificados'] += 1
+
+    def estatisticas(self):
+        with self._lock:
+            s = dict(self.stats)
+            entradas = len(self._entradas)
+        consultas = s['hits'] + s['misses']
+        return {
+            "ttl_s": self.ttl,
+            "entradas": entradas,
+            "hits": s['hits'],
+            "misses": s['misses'],
+            "taxa_acerto": round(s['hits'] / consultas, 4) if consultas else 0.0,
+            "invalidacoes": s['invalidacoes'],
+            "nao_modificados_304": s['nao_modificados']
+        }
+
+cache_referencia = CacheReferencia(CACHE_TTL)
+
+def responder_cacheado(chave, gerar_dados):
+    """Devolve o JSON de `gerar_dados()` pelo cache, com ETag/Last-Modified e 304.
+    `gerar_dados` só é chamado (e só abre conexão) quando a entrada expirou."""
+    e = cache_referencia.obter(chave)
+    if e is None:
+        corpo = json.dumps(gerar_dados(), default=json_padrao).encode('utf-8')
+        e = cache_referencia.guardar(chave, corpo)
+    _, corpo, etag, last_modified = e
+    resp = Response(corpo, mimetype='application/json')
+    resp.set_etag(etag)
+    resp.last_modified = last_modified
+    resp.cache_control.no_cache = True  # Cliente sempre revalida (barato: 304 sem corpo)
+    resp.make_conditional(request)
+    if resp.status_code == 304:
+        cache_referencia.contar_304()
+    return resp
 
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'svg'}
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # 1. Histórico de Posições
+# --- MIGRAÇÕES DE SCHEMA ---
+# Passos versionados e idempotentes, aplicados em ordem, cada um na sua transação
+# e registrado em schema_versao. Rodam uma vez no deploy (`flask --app app migrar`,
+# fase release do Procfile); /init_db continua disponível para a Vercel.
+# Um advisory lock impede dois processos de migrarem ao mesmo tempo.
+
+MIGRACOES = []
+MIGRACAO_LOCK = 7262011  # Chave do pg_advisory_lock
+
+def migracao(versao, nome):
+    def registrar(passo):
+        MIGRACOES.append((versao, nome, passo))
+        return passo
+    return registrar
+
+def criar_geokey(cur):
+    # Chave espacial Z-order (mesma intercalação de bits de geokey() no Python),
+    # calculada pelo próprio banco em qualquer INSERT, inclusive restore
+    cur.execute(f'''
+        CREATE OR REPLACE FUNCTION maprix_espalhar(v BIGINT) RETURNS BIGINT AS $$
+        BEGIN
+            v := (v | (v << 16)) & x'0000FFFF0000FFFF'::bigint;
+            v := (v | (v << 8))  & x'00FF00FF00FF00FF'::bigint;
+            v := (v | (v << 4))  & x'0F0F0F0F0F0F0F0F'::bigint;
+            v := (v | (v << 2))  & x'3333333333333333'::bigint;
+            v := (v | (v << 1))  & x'5555555555555555'::bigint;
+            RETURN v;
+        END $$ LANGUAGE plpgsql IMMUTABLE;
+
+        CREATE OR REPLACE FUNCTION maprix_geokey(lat DOUBLE PRECISION, lng DOUBLE PRECISION) RETURNS BIGINT AS $$
+            SELECT maprix_espalhar(LEAST(GREATEST(floor((lng + 180) / 360 * {1 << GEO_BITS})::bigint, 0), {(1 << GEO_BITS) - 1}))
+                 | (maprix_espalhar(LEAST(GREATEST(floor((lat + 90) / 180 * {1 << GEO_BITS})::bigint, 0), {(1 << GEO_BITS) - 1})) << 1)
+        $$ LANGUAGE sql IMMUTABLE;
+
+        ALTER TABLE registros ADD COLUMN IF NOT EXISTS geokey BIGINT GENERATED ALWAYS AS (maprix_geokey(latitude, longitude)) STORED;
+        CREATE INDEX IF NOT EXISTS idx_registros_geokey ON registros (geokey);
+    ''')
+
+@migracao(1, 'schema_inicial')
+def migracao_schema_inicial(cur):
     cur.execute('''
+        -- 1. Histórico de Posições
         CREATE TABLE IF NOT EXISTS registros (
             id SERIAL PRIMARY KEY,
             equipamento TEXT NOT NULL,
@@ -53,72 +813,58 @@ def init_db():
             sincronizado_em TEXT,
             observacao TEXT,
             cor TEXT DEFAULT '#007bff'
-        )
-    ''')
-    
-    # 2. Áreas (Geofencing)
-    cur.execute('''
+        );
+
+        -- 2. Áreas (Geofencing)
         CREATE TABLE IF NOT EXISTS areas (
             id SERIAL PRIMARY KEY,
             nome TEXT NOT NULL,
             geometria TEXT NOT NULL,
             cor TEXT DEFAULT '#FFC107'
-        )
-    ''')
+        );
 
-    # 3. Cadastro de Ativos (Frota Real)
-    cur.execute('''
+        -- 3. Cadastro de Ativos (Frota Real)
         CREATE TABLE IF NOT EXISTS equipamentos_cadastrados (
             id SERIAL PRIMARY KEY,
             nome TEXT NOT NULL UNIQUE,
             tipo_id INTEGER,
             cor_padrao TEXT DEFAULT '#007bff',
             bateria_fabricacao TEXT
-        )
-    ''')
-    
-    # 4. Regiões Salvas (Visões do Mapa)
-    cur.execute('''
+        );
+
+        -- 4. Regiões Salvas (Visões do Mapa)
         CREATE TABLE IF NOT EXISTS regioes (
             id SERIAL PRIMARY KEY,
             nome TEXT NOT NULL,
             latitude REAL,
             longitude REAL,
             zoom INTEGER
-        )
-    ''')
+        );
 
-    # 5. Tipos de Equipamento
-    cur.execute('''
+        -- 5. Tipos de Equipamento
         CREATE TABLE IF NOT EXISTS tipos_equipamento (
             id SERIAL PRIMARY KEY,
             nome TEXT NOT NULL UNIQUE,
             icone TEXT
-        )
-    ''')
-    
-    # 6. Perguntas do Checklist
-    cur.execute('''
+        );
+
+        -- 6. Perguntas do Checklist
         CREATE TABLE IF NOT EXISTS checklist_perguntas (
             id SERIAL PRIMARY KEY,
             tipo_id INTEGER NOT NULL,
             texto TEXT NOT NULL,
             FOREIGN KEY(tipo_id) REFERENCES tipos_equipamento(id) ON DELETE CASCADE
-        )
-    ''')
+        );
 
-    # 7. Cabeçalho do Checklist Realizado
-    cur.execute('''
+        -- 7. Cabeçalho do Checklist Realizado
         CREATE TABLE IF NOT EXISTS checklist_realizados (
             id SERIAL PRIMARY KEY,
             equipamento TEXT NOT NULL,
             operador TEXT NOT NULL,
             data_hora TEXT NOT NULL
-        )
-    ''')
+        );
 
-    # 8. Detalhes do Checklist
-    cur.execute('''
+        -- 8. Detalhes do Checklist
         CREATE TABLE IF NOT EXISTS checklist_itens (
             id SERIAL PRIMARY KEY,
             checklist_id INTEGER NOT NULL,
@@ -127,60 +873,385 @@ def init_db():
             observacao TEXT,
             foto_path TEXT,
             FOREIGN KEY(checklist_id) REFERENCES checklist_realizados(id) ON DELETE CASCADE
-        )
-    ''')
+        );
 
-    # 9. Configurações do Sistema
-    cur.execute('''
+        -- 9. Configurações do Sistema
         CREATE TABLE IF NOT EXISTS config_sistema (
             chave TEXT PRIMARY KEY,
             valor TEXT
+        );
+
+        -- Dados Iniciais Obrigatórios
+        INSERT INTO config_sistema (chave, valor) VALUES ('bat_aviso', '48'), ('bat_critico', '54')
+        ON CONFLICT (chave) DO NOTHING;
+        INSERT INTO tipos_equipamento (nome)
+        SELECT unnest(ARRAY['Caminhão', 'Escavadeira', 'Veículo Leve'])
+        WHERE NOT EXISTS (SELECT 1 FROM tipos_equipamento);
+    ''')
+
+@migracao(2, 'registros_equipamento_id')
+def migracao_registros_equipamento_id(cur):
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_registros_equipamento_id ON registros (equipamento, id)')
+
+@migracao(3, 'registros_geokey')
+def migracao_registros_geokey(cur):
+    criar_geokey(cur)
+
+@migracao(4, 'posicoes_atuais')
+def migracao_posicoes_atuais(cur):
+    # 10. Posição Atual (último ponto de cada equipamento)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS posicoes_atuais (
+            equipamento TEXT PRIMARY KEY,
+            registro_id INTEGER,
+            latitude REAL NOT NULL,
+            longitude REAL NOT NULL,
+            data_hora TEXT NOT NULL,
+            sincronizado_em TEXT,
+            observacao TEXT,
+            cor TEXT
         )
     ''')
-    
-    # Dados Iniciais Obrigatórios
-    cur.execute("SELECT count(*) as count FROM config_sistema WHERE chave='bat_aviso'")
+    cur.execute('SELECT count(*) as count FROM posicoes_atuais')
     if cur.fetchone()['count'] == 0:
-        cur.execute("INSERT INTO config_sistema (chave, valor) VALUES ('bat_aviso', '48')") 
-        cur.execute("INSERT INTO config_sistema (chave, valor) VALUES ('bat_critico', '54')") 
+        recalcular_posicao_atual(cur)
 
-    cur.execute('SELECT count(*) as count FROM tipos_equipamento')
-    if cur.fetchone()['count'] == 0:
-        cur.execute("INSERT INTO tipos_equipamento (nome) VALUES ('Caminhão')")
-        cur.execute("INSERT INTO tipos_equipamento (nome) VALUES ('Escavadeira')")
-        cur.execute("INSERT INTO tipos_equipamento (nome) VALUES ('Veículo Leve')")
+@migracao(5, 'geofencing')
+def migracao_geofencing(cur):
+    # 11. Geofencing: eventos de entrada/saída e áreas em que cada equipamento está
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS geofence_eventos (
+            id SERIAL PRIMARY KEY,
+            equipamento TEXT NOT NULL,
+            area_id INTEGER NOT NULL,
+            area_nome TEXT,
+            tipo TEXT NOT NULL,
+            registro_id INTEGER,
+            data_hora TEXT NOT NULL,
+            latitude REAL,
+            longitude REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_geofence_eventos_equipamento ON geofence_eventos (equipamento, id);
+        CREATE INDEX IF NOT EXISTS idx_geofence_eventos_area ON geofence_eventos (area_id, id);
+        CREATE TABLE IF NOT EXISTS geofence_estado (
+            equipamento TEXT PRIMARY KEY,
+            areas INTEGER[] NOT NULL DEFAULT '{}',
+            data_hora TEXT
+        );
+    ''')
+
+@migracao(6, 'indices_checklists')
+def migracao_indices_checklists(cur):
+    # Listagem paginada do painel: keyset por id com filtros de equipamento/operador/período
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS idx_checklist_realizados_equipamento ON checklist_realizados (equipamento, id);
+        CREATE INDEX IF NOT EXISTS idx_checklist_realizados_operador ON checklist_realizados (operador, id);
+        CREATE INDEX IF NOT EXISTS idx_checklist_realizados_data ON checklist_realizados (data_hora);
+        CREATE INDEX IF NOT EXISTS idx_checklist_itens_checklist ON checklist_itens (checklist_id, id);
+        CREATE INDEX IF NOT EXISTS idx_checklist_itens_nao_conforme ON checklist_itens (checklist_id)
+            WHERE conforme = 0 OR conforme IS NULL;
+    ''')
+
+@migracao(7, 'importacoes')
+def migracao_importacoes(cur):
+    # 12. Importações CSV: resumo e relatório das linhas rejeitadas (CSV)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS importacoes (
+            id TEXT PRIMARY KEY,
+            arquivo TEXT,
+            data_hora TEXT NOT NULL,
+            linhas INTEGER NOT NULL,
+            importadas INTEGER NOT NULL,
+            rejeitadas INTEGER NOT NULL,
+            segundos REAL,
+            relatorio TEXT
+        )
+    ''')
+
+def tipo_coluna(cur, tabela, coluna):
+    cur.execute('''
+        SELECT format_type(a.atttypid, a.atttypmod) AS tipo
+        FROM pg_attribute a
+        WHERE a.attrelid = to_regclass(%s) AND a.attname = %s AND NOT a.attisdropped
+    ''', (tabela, coluna))
+    row = cur.fetchone()
+    return row['tipo'] if row else None
+
+def alterar_tipos(cur, tabela, colunas):
+    """colunas: {nome: (tipo, expressão USING)}. Um único ALTER TABLE (uma reescrita)
+    só com as colunas que ainda não estão no tipo novo. Devolve se alterou algo."""
+    clausulas = [f"ALTER COLUMN {c} TYPE {tipo} USING {using}"
+                 for c, (tipo, using) in colunas.items() if tipo_coluna(cur, tabela, c) != tipo]
+    if clausulas:
+        cur.execute(f"ALTER TABLE {tabela} {', '.join(clausulas)}")
+    return bool(clausulas)
+
+# Texto -> data sem abortar: NULL quando o valor não é legível
+FUNCOES_DATA_TEXTO = '''
+    CREATE OR REPLACE FUNCTION maprix_ts(v TEXT) RETURNS TIMESTAMPTZ AS $$
+    BEGIN
+        RETURN v::timestamptz;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql STABLE;
+
+    CREATE OR REPLACE FUNCTION maprix_ts_local(v TEXT) RETURNS TIMESTAMP AS $$
+    BEGIN
+        RETURN v::timestamp;
+    EXCEPTION WHEN others THEN
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql STABLE;
+'''
+
+@migracao(8, 'tipos_data_e_coordenadas')
+def migracao_tipos_data_e_coordenadas(cur):
+    # Datas TEXT -> timestamptz e coordenadas REAL -> double precision.
+    # Texto sem fuso é lido em MIGRACAO_FUSO; valores ilegíveis caem para
+    # sincronizado_em e, em último caso, 'epoch' (em vez de abortar o deploy).
+    # checklist_realizados.data_hora é a hora local do aparelho: vira timestamp sem fuso.
+    cur.execute("SELECT set_config('TimeZone', %s, true)", (MIGRACAO_FUSO,))
+    cur.execute(FUNCOES_DATA_TEXTO)
+    ts = lambda c, alt="'epoch'": ('timestamp with time zone', f"coalesce(maprix_ts({c}::text), {alt})")
+    dp = lambda c: ('double precision', f"{c}::double precision")
+
+    # geokey é gerada a partir de latitude/longitude: sai antes e volta depois
+    coords = {c: dp(c) for c in ('latitude', 'longitude')}
+    if any(tipo_coluna(cur, 'registros', c) != coords[c][0] for c in coords):
+        cur.execute('ALTER TABLE registros DROP COLUMN IF EXISTS geokey')
+    alterar_tipos(cur, 'registros', {
+        **coords,
+        'data_hora': ts('data_hora', "maprix_ts(sincronizado_em::text), 'epoch'"),
+        'sincronizado_em': ('timestamp with time zone', 'maprix_ts(sincronizado_em::text)')
+    })
+    criar_geokey(cur)
 
+    alterar_tipos(cur, 'posicoes_atuais', {
+        'latitude': dp('latitude'), 'longitude': dp('longitude'),
+        'data_hora': ts('data_hora', "maprix_ts(sincronizado_em::text), 'epoch'"),
+        'sincronizado_em': ('timestamp with time zone', 'maprix_ts(sincronizado_em::text)')
+    })
+    alterar_tipos(cur, 'regioes', {'latitude': dp('latitude'), 'longitude': dp('longitude')})
+    alterar_tipos(cur, 'geofence_eventos', {
+        'latitude': dp('latitude'), 'longitude': dp('longitude'), 'data_hora': ts('data_hora')
+    })
+    alterar_tipos(cur, 'geofence_estado', {'data_hora': ('timestamp with time zone', 'maprix_ts(data_hora::text)')})
+    alterar_tipos(cur, 'importacoes', {'data_hora': ts('data_hora')})
+    alterar_tipos(cur, 'checklist_realizados', {
+        'data_hora': ('timestamp without time zone', "coalesce(maprix_ts_local(data_hora::text), 'epoch')")
+    })
+
+    cur.execute('''
+        DROP FUNCTION maprix_ts(TEXT);
+        DROP FUNCTION maprix_ts_local(TEXT);
+
+        -- Histórico e trajeto por equipamento ordenados por data; delta por sincronização
+        CREATE INDEX IF NOT EXISTS idx_registros_equipamento_data ON registros (equipamento, data_hora);
+        CREATE INDEX IF NOT EXISTS idx_registros_data ON registros (data_hora);
+        CREATE INDEX IF NOT EXISTS idx_checklist_perguntas_tipo ON checklist_perguntas (tipo_id);
+        CREATE INDEX IF NOT EXISTS idx_geofence_eventos_data ON geofence_eventos (data_hora);
+    ''')
+
+@migracao(9, 'registros_particionado')
+def migracao_registros_particionado(cur):
+    # registros vira tabela particionada por data_hora (mês, UTC). A PK passa a ser
+    # (id, data_hora), exigência do particionamento; o id continua vindo da mesma sequência.
+    # Só os meses com dados ganham partição; o resto (datas fora da faixa) cai na default.
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'registros'::regclass) AS feito")
+    if cur.fetchone()['feito']: return
+    cur.execute('''
+        ALTER TABLE registros RENAME TO registros_legado;
+        ALTER INDEX IF EXISTS registros_pkey RENAME TO registros_legado_pkey;
+        DROP INDEX IF EXISTS idx_registros_equipamento_id, idx_registros_equipamento_data,
+                             idx_registros_data, idx_registros_geokey;
+
+        CREATE TABLE registros (
+            id INTEGER NOT NULL DEFAULT nextval('registros_id_seq'),
+            equipamento TEXT NOT NULL,
+            latitude DOUBLE PRECISION NOT NULL,
+            longitude DOUBLE PRECISION NOT NULL,
+            data_hora TIMESTAMPTZ NOT NULL,
+            sincronizado_em TIMESTAMPTZ,
+            observacao TEXT,
+            cor TEXT DEFAULT '#007bff',
+            geokey BIGINT GENERATED ALWAYS AS (maprix_geokey(latitude, longitude)) STORED,
+            PRIMARY KEY (id, data_hora)
+        ) PARTITION BY RANGE (data_hora);
+        ALTER SEQUENCE registros_id_seq OWNED BY registros.id;
+        CREATE TABLE registros_default PARTITION OF registros DEFAULT;
+
+        CREATE INDEX idx_registros_equipamento_id ON registros (equipamento, id);
+        CREATE INDEX idx_registros_equipamento_data ON registros (equipamento, data_hora);
+        CREATE INDEX idx_registros_data ON registros (data_hora);
+        CREATE INDEX idx_registros_geokey ON registros (geokey);
+
+        -- Meses exportados para ARQUIVO_DIR (e quando voltaram ao banco, se voltaram)
+        CREATE TABLE IF NOT EXISTS registros_arquivo (
+            mes DATE PRIMARY KEY,
+            arquivo TEXT NOT NULL,
+            linhas BIGINT NOT NULL,
+            bytes BIGINT NOT NULL,
+            arquivado_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+            reanexado_em TIMESTAMPTZ
+        );
+    ''')
+    cur.execute("SELECT DISTINCT date_trunc('month', data_hora AT TIME ZONE 'UTC')::date AS mes FROM registros_legado")
+    meses = {r['mes'] for r in cur.fetchall()}
+    atual = inicio_mes(datetime.now(timezone.utc))
+    meses.update(somar_meses(atual, i) for i in range(PARTICOES_A_FRENTE + 1))
+    for mes in sorted(meses):
+        criar_particao(cur, mes)
+    cols = 'id, equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor'
+    cur.execute(f'INSERT INTO registros ({cols}) SELECT {cols} FROM registros_legado')
+    cur.execute('DROP TABLE registros_legado')
+
+@migracao(10, 'resumo_diario')
+def migracao_resumo_diario(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS resumo_diario (
+            equipamento TEXT NOT NULL,
+            dia DATE NOT NULL,
+            pontos INTEGER NOT NULL DEFAULT 0,
+            pontos_turno INTEGER[] NOT NULL DEFAULT '{}',
+            distancia_m DOUBLE PRECISION NOT NULL DEFAULT 0,
+            parado_s DOUBLE PRECISION NOT NULL DEFAULT 0,
+            movimento_s DOUBLE PRECISION NOT NULL DEFAULT 0,
+            primeiro_em TIMESTAMPTZ,
+            ultimo_em TIMESTAMPTZ,
+            ultimo_lat DOUBLE PRECISION,
+            ultimo_lon DOUBLE PRECISION,
+            ancora_lat DOUBLE PRECISION,
+            ancora_lon DOUBLE PRECISION,
+            recalcular BOOLEAN NOT NULL DEFAULT false,
+            PRIMARY KEY (equipamento, dia)
+        );
+        CREATE INDEX IF NOT EXISTS idx_resumo_diario_dia ON resumo_diario (dia);
+        CREATE INDEX IF NOT EXISTS idx_resumo_diario_recalcular ON resumo_diario (dia) WHERE recalcular;
+    ''')
+    # Histórico já gravado: os dias entram marcados e são calculados na primeira leitura
+    cur.execute('''
+        INSERT INTO resumo_diario (equipamento, dia, recalcular)
+        SELECT DISTINCT equipamento, (data_hora AT TIME ZONE %s)::date, true FROM registros
+        ON CONFLICT DO NOTHING
+    ''', (RESUMO_FUSO,))
+
+@migracao(11, 'registros_ponto_uid')
+def migracao_registros_ponto_uid(cur):
+    # Id gerado no aparelho para cada ponto: o reenvio da fila offline não duplica.
+    # A chave única leva data_hora (exigência do particionamento); um ponto tem sempre
+    # a mesma data_hora, então na prática o uid sozinho é único.
+    cur.execute('''
+        ALTER TABLE registros ADD COLUMN IF NOT EXISTS ponto_uid UUID;
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_registros_ponto_uid
+            ON registros (ponto_uid, data_hora) WHERE ponto_uid IS NOT NULL;
+    ''')
+
+@migracao(12, 'funcoes_data_texto')
+def migracao_funcoes_data_texto(cur):
+    # maprix_ts/maprix_ts_local voltam (a migração 8 as removia): o restore de backups 2.0
+    # converte as datas em texto com as mesmas regras
+    cur.execute(FUNCOES_DATA_TEXTO)
+
+def migrar():
+    """Aplica as migrações pendentes e devolve [(versao, nome, ms)] das aplicadas."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_versao (
+            versao INTEGER PRIMARY KEY,
+            nome TEXT NOT NULL,
+            aplicada_em TIMESTAMPTZ NOT NULL DEFAULT now(),
+            ms REAL
+        )
+    ''')
     conn.commit()
+    # Outro processo migrando ao mesmo tempo (vários workers/deploys): espera ele terminar
+    cur.execute('SELECT pg_advisory_lock(%s)', (MIGRACAO_LOCK,))
+    aplicadas = []
+    try:
+        cur.execute('SELECT versao FROM schema_versao')
+        feitas = {r['versao'] for r in cur.fetchall()}
+        conn.commit()
+        for versao, nome, passo in sorted(MIGRACOES, key=lambda m: m[0]):
+            if versao in feitas: continue
+            inicio = time.perf_counter()
+            try:
+                passo(cur)
+                ms = round((time.perf_counter() - inicio) * 1000, 1)
+                cur.execute('INSERT INTO schema_versao (versao, nome, ms) VALUES (%s, %s, %s)', (versao, nome, ms))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise RuntimeError(f"Migração {versao} ({nome}) falhou: {e}") from e
+            aplicadas.append((versao, nome, ms))
+    finally:
+        cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRACAO_LOCK,))
+        conn.commit()
+        cur.close()
+        conn.close()
+    return aplicadas
+
+def status_migracoes():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('schema_versao') IS NOT NULL AS existe")
+    feitas = {}
+    if cur.fetchone()['existe']:
+        cur.execute('SELECT versao, aplicada_em FROM schema_versao')
+        feitas = {r['versao']: r['aplicada_em'] for r in cur.fetchall()}
     cur.close()
     conn.close()
+    return [(versao, nome, feitas.get(versao)) for versao, nome, _ in sorted(MIGRACOES, key=lambda m: m[0])]
+
+def init_db():
+    # Mantido para /init_db: agora só aplica as migrações pendentes
+    return migrar()
+
+@app.cli.command('migrar')
+@click.option('--status', is_flag=True, help='Só lista as migrações e quais já foram aplicadas.')
+def comando_migrar(status):
+    """Aplica as migrações pendentes do banco (rodar no deploy)."""
+    if status:
+        for versao, nome, aplicada_em in status_migracoes():
+            click.echo(f"{versao:>4}  {nome:<28} {aplicada_em.isoformat() if aplicada_em else 'pendente'}")
+        return
+    aplicadas = migrar()
+    for versao, nome, ms in aplicadas:
+        click.echo(f"Aplicada {versao} ({nome}) em {ms} ms")
+    click.echo(f"Schema na versão {max(m[0] for m in MIGRACOES)}." if aplicadas else "Nenhuma migração pendente.")
+
+def carregar_limites_bateria(cur):
+    """(aviso, critico) em meses, lidos uma única vez por requisição"""
+    cur.execute("SELECT chave, valor FROM config_sistema WHERE chave IN ('bat_aviso', 'bat_critico')")
+    valores = {r['chave']: r['valor'] for r in cur.fetchall()}
+    try:
+        return int(valores['bat_aviso']), int(valores['bat_critico'])
+    except (KeyError, TypeError, ValueError):
+        return 48, 54
 
-def calcular_status_bateria(data_fab_str):
+def meses_de_uso(data_fab_str, hoje=None):
+    fab = datetime.strptime(data_fab_str, "%Y-%m")
+    hoje = hoje or datetime.now()
+    return (hoje.year - fab.year) * 12 + (hoje.month - fab.month)
+
+def calcular_status_bateria(data_fab_str, limites=None, hoje=None):
+    # Para a frota inteira passe `limites` (carregar_limites_bateria) e `hoje` já prontos
     if not data_fab_str: return "Indefinido", "cinza"
     try:
-        fab = datetime.strptime(data_fab_str, "%Y-%m")
-        hoje = datetime.now()
-        meses_uso = (hoje.year - fab.year) * 12 + (hoje.month - fab.month)
-        
+        meses_uso = meses_de_uso(data_fab_str, hoje)
+    except (ValueError, TypeError):
+        return "Erro Data", "cinza"
+
+    if limites is None:
         conn = get_db_connection()
         cur = conn.cursor()
-        
-        # Busca config do banco ou usa padrão
-        try:
-            cur.execute("SELECT valor FROM config_sistema WHERE chave='bat_aviso'")
-            aviso = int(cur.fetchone()['valor'])
-            cur.execute("SELECT valor FROM config_sistema WHERE chave='bat_critico'")
-            critico = int(cur.fetchone()['valor'])
-        except:
-            aviso, critico = 48, 54
-            
+        limites = carregar_limites_bateria(cur)
         cur.close()
         conn.close()
+    aviso, critico = limites
 
-        if meses_uso >= critico: return "B/ Vencida", "vermelho"
-        elif meses_uso >= aviso: return "B/ Próximo ao Vencimento", "laranja"
-        else: return "Bateria Saúdavel", "verde"
-    except:
-        return "Erro Data", "cinza"
+    if meses_uso >= critico: return "B/ Vencida", "vermelho"
+    elif meses_uso >= aviso: return "B/ Próximo ao Vencimento", "laranja"
+    else: return "Bateria Saúdavel", "verde"
 
 def reset_sequences():
     """Corrige o contador ID (SERIAL) de todas as tabelas após restauração"""
@@ -194,7 +1265,7 @@ def reset_sequences():
         try:
             cur.execute(f"SELECT setval(pg_get_serial_sequence('{tab}', 'id'), coalesce(max(id),0) + 1, false) FROM {tab};")
         except Exception as ex:
-            print(f"Aviso sequence {tab}: {ex}")
+            app.logger.warning(f"Aviso sequence {tab}: {ex}")
     conn.commit()
     cur.close()
     conn.close()
@@ -218,52 +1289,499 @@ def index():
 @app.route('/init_db')
 def manual_init_db():
     try:
-        init_db()
-        return "Banco de dados (PostgreSQL) inicializado com sucesso!"
+        aplicadas = init_db()
+        cache_referencia.invalidar()
+        return f"Banco de dados (PostgreSQL) inicializado com sucesso! ({len(aplicadas)} migração(ões) aplicada(s))"
     except Exception as e:
         return f"Erro ao inicializar: {str(e)}"
 
+@app.route('/api/db/pool')
+def status_pool():
+    # Contadores do pool deste worker (checkouts, tempo de espera, reciclagens)
+    return jsonify(get_db_pool().estatisticas())
+
+@app.route('/api/cache/stats')
+def status_cache():
+    # Acertos/faltas do cache de cadastros deste worker
+    return jsonify(cache_referencia.estatisticas())
+
 # ==========================================
 # 3. API: OPERACIONAL
 # ==========================================
 
+def resolver_cores(cur, nomes):
+    """Cor padrão de cada equipamento do lote, em uma única consulta"""
+    nomes = list(set(nomes))
+    if not nomes: return {}
+    cur.execute('SELECT nome, cor_padrao FROM equipamentos_cadastrados WHERE nome = ANY(%s)', (nomes,))
+    return {r['nome']: r['cor_padrao'] for r in cur.fetchall()}
+
+def inserir_registros(cur, pontos, lote_max=None):
+    """Grava posições com INSERT multi-linha (um round trip por lote).
+    Cada ponto: equipamento, latitude, longitude, data_hora e opcionais observacao/cor/ponto_uid.
+    Sem 'cor' usa a cor padrão do cadastro. Ponto com ponto_uid já gravado é ignorado
+    (reenvio da fila offline). Retorna linhas novas, duplicadas e tempo (ms) de cada lote."""
+    lote_max = lote_max or INGEST_LOTE_MAX
+    garantir_particoes(cur)
+    cores = resolver_cores(cur, [p['equipamento'] for p in pontos if not p.get('cor')])
+    sincronizado_em = datetime.now(timezone.utc)
+    lotes = []
+    for i in range(0, len(pontos), lote_max):
+        inicio = time.perf_counter()
+        lote = pontos[i:i + lote_max]
+        linhas = [
+            (p['equipamento'], p['latitude'], p['longitude'], p['data_hora'], sincronizado_em,
+             p.get('observacao', ''), p.get('cor') or cores.get(p['equipamento'], '#007bff'), p.get('ponto_uid'))
+            for p in lote
+        ]
+        gravados = execute_values(cur, '''
+            INSERT INTO registros (equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor, ponto_uid)
+            VALUES %s
+            ON CONFLICT (ponto_uid, data_hora) WHERE ponto_uid IS NOT NULL DO NOTHING
+            RETURNING id, data_hora, ponto_uid''', linhas, page_size=lote_max, fetch=True)
+        # Duplicados não voltam no RETURNING: casa pelo uid (os sem uid voltam todos, na ordem).
+        # data_hora volta do banco já como timestamptz: os ganchos comparam datas, não texto
+        por_uid = {r['ponto_uid']: r for r in gravados if r['ponto_uid'] is not None}
+        sem_uid = iter([r for r in gravados if r['ponto_uid'] is None])
+        inseridos = []
+        for linha in linhas:
+            r = por_uid.pop(linha[7], None) if linha[7] else next(sem_uid)
+            if r is not None:
+                inseridos.append((r['id'],) + linha[:3] + (r['data_hora'],) + linha[4:7])
+        atualizar_posicoes_atuais(cur, inseridos)
+        indice_proximos.atualizar(inseridos)
+        avaliar_geofences(cur, inseridos)
+        atualizar_resumos(cur, inseridos)
+        notificar_posicoes(cur, inseridos)
+        lotes.append({"linhas": len(inseridos), "duplicados": len(linhas) - len(inseridos),
+                      "ms": round((time.perf_counter() - inicio) * 1000, 2)})
+    return lotes
+
+# --- POSIÇÃO ATUAL POR EQUIPAMENTO ---
+# posicoes_atuais guarda só o último ponto (maior data_hora) de cada equipamento,
+# mantida a cada inserção; a consulta do "onde está cada máquina" é O(ativos).
+
+def atualizar_posicoes_atuais(cur, inseridos):
+    """inseridos: tuplas (id, equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor)"""
+    ultimos = {}
+    for r in inseridos:
+        atual = ultimos.get(r[1])
+        if atual is None or (r[4], r[0]) > (atual[4], atual[0]):
+            ultimos[r[1]] = r
+    if not ultimos: return
+    # Ponto offline mais antigo que o atual não sobrescreve a posição
+    execute_values(cur, '''
+        INSERT INTO posicoes_atuais (registro_id, equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor)
+        VALUES %s
+        ON CONFLICT (equipamento) DO UPDATE SET
+            registro_id = EXCLUDED.registro_id, latitude = EXCLUDED.latitude, longitude = EXCLUDED.longitude,
+            data_hora = EXCLUDED.data_hora, sincronizado_em = EXCLUDED.sincronizado_em,
+            observacao = EXCLUDED.observacao, cor = EXCLUDED.cor
+        WHERE (posicoes_atuais.data_hora, posicoes_atuais.registro_id) <= (EXCLUDED.data_hora, EXCLUDED.registro_id)
+    ''', list(ultimos.values()))
+
+def recalcular_posicao_atual(cur, equipamento=None):
+    """Refaz a posição atual a partir de registros (um equipamento ou todos),
+    usado quando pontos são editados, apagados ou restaurados."""
+    filtro = 'WHERE equipamento = %s' if equipamento is not None else ''
+    params = (equipamento,) if equipamento is not None else None
+    cur.execute(f'DELETE FROM posicoes_atuais {filtro}', params)
+    cur.execute(f'''
+        INSERT INTO posicoes_atuais (registro_id, equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor)
+        SELECT DISTINCT ON (equipamento) id, equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor
+        FROM registros {filtro}
+        ORDER BY equipamento, data_hora DESC, id DESC
+    ''', params)
+
+# --- INGESTÃO WRITE-BEHIND ---
+# Os pontos aceitos ficam na fila do worker até a próxima gravação; como a resposta sai
+# antes do INSERT, eles são validados na entrada. A fila só esvazia depois do commit:
+# se o banco cair, os pontos continuam nela (e a fila cheia devolve 503, que o operador
+# trata guardando o ponto no aparelho). O encerramento normal do worker grava o que
+# restou; só um kill -9/OOM perde pontos já aceitos.
+
+BUCKETS_LINHAS = (1, 10, 50, 100, 500, 1000, 5000, 10000)
+metricas.declarar('maprix_ingest_flush_segundos', 'histogram', 'Duração de cada gravação da fila de ingestão.', BUCKETS_LATENCIA)
+metricas.declarar('maprix_ingest_flush_linhas', 'histogram', 'Pontos por gravação da fila de ingestão.', BUCKETS_LINHAS)
+
+def ler_ponto_uid(valor):
+    """Id do ponto gerado no aparelho (UUID), na forma canônica em que o banco devolve"""
+    if valor is None: return None
+    try:
+        return str(uuid.UUID(str(valor)))
+    except ValueError:
+        raise ValueError(f"id inválido: {valor}")
+
+def validar_ponto(item):
+    """Ponto do /api/registrar já normalizado; levanta ValueError com o motivo"""
+    try:
+        equipamento, lat, lon, data_hora = item['equipamento'], item['latitude'], item['longitude'], item['data_hora']
+    except (KeyError, TypeError):
+        raise ValueError("campos obrigatórios: equipamento, latitude, longitude, data_hora")
+    if not isinstance(equipamento, str) or not equipamento.strip():
+        raise ValueError("equipamento inválido")
+    for valor, limite in ((lat, 90), (lon, 180)):
+        if isinstance(valor, bool) or not isinstance(valor, (int, float)) or not math.isfinite(valor) or abs(valor) > limite:
+            raise ValueError(f"coordenada inválida: {valor}")
+    if not isinstance(data_hora, str):
+        raise ValueError(f"data_hora inválida: {data_hora}")
+    # Grava o datetime já lido, não o texto: "18/10/2026" no DateStyle MDY do banco
+    # seria erro (ou outro dia) depois do 202 da fila
+    data_hora = ler_data_hora(data_hora)
+    # Clientes antigos mandam id numérico no /api/registrar: id que não é UUID fica sem
+    # deduplicação em vez de recusar o ponto (o /api/sincronizar exige o UUID antes daqui)
+    try:
+        ponto_uid = ler_ponto_uid(item.get('id'))
+    except ValueError:
+        ponto_uid = None
+    # A cor vem sempre do cadastro do equipamento, nunca do payload
+    return {'equipamento': equipamento, 'latitude': lat, 'longitude': lon, 'data_hora': data_hora,
+            'observacao': item.get('observacao') or '', 'ponto_uid': ponto_uid}
+
+class FilaIngestao:
+    """Fila limitada de pontos aceitos e a thread que os grava em lote (uma por worker)"""
+
+    def __init__(self, maximo, flush_ms, flush_linhas):
+        self.maximo = maximo
+        self.flush_s = flush_ms / 1000
+        self.flush_linhas = flush_linhas
+        self._cond = threading.Condition()
+        self._pontos = deque()
+        self._primeiro_em = None  # Chegada (monotonic) do ponto pendente mais antigo
+        self._thread = None
+        self._pid = os.getpid()
+        self._parando = False
+        self.stats = {'aceitos': 0, 'gravados': 0, 'recusados_fila_cheia': 0, 'descartados': 0,
+                      'flushes': 0, 'falhas': 0, 'ultimo_flush_ms': 0.0}
+
+    def enfileirar(self, pontos, espera):
+        """Espera até `espera` s por espaço na fila; False se continuar cheia"""
+        limite = time.monotonic() + espera
+        with self._cond:
+            if os.getpid() != self._pid:
+                # Fork do gunicorn: a thread do processo pai não existe aqui
+                self._pontos.clear()
+                self._thread = None
+                self._pid = os.getpid()
+            while len(self._pontos) + len(pontos) > self.maximo and not self._parando:
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    self.stats['recusados_fila_cheia'] += len(pontos)
+                    return False
+                self._cond.wait(restante)
+            if self._parando: return False
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._gravar_sempre, name='maprix-ingest', daemon=True)
+                self._thread.start()
+            if not self._pontos: self._primeiro_em = time.monotonic()
+            self._pontos.extend(pontos)
+            self.stats['aceitos'] += len(pontos)
+            self._cond.notify_all()
+        return True
+
+    def _pronto(self):
+        # Chamado com o lock: hora de gravar?
+        if not self._pontos: return self._parando
+        return (self._parando or len(self._pontos) >= self.flush_linhas
+                or time.monotonic() - self._primeiro_em >= self.flush_s)
+
+    def _gravar_sempre(self):
+        falhas = 0
+        while True:
+            with self._cond:
+                while not self._pronto():
+                    self._cond.wait(self.flush_s - (time.monotonic() - self._primeiro_em) if self._pontos else None)
+                if not self._pontos: return  # Parando e sem nada pendente
+                lote = list(self._pontos)
+            try:
+                gravados = self._gravar(lote)
+            except Exception as e:
+                gravados = 0
+                self._falhou(e, lote)
+            if gravados:
+                with self._cond:
+                    for _ in range(gravados): self._pontos.popleft()
+                    self._primeiro_em = time.monotonic() if self._pontos else None
+                    self._cond.notify_all()
+            if gravados < len(lote):
+                falhas += 1
+                time.sleep(min(0.2 * 2 ** falhas, 5))
+            else:
+                falhas = 0
+
+    def _gravar(self, lote):
+        """Grava o lote em uma transação. Devolve quantos pontos do início da fila saíram
+        (gravados ou descartados); o resto fica para a próxima tentativa."""
+        inicio = time.perf_counter()
+        conn = get_db_pool().obter()
+        cur = conn.cursor()
+        try:
+            try:
+                inserir_registros(cur, lote)
+                conn.commit()
+                resolvidos, descartados = len(lote), 0
+            except (psycopg2.DataError, psycopg2.IntegrityError):
+                # Algum ponto que a validação deixou passar: isola os culpados um a um
+                conn.rollback()
+                resolvidos, descartados = self._gravar_separados(conn, cur, lote)
+        finally:
+            cur.close()
+            conn.close()
+        segundos = time.perf_counter() - inicio
+        metricas.observar('maprix_ingest_flush_segundos', segundos)
+        metricas.observar('maprix_ingest_flush_linhas', resolvidos)
+        with self._cond:
+            self.stats['flushes'] += 1
+            self.stats['gravados'] += resolvidos - descartados
+            self.stats['descartados'] += descartados
+            self.stats['ultimo_flush_ms'] = round(segundos * 1000, 2)
+        return resolvidos
+
+    def _gravar_separados(self, conn, cur, lote):
+        descartados = 0
+        for i, p in enumerate(lote):
+            try:
+                inserir_registros(cur, [p])
+                conn.commit()
+            except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+                conn.rollback()
+                descartados += 1
+                app.logger.warning(f"Ingestão: ponto descartado {p}: {e}")
+            except psycopg2.Error as e:
+                # Banco caiu no meio: os já gravados saem da fila, o resto espera
+                # (a conexão quebrada é descartada ao voltar para o pool)
+                self._falhou(e, lote[i:])
+                return i, descartados
+        return len(lote), descartados
+
+    def _falhou(self, erro, lote):
+        with self._cond:
+            self.stats['falhas'] += 1
+        app.logger.warning(f"Ingestão: falha ao gravar {len(lote)} pontos, nova tentativa: {erro}")
+
+    def parar(self, timeout=25):
+        """Grava o que estiver na fila e encerra a thread (saída normal do worker)"""
+        with self._cond:
+            self._parando = True
+            self._cond.notify_all()
+            thread = self._thread if os.getpid() == self._pid else None
+        if thread is not None:
+            thread.join(timeout)
+        with self._cond:
+            pendentes = len(self._pontos) if os.getpid() == self._pid else 0
+        if pendentes:
+            app.logger.error(f"Ingestão: {pendentes} pontos aceitos não foram gravados no encerramento")
+
+    def estatisticas(self):
+        with self._cond:
+            s = dict(self.stats)
+            s['profundidade'] = len(self._pontos) if os.getpid() == self._pid else 0
+            s['idade_ms'] = round((time.monotonic() - self._primeiro_em) * 1000, 1) if s['profundidade'] else 0.0
+        s.update({'ativo': INGEST_ASSINCRONO, 'maximo': self.maximo,
+                  'flush_ms': self.flush_s * 1000, 'flush_linhas': self.flush_linhas})
+        return s
+
+fila_ingestao = FilaIngestao(INGEST_FILA_MAX, INGEST_FLUSH_MS, INGEST_FLUSH_LINHAS)
+atexit.register(fila_ingestao.parar)
+
+@app.route('/api/ingestao/stats')
+def status_ingestao():
+    return jsonify(fila_ingestao.estatisticas())
+
 @app.route('/api/registrar', methods=['POST'])
 def registrar_posicao():
     dados = request.json
     lista_dados = dados if isinstance(dados, list) else [dados]
+    # Mesma validação nos dois caminhos: o status não depende da fila estar ligada
+    try:
+        pontos = [validar_ponto(item) for item in lista_dados]
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+    if INGEST_ASSINCRONO and len(pontos) <= INGEST_FILA_MAX:
+        if not fila_ingestao.enfileirar(pontos, INGEST_FILA_ESPERA):
+            resp = jsonify({"erro": "Fila de ingestão cheia, tente novamente"})
+            resp.headers['Retry-After'] = '1'
+            return resp, 503
+        return jsonify({"status": "aceito", "aceitos": len(pontos)}), 202
+    inicio = time.perf_counter()
     conn = get_db_connection()
     cur = conn.cursor()
-    
-    for item in lista_dados:
-        # Pega a cor padrão do cadastro
-        cur.execute('SELECT cor_padrao FROM equipamentos_cadastrados WHERE nome = %s', (item['equipamento'],))
-        res = cur.fetchone()
-        cor_final = res['cor_padrao'] if res else '#007bff'
-        
-        cur.execute('''
-            INSERT INTO registros (equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s)''',
-            (item['equipamento'], item['latitude'], item['longitude'], item['data_hora'], datetime.now().isoformat(), item.get('observacao', ''), cor_final)
-        )
+    lotes = inserir_registros(cur, pontos)
     conn.commit()
     cur.close()
     conn.close()
-    return jsonify({"status": "sucesso"}), 201
+    total = sum(l['linhas'] for l in lotes)
+    ms_total = (time.perf_counter() - inicio) * 1000
+    return jsonify({
+        "status": "sucesso",
+        "inseridos": total,
+        "lotes": lotes,
+        "ms_total": round(ms_total, 2),
+        "linhas_por_seg": round(total / (ms_total / 1000), 1) if ms_total else None
+    }), 201
+
+@app.route('/api/sincronizar', methods=['POST'])
+def sincronizar_fila():
+    """Um lote da fila offline do aparelho: {"lote": ..., "pontos": [{"id": uuid, ...}]}.
+    Idempotente: ponto com id já gravado é confirmado sem gravar de novo, então o aparelho
+    reenvia só o lote que não teve resposta. Pontos inválidos voltam em "rejeitados" (nunca
+    vão passar; o aparelho descarta) e os demais em "confirmados"."""
+    dados = request.get_json(silent=True)
+    itens = dados.get('pontos') if isinstance(dados, dict) else None
+    if not isinstance(itens, list) or not itens:
+        return jsonify({"erro": "Lista de pontos obrigatória"}), 400
+    if len(itens) > SYNC_LOTE_MAX:
+        return jsonify({"erro": f"Máximo de {SYNC_LOTE_MAX} pontos por lote", "lote_max": SYNC_LOTE_MAX}), 413
+    pontos, rejeitados = {}, []
+    for item in itens:
+        try:
+            uid = ler_ponto_uid(item.get('id') if isinstance(item, dict) else None)
+        except ValueError as e:
+            return jsonify({"erro": str(e)}), 400
+        if uid is None:
+            return jsonify({"erro": "Todo ponto precisa de id"}), 400
+        try:
+            pontos[uid] = validar_ponto(item)
+        except ValueError as e:
+            rejeitados.append({"id": uid, "motivo": str(e)})
+    inicio = time.perf_counter()
+    lotes = []
+    if pontos:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        lotes = inserir_registros(cur, list(pontos.values()))
+        conn.commit()
+        cur.close()
+        conn.close()
+    return jsonify({
+        "status": "sucesso",
+        "lote": dados.get('lote'),
+        "confirmados": list(pontos),
+        "rejeitados": rejeitados,
+        "inseridos": sum(l['linhas'] for l in lotes),
+        "duplicados": sum(l['duplicados'] for l in lotes),
+        "lote_max": SYNC_LOTE_MAX,
+        "ms_total": round((time.perf_counter() - inicio) * 1000, 2)
+    })
+
+# --- FORMATO COMPACTO (COLUNAR) ---
+# ?formato=colunar devolve uma página do /api/locais em colunas de inteiros:
+#   textos repetidos (equipamento, cor, observacao) -> índice num dicionário
+#   id, latitude/longitude (1/ESCALA_COORD grau) e data_hora (epoch ms) -> delta do anterior
+#   sincronizado_em -> atraso em ms sobre data_hora (índices nulos listados à parte)
+# ?formato=binario leva as mesmas colunas em varints zigzag:
+#   b'MPX1' | uint32 LE tamanho do cabeçalho | cabeçalho JSON | colunas na ordem de "ordem"
+
+COLUNAS_COLUNAR = ['id', 'equipamento', 'latitude', 'longitude', 'data_hora', 'sincronizado_em', 'observacao', 'cor']
+
+def codificar_colunar(linhas):
+    """(cabeçalho, {coluna: np.int64[]}) de linhas de registros em ordem de id"""
+    n = len(linhas)
+    dicionarios, colunas = {}, {}
+    for c in ('equipamento', 'cor', 'observacao'):
+        indices = {}
+        colunas[c] = np.fromiter((indices.setdefault(l[c], len(indices)) for l in linhas), np.int64, n)
+        dicionarios[c] = list(indices)
+    delta = lambda v: np.diff(v, prepend=np.int64(0))
+    colunas['id'] = delta(np.fromiter((l['id'] for l in linhas), np.int64, n))
+    for c in ('latitude', 'longitude'):
+        graus = np.fromiter((l[c] for l in linhas), float, n)
+        colunas[c] = delta(np.round(graus * ESCALA_COORD).astype(np.int64))
+    ms = np.fromiter((round(para_epoch(l['data_hora']) * 1000) for l in linhas), np.int64, n)
+    colunas['data_hora'] = delta(ms)
+    nulos = [i for i, l in enumerate(linhas) if l['sincronizado_em'] is None]
+    colunas['sincronizado_em'] = np.fromiter(
+        (0 if l['sincronizado_em'] is None else round(para_epoch(l['sincronizado_em']) * 1000) for l in linhas),
+        np.int64, n) - ms
+    colunas['sincronizado_em'][nulos] = 0
+    cabecalho = {"versao": 1, "n": n, "escala_coord": ESCALA_COORD, "dicionarios": dicionarios,
+                 "nulos": {"sincronizado_em": nulos}}
+    return cabecalho, colunas
+
+def varints(valores):
+    """Inteiros com sinal em zigzag + LEB128 (1 byte para |v| < 64), vetorizado"""
+    v = np.asarray(valores, dtype=np.int64)
+    z = ((v << 1) ^ (v >> 63)).view(np.uint64)
+    deslocamentos = np.arange(10, dtype=np.uint64) * np.uint64(7)
+    grupos = (z[:, None] >> deslocamentos) & np.uint64(0x7F)
+    tamanhos = 1 + (z[:, None] >> deslocamentos[1:] != 0).sum(axis=1)
+    k = np.arange(10)
+    continua = np.where(k < (tamanhos - 1)[:, None], np.uint64(0x80), np.uint64(0))
+    return (grupos | continua).astype(np.uint8)[k < tamanhos[:, None]].tobytes()
+
+def responder_colunar(linhas, formato, extra):
+    cabecalho, colunas = codificar_colunar(linhas)
+    cabecalho.update(extra)
+    if formato == 'binario':
+        cabecalho['ordem'] = COLUNAS_COLUNAR
+        meta = json.dumps(cabecalho, default=json_padrao).encode('utf-8')
+        corpo = b'MPX1' + len(meta).to_bytes(4, 'little') + meta + b''.join(varints(colunas[c]) for c in COLUNAS_COLUNAR)
+        return Response(corpo, mimetype='application/x-maprix-colunar')
+    cabecalho['formato'] = 'colunar'
+    cabecalho['colunas'] = {c: colunas[c].tolist() for c in COLUNAS_COLUNAR}
+    return jsonify(cabecalho)
 
 @app.route('/api/locais')
 def get_locais():
+    # Sem parâmetros mantém o formato antigo (histórico completo em uma lista)
+    # (enviado em streaming; ?formato=ndjson para um objeto por linha)
+    # (?formato=colunar|binario sempre usa a paginação abaixo)
+    formato = request.args.get('formato')
+    if formato not in ('colunar', 'binario') and \
+            not any(k in request.args for k in ('since_id', 'since', 'equipamento', 'inicio', 'fim', 'limite')):
+        def chunks():
+            conn = get_db_connection()
+            yield from ler_em_chunks(conn, 'SELECT * FROM registros ORDER BY data_hora ASC')
+        return stream_json(chunks(), formato_stream())
+
+    # Delta / paginação por keyset: id > since_id ORDER BY id LIMIT n (range scan na PK)
+    since_id = request.args.get('since_id', 0, type=int)
+    limite = max(1, min(request.args.get('limite', LOCAIS_PAGINA_PADRAO, type=int), LOCAIS_PAGINA_MAX))
+    condicoes, params = ['id > %s'], [since_id]
+    if request.args.get('equipamento'):
+        condicoes.append('equipamento = %s')
+        params.append(request.args['equipamento'])
+
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('SELECT * FROM registros ORDER BY data_hora ASC')
+    try:
+        if request.args.get('since'):
+            condicoes.append('sincronizado_em > %s')  # Recebidos pelo servidor depois desse instante
+            params.append(ler_instante(cur, request.args['since']))
+        if request.args.get('inicio'):
+            condicoes.append('data_hora >= %s')
+            params.append(ler_instante(cur, request.args['inicio']))
+        if request.args.get('fim'):
+            condicoes.append('data_hora <= %s')
+            params.append(ler_instante(cur, request.args['fim']))
+    except ValueError as e:
+        cur.close()
+        conn.close()
+        return jsonify({"erro": str(e)}), 400
+    cur.execute(f"SELECT * FROM registros WHERE {' AND '.join(condicoes)} ORDER BY id LIMIT %s", params + [limite + 1])
     registros = cur.fetchall()
     cur.close()
     conn.close()
-    return jsonify([dict(row) for row in registros])
+
+    tem_mais = len(registros) > limite
+    registros = registros[:limite]
+    if formato in ('colunar', 'binario'):
+        return responder_colunar(registros, formato, {
+            "ultimo_id": registros[-1]['id'] if registros else since_id, "tem_mais": tem_mais
+        })
+    return jsonify({
+        "dados": [dict(row) for row in registros],
+        "ultimo_id": registros[-1]['id'] if registros else since_id,
+        "tem_mais": tem_mais
+    })
 
 @app.route('/api/registro/<int:id>', methods=['PUT', 'DELETE'])
 def manage_registro(id):
     conn = get_db_connection()
     cur = conn.cursor()
+    cur.execute('SELECT equipamento, data_hora FROM registros WHERE id = %s', (id,))
+    anterior = cur.fetchone()
+    afetados = {anterior['equipamento']} if anterior else set()
     if request.method == 'DELETE':
         cur.execute('DELETE FROM registros WHERE id = %s', (id,))
         msg = "deletado"
@@ -271,19 +1789,1205 @@ def manage_registro(id):
         d = request.json
         cur.execute('UPDATE registros SET equipamento=%s, cor=%s, observacao=%s WHERE id=%s', 
                      (d['equipamento'], d['cor'], d['observacao'], id))
+        afetados.add(d['equipamento'])
         msg = "atualizado"
+    for equipamento in afetados:
+        recalcular_posicao_atual(cur, equipamento)
+    if anterior:
+        marcar_resumos(cur, [(e, dia_local(anterior['data_hora'])) for e in afetados])
     conn.commit()
     cur.close()
     conn.close()
     return jsonify({"status": msg})
 
+@app.route('/api/posicoes/atuais')
+def get_posicoes_atuais():
+    # Última posição conhecida de cada equipamento (uma linha por ativo)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    if request.args.get('equipamento'):
+        cur.execute('SELECT * FROM posicoes_atuais WHERE equipamento = %s', (request.args['equipamento'],))
+    else:
+        cur.execute('SELECT * FROM posicoes_atuais ORDER BY equipamento')
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return jsonify([dict(row) for row in rows])
+
+# --- RESUMO DIÁRIO POR EQUIPAMENTO ---
+# resumo_diario guarda, por equipamento e dia (no fuso RESUMO_FUSO): pontos (total e por
+# turno), distância percorrida (haversine), tempo parado e em movimento, primeiro e último
+# ponto. Cada lote ingerido avança o estado do dia a partir do último ponto gravado.
+# Ponto fora de ordem (sync offline atrasado), edição, exclusão ou restore marcam o dia
+# com recalcular=true e ele é refeito a partir de registros: um pouco na leitura
+# (limitado, sem esperar travas) e o resto por uma thread do worker ou pela CLI.
+# O ativo só "anda" quando se afasta RESUMO_RAIO_PARADO metros da âncora (último ponto
+# em que andou): o ruído do GPS parado não vira quilometragem.
+
+RAIO_TERRA_M = 6371008.8
+FUSO_RESUMO = ZoneInfo(RESUMO_FUSO)
+COLUNAS_RESUMO = ['pontos', 'pontos_turno', 'distancia_m', 'parado_s', 'movimento_s', 'primeiro_em',
+                  'ultimo_em', 'ultimo_lat', 'ultimo_lon', 'ancora_lat', 'ancora_lon']
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    f1, f2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((f2 - f1) / 2) ** 2
+         + math.cos(f1) * math.cos(f2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * RAIO_TERRA_M * math.asin(math.sqrt(min(1.0, a)))
+
+def dia_local(data_hora):
+    return data_hora.astimezone(FUSO_RESUMO).date()
+
+def turno_de(data_hora):
+    # Antes do primeiro início do dia ainda é o último turno da véspera
+    return (bisect.bisect_right(RESUMO_TURNOS, data_hora.astimezone(FUSO_RESUMO).hour) - 1) % len(RESUMO_TURNOS)
+
+def novo_resumo():
+    return {c: None for c in COLUNAS_RESUMO} | {
+        'pontos': 0, 'pontos_turno': [0] * len(RESUMO_TURNOS), 'distancia_m': 0.0, 'parado_s': 0.0, 'movimento_s': 0.0
+    }
+
+def acumular_resumo(resumo, pontos):
+    """Avança o resumo do dia com pontos (data_hora, lat, lon) em ordem cronológica"""
+    turnos = list(resumo['pontos_turno'] or [])
+    turnos += [0] * (len(RESUMO_TURNOS) - len(turnos))
+    for dh, lat, lon in pontos:
+        if resumo['ultimo_em'] is None:
+            resumo['primeiro_em'] = dh
+            resumo['ancora_lat'], resumo['ancora_lon'] = lat, lon
+        else:
+            intervalo = (dh - resumo['ultimo_em']).total_seconds()
+            d = haversine_m(resumo['ancora_lat'], resumo['ancora_lon'], lat, lon)
+            andou = d >= RESUMO_RAIO_PARADO
+            if andou:
+                resumo['distancia_m'] += d
+                resumo['ancora_lat'], resumo['ancora_lon'] = lat, lon
+            # Lacuna longa (aparelho desligado/sem sinal) não conta como parado nem movimento
+            if intervalo <= RESUMO_LACUNA_MAX:
+                resumo['movimento_s' if andou else 'parado_s'] += intervalo
+        resumo['ultimo_em'], resumo['ultimo_lat'], resumo['ultimo_lon'] = dh, lat, lon
+        resumo['pontos'] += 1
+        turnos[turno_de(dh)] += 1
+    resumo['pontos_turno'] = turnos
+    return resumo
+
+def gravar_resumos(cur, resumos, em_conflito):
+    """resumos: {(equipamento, dia): resumo}. em_conflito: SET do ON CONFLICT"""
+    if not resumos: return
+    execute_values(cur, f'''
+        INSERT INTO resumo_diario (equipamento, dia, {', '.join(COLUNAS_RESUMO)}, recalcular) VALUES %s
+        ON CONFLICT (equipamento, dia) DO UPDATE SET {em_conflito}
+    ''', [chave + tuple(r[c] for c in COLUNAS_RESUMO) + (False,) for chave, r in resumos.items()])
+
+def atualizar_resumos(cur, inseridos):
+    """inseridos: tuplas (id, equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor)"""
+    por_dia = {}
+    for r in sorted(inseridos, key=lambda r: (r[4], r[0])):
+        por_dia.setdefault((r[1], dia_local(r[4])), []).append((r[4], r[2], r[3]))
+    if not por_dia: return
+    chaves = list(por_dia)
+    # Trava os dias já existentes: duas ingestões do mesmo ativo avançam uma de cada vez
+    cur.execute(f'''
+        SELECT equipamento, dia, recalcular, {', '.join(COLUNAS_RESUMO)} FROM resumo_diario
+        WHERE (equipamento, dia) IN (SELECT * FROM unnest(%s::text[], %s::date[]))
+        ORDER BY equipamento, dia FOR UPDATE
+    ''', ([c[0] for c in chaves], [c[1] for c in chaves]))
+    existentes = {(r['equipamento'], r['dia']): r for r in cur.fetchall()}
+    novos, avancados, fora_de_ordem = {}, {}, []
+    for chave, pontos in por_dia.items():
+        atual = existentes.get(chave)
+        if atual is None:
+            novos[chave] = acumular_resumo(novo_resumo(), pontos)
+        elif atual['recalcular']:
+            continue
+        elif pontos[0][0] < atual['ultimo_em']:
+            fora_de_ordem.append(chave)
+        else:
+            avancados[chave] = acumular_resumo(dict(atual), pontos)
+    gravar_resumos(cur, avancados, ', '.join(f"{c} = EXCLUDED.{c}" for c in COLUNAS_RESUMO))
+    # Outro lote criou o mesmo dia ao mesmo tempo: refaz a partir de registros
+    gravar_resumos(cur, novos, 'recalcular = true')
+    marcar_resumos(cur, fora_de_ordem)
+
+def marcar_resumos(cur, chaves):
+    """Dias (equipamento, dia) a refazer a partir de registros"""
+    chaves = set(chaves)
+    if not chaves: return
+    execute_values(cur, '''
+        INSERT INTO resumo_diario (equipamento, dia, recalcular) VALUES %s
+        ON CONFLICT (equipamento, dia) DO UPDATE SET recalcular = true
+    ''', [c + (True,) for c in chaves])
+
+def filtro_resumos(inicio=None, fim=None, equipamento=None):
+    condicoes, params = ['recalcular'], []
+    if inicio:
+        condicoes.append('dia >= %s')
+        params.append(inicio)
+    if fim:
+        condicoes.append('dia <= %s')
+        params.append(fim)
+    if equipamento:
+        condicoes.append('equipamento = %s')
+        params.append(equipamento)
+    return ' AND '.join(condicoes), params
+
+def recalcular_resumos(conn, inicio=None, fim=None, equipamento=None, lote=50, maximo=None, pular_travados=False):
+    """Refaz os dias marcados (do intervalo pedido) em transações de até `lote` dias, no
+    máximo `maximo` dias no total. Os dias ficam travados enquanto isso: a ingestão
+    concorrente espera e continua dali. pular_travados: deixa de lado os dias que outra
+    transação já travou (em vez de esperar por eles)."""
+    where, params = filtro_resumos(inicio, fim, equipamento)
+    trava = 'FOR UPDATE SKIP LOCKED' if pular_travados else 'FOR UPDATE'
+    total = 0
+    cur = conn.cursor()
+    while maximo is None or total < maximo:
+        n = lote if maximo is None else min(lote, maximo - total)
+        cur.execute(f'''
+            SELECT equipamento, dia FROM resumo_diario WHERE {where}
+            ORDER BY dia, equipamento LIMIT %s {trava}
+        ''', params + [n])
+        chaves = [(r['equipamento'], r['dia']) for r in cur.fetchall()]
+        if not chaves: break
+        resumos = {}
+        sql = '''
+            SELECT r.equipamento, r.data_hora, r.latitude, r.longitude
+            FROM unnest(%s::text[], %s::date[]) AS k(equipamento, dia)
+            JOIN registros r ON r.equipamento = k.equipamento
+             AND r.data_hora >= k.dia::timestamp AT TIME ZONE %s
+             AND r.data_hora < (k.dia + 1)::timestamp AT TIME ZONE %s
+            ORDER BY r.equipamento, r.data_hora, r.id
+        '''
+        for linhas in ler_em_chunks(conn, sql, ([c[0] for c in chaves], [c[1] for c in chaves], RESUMO_FUSO, RESUMO_FUSO)):
+            for l in linhas:
+                chave = (l['equipamento'], dia_local(l['data_hora']))
+                resumo = resumos.get(chave)
+                if resumo is None: resumo = resumos[chave] = novo_resumo()
+                acumular_resumo(resumo, [(l['data_hora'], l['latitude'], l['longitude'])])
+        gravar_resumos(cur, resumos, ', '.join(f"{c} = EXCLUDED.{c}" for c in COLUNAS_RESUMO + ['recalcular']))
+        # Dias que ficaram sem pontos (exclusão, arquivo) saem do resumo
+        vazios = [c for c in chaves if c not in resumos]
+        if vazios:
+            cur.execute('''
+                DELETE FROM resumo_diario WHERE (equipamento, dia) IN (SELECT * FROM unnest(%s::text[], %s::date[]))
+            ''', ([c[0] for c in vazios], [c[1] for c in vazios]))
+        conn.commit()
+        total += len(chaves)
+    cur.close()
+    conn.commit()
+    return total
+
+def contar_resumos_pendentes(cur, inicio=None, fim=None, equipamento=None):
+    where, params = filtro_resumos(inicio, fim, equipamento)
+    cur.execute(f'SELECT count(*) AS n FROM resumo_diario WHERE {where}', params)
+    return cur.fetchone()['n']
+
+_recalculo_lock = threading.Lock()
+_recalculo_thread = None
+
+def recalcular_em_segundo_plano():
+    """Dispara (se ainda não estiver rodando neste worker) a thread que refaz todos os dias
+    marcados, com conexão própria do pool. Workers diferentes dividem o trabalho pelo
+    SKIP LOCKED. No serverless não roda: a função congela após a resposta."""
+    global _recalculo_thread
+    if DB_SERVERLESS: return
+    with _recalculo_lock:
+        if _recalculo_thread is not None and _recalculo_thread.is_alive(): return
+        _recalculo_thread = threading.Thread(target=_recalcular_pendentes, name='maprix-resumos', daemon=True)
+        _recalculo_thread.start()
+
+def _recalcular_pendentes():
+    conn = get_db_pool().obter()
+    try:
+        while recalcular_resumos(conn, maximo=500, pular_travados=True):
+            pass
+    except Exception as e:
+        conn.rollback()
+        app.logger.warning(f"Erro ao recalcular resumos: {e}")
+    finally:
+        conn.close()
+
+def agregar_resumos(linhas, agrupar):
+    """Soma as linhas diárias por (equipamento, dia), equipamento ou dia (frota)"""
+    campos = {'dia': ('equipamento', 'dia'), 'equipamento': ('equipamento',), 'frota': ('dia',)}[agrupar]
+    grupos = OrderedDict()
+    for l in linhas:
+        chave = tuple(l[c] for c in campos)
+        g = grupos.get(chave)
+        if g is None:
+            g = grupos[chave] = {**dict(zip(campos, chave)), 'dias': set(), 'equipamentos': set(), 'pontos': 0,
+                                 'pontos_turno': [0] * len(RESUMO_TURNOS), 'distancia_m': 0.0, 'parado_s': 0.0,
+                                 'movimento_s': 0.0, 'primeiro_em': None, 'ultimo_em': None}
+        g['dias'].add(l['dia'])
+        g['equipamentos'].add(l['equipamento'])
+        g['pontos'] += l['pontos']
+        for i, n in enumerate((l['pontos_turno'] or [])[:len(RESUMO_TURNOS)]):
+            g['pontos_turno'][i] += n
+        for c in ('distancia_m', 'parado_s', 'movimento_s'):
+            g[c] += l[c]
+        if l['primeiro_em'] and (g['primeiro_em'] is None or l['primeiro_em'] < g['primeiro_em']):
+            g['primeiro_em'] = l['primeiro_em']
+        if l['ultimo_em'] and (g['ultimo_em'] is None or l['ultimo_em'] > g['ultimo_em']):
+            g['ultimo_em'] = l['ultimo_em']
+    for g in grupos.values():
+        g['dias'], g['equipamentos'] = len(g['dias']), len(g['equipamentos'])
+        g['km'] = round(g.pop('distancia_m') / 1000, 3)
+        g['parado_s'], g['movimento_s'] = round(g['parado_s']), round(g['movimento_s'])
+    return list(grupos.values())
+
+@app.route('/api/resumos')
+def get_resumos():
+    """?inicio=&fim= (AAAA-MM-DD, padrão últimos 7 dias), equipamento, agrupar=dia|equipamento|frota"""
+    try:
+        fim = date.fromisoformat(request.args['fim']) if request.args.get('fim') else datetime.now(FUSO_RESUMO).date()
+        inicio = date.fromisoformat(request.args['inicio']) if request.args.get('inicio') else fim - timedelta(days=6)
+    except ValueError:
+        return jsonify({"erro": "Datas no formato AAAA-MM-DD"}), 400
+    agrupar = request.args.get('agrupar', 'dia')
+    if agrupar not in ('dia', 'equipamento', 'frota'):
+        return jsonify({"erro": "agrupar deve ser dia, equipamento ou frota"}), 400
+    equipamento = request.args.get('equipamento')
+    try:
+        conn = get_db_connection()
+        recalculados = recalcular_resumos(conn, inicio, fim, equipamento,
+                                          maximo=RESUMO_RECALCULO_LEITURA, pular_travados=True)
+        cur = conn.cursor()
+        pendentes = contar_resumos_pendentes(cur, inicio, fim, equipamento)
+        if pendentes: recalcular_em_segundo_plano()
+        filtro = 'AND equipamento = %s' if equipamento else ''
+        cur.execute(f'''
+            SELECT equipamento, dia, pontos, pontos_turno, distancia_m, parado_s, movimento_s, primeiro_em, ultimo_em
+            FROM resumo_diario WHERE dia BETWEEN %s AND %s {filtro}
+            ORDER BY dia, equipamento
+        ''', [inicio, fim] + ([equipamento] if equipamento else []))
+        linhas = cur.fetchall()
+        cur.close()
+        conn.close()
+        return jsonify({
+            "inicio": inicio, "fim": fim, "fuso": RESUMO_FUSO, "turnos": RESUMO_TURNOS,
+            "agrupar": agrupar, "recalculados": recalculados, "pendentes": pendentes, "dados": agregar_resumos(linhas, agrupar)
+        })
+    except Exception as e:
+        return jsonify({"erro": str(e)}), 500
+
+@app.cli.group('resumos')
+def comando_resumos():
+    """Resumo diário por equipamento (resumo_diario)."""
+
+@comando_resumos.command('recalcular')
+@click.option('--tudo', is_flag=True, help='Refaz todos os dias do histórico (ex.: após mudar RESUMO_FUSO ou o raio).')
+def comando_recalcular_resumos(tudo):
+    """Calcula os dias marcados para recalcular."""
+    conn = get_db_connection()
+    if tudo:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO resumo_diario (equipamento, dia, recalcular)
+            SELECT DISTINCT equipamento, (data_hora AT TIME ZONE %s)::date, true FROM registros
+            ON CONFLICT (equipamento, dia) DO UPDATE SET recalcular = true
+        ''', (RESUMO_FUSO,))
+        conn.commit()
+        cur.close()
+    click.echo(f"{recalcular_resumos(conn)} dia(s) recalculado(s).")
+
+# --- TRAJETO SIMPLIFICADO ---
+# Douglas-Peucker vetorizado (numpy) sobre o histórico de um equipamento, com
+# tolerância derivada do zoom. O resultado fica em cache por tolerância e é
+# invalidado sozinho quando o histórico muda (a chave inclui count e max(id)).
+# Sem inicio a janela é dos últimos TRAJETO_DIAS_PADRAO dias (início arredondado
+# para a hora, para a chave do cache não mudar a cada chamada).
+
+_trajeto_cache = OrderedDict()
+_trajeto_cache_lock = threading.Lock()
+
+def metros_por_pixel(lat, zoom):
+    return 156543.03392 * math.cos(math.radians(lat)) / (2 ** zoom)
+
+def para_epoch(valor):
+    if hasattr(valor, 'timestamp'): return valor.timestamp()
+    try:
+        return datetime.fromisoformat(str(valor).replace('Z', '+00:00')).timestamp()
+    except ValueError:
+        return float('nan')
+
+def douglas_peucker(xy, tolerancia):
+    """Índices dos pontos mantidos. xy: array (n, 2) em metros."""
+    n = len(xy)
+    if n < 3: return np.arange(n)
+    manter = np.zeros(n, dtype=bool)
+    manter[0] = manter[-1] = True
+    pilha = [(0, n - 1)]
+    while pilha:
+        i, j = pilha.pop()
+        if j - i < 2: continue
+        a, b = xy[i], xy[j]
+        trecho = xy[i + 1:j]
+        dx, dy = b - a
+        comprimento = math.hypot(dx, dy)
+        if comprimento == 0:
+            dist = np.hypot(trecho[:, 0] - a[0], trecho[:, 1] - a[1])
+        else:
+            dist = np.abs(dx * (trecho[:, 1] - a[1]) - dy * (trecho[:, 0] - a[0])) / comprimento
+        k = int(np.argmax(dist))
+        if dist[k] > tolerancia:
+            meio = i + 1 + k
+            manter[meio] = True
+            pilha.append((i, meio))
+            pilha.append((meio, j))
+    return np.flatnonzero(manter)
+
+@app.route('/api/trajeto')
+def get_trajeto():
+    equipamento = request.args.get('equipamento')
+    if not equipamento: return jsonify({"erro": "Equipamento obrigatório"}), 400
+    bucket = request.args.get('bucket', 0, type=int)  # Segundos: mantém o último ponto de cada janela
+    zoom = request.args.get('zoom', type=int)
+    tolerancia = request.args.get('tolerancia', type=float)  # Metros (tem prioridade sobre o zoom)
+
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        try:
+            fim = ler_instante(cur, request.args['fim']) if request.args.get('fim') else None
+            if request.args.get('inicio'):
+                inicio = ler_instante(cur, request.args['inicio'])
+            else:
+                base = fim or datetime.now(timezone.utc)
+                inicio = (base - timedelta(days=TRAJETO_DIAS_PADRAO)).replace(minute=0, second=0, microsecond=0)
+        except ValueError as e:
+            cur.close()
+            conn.close()
+            return jsonify({"erro": str(e)}), 400
+
+        condicoes, params = ['equipamento = %s', 'data_hora >= %s'], [equipamento, inicio]
+        if fim:
+            condicoes.append('data_hora <= %s')
+            params.append(fim)
+        where = ' AND '.join(condicoes)
+
+        cur.execute(f'SELECT count(*) AS n, max(id) AS max_id FROM registros WHERE {where}', params)
+        versao = cur.fetchone()
+        cur.close()
+        nivel = ('m', round(tolerancia, 1)) if tolerancia is not None else ('z', zoom)
+        chave = (equipamento, inicio, fim, bucket, nivel, versao['n'], versao['max_id'])
+        with _trajeto_cache_lock:
+            em_cache = _trajeto_cache.get(chave)
+            if em_cache is not None: _trajeto_cache.move_to_end(chave)
+        if em_cache is not None:
+            conn.close()
+            return jsonify(dict(em_cache, cache=True))
+
+        # Em chunks pelo cursor nomeado: guarda só as colunas usadas, não as linhas inteiras
+        ids, datas, lats, lons = [], [], [], []
+        for linhas in ler_em_chunks(conn, f'SELECT id, latitude, longitude, data_hora FROM registros '
+                                          f'WHERE {where} ORDER BY data_hora, id', params):
+            for r in linhas:
+                ids.append(r['id'])
+                datas.append(r['data_hora'])
+                lats.append(r['latitude'])
+                lons.append(r['longitude'])
+        conn.close()
+    except Exception as e:
+        return jsonify({"erro": str(e)}), 500
+
+    coords = np.column_stack((np.array(lats, dtype=float), np.array(lons, dtype=float)))
+    idx = np.arange(len(ids))
+    if bucket > 0 and len(ids):
+        janelas = np.floor(np.array([para_epoch(d) for d in datas]) / bucket)
+        idx = np.flatnonzero(np.r_[janelas[1:] != janelas[:-1], True])
+
+    lat0 = float(coords[idx, 0].mean()) if len(idx) else 0.0
+    if tolerancia is None:
+        tolerancia = 1.5 * metros_por_pixel(lat0, zoom) if zoom is not None else 5.0
+    # Projeção equiretangular local (metros), suficiente na escala de um trajeto
+    raio = 6371008.8
+    xy = np.column_stack((
+        np.radians(coords[idx, 1]) * raio * math.cos(math.radians(lat0)),
+        np.radians(coords[idx, 0]) * raio
+    ))
+    mantidos = idx[douglas_peucker(xy, tolerancia)]
+
+    resultado = {
+        "equipamento": equipamento,
+        "inicio": inicio,
+        "fim": fim,
+        "originais": len(ids),
+        "apos_bucket": int(len(idx)),
+        "simplificados": int(len(mantidos)),
+        "tolerancia_m": round(tolerancia, 2),
+        "colunas": ["latitude", "longitude", "data_hora", "id"],
+        "pontos": [[lats[i], lons[i], json_padrao(datas[i]), ids[i]] for i in mantidos]
+    }
+    with _trajeto_cache_lock:
+        _trajeto_cache[chave] = resultado
+        while len(_trajeto_cache) > TRAJETO_CACHE_MAX:
+            _trajeto_cache.popitem(last=False)
+    return jsonify(dict(resultado, cache=False))
+
+# --- FROTA NO INSTANTE E REPRODUÇÃO ---
+# Posição de cada ativo num instante T = último ponto com data_hora <= T. Cada ativo é uma
+# busca LATERAL ... ORDER BY data_hora DESC LIMIT 1 no índice (equipamento, data_hora),
+# limitada a [T - FROTA_MAX_IDADE, T] para o planner descartar as partições de fora:
+# o custo é O(ativos) por quadro, não depende do tamanho do histórico. Interpolando, o
+# ponto seguinte (até RESUMO_LACUNA_MAX depois) também é buscado e a posição é a reta
+# entre os dois no instante pedido.
+
+def posicoes_no_instante(cur, instante, interpolar=False, max_idade=None, equipamento=None):
+    """Lista de posições (uma por ativo com ponto na janela) no instante (datetime com fuso)"""
+    max_idade = FROTA_MAX_IDADE if max_idade is None else max_idade
+    params = {
+        'inicio': instante - timedelta(seconds=max_idade), 't': instante,
+        'lacuna': instante + timedelta(seconds=RESUMO_LACUNA_MAX), 'interpolar': interpolar,
+        'equipamento': equipamento
+    }
+    filtro = 'WHERE p.equipamento = %(equipamento)s' if equipamento else ''
+    cur.execute(f'''
+        SELECT p.equipamento, a.id, a.latitude, a.longitude, a.data_hora, a.cor,
+               d.latitude AS lat_seguinte, d.longitude AS lng_seguinte, d.data_hora AS data_hora_seguinte
+        FROM posicoes_atuais p
+        CROSS JOIN LATERAL (
+            SELECT id, latitude, longitude, data_hora, cor FROM registros r
+            WHERE r.equipamento = p.equipamento AND r.data_hora > %(inicio)s AND r.data_hora <= %(t)s
+            ORDER BY r.data_hora DESC LIMIT 1
+        ) a
+        LEFT JOIN LATERAL (
+            SELECT latitude, longitude, data_hora FROM registros r
+            WHERE %(interpolar)s AND r.equipamento = p.equipamento
+              AND r.data_hora > %(t)s AND r.data_hora <= %(lacuna)s
+            ORDER BY r.data_hora LIMIT 1
+        ) d ON true
+        {filtro}
+        ORDER BY p.equipamento
+    ''', params)
+    posicoes = []
+    for r in cur.fetchall():
+        p = {"equipamento": r['equipamento'], "registro_id": r['id'], "latitude": r['latitude'],
+             "longitude": r['longitude'], "data_hora": r['data_hora'], "cor": r['cor'],
+             "idade_s": round((instante - r['data_hora']).total_seconds(), 1), "interpolado": False}
+        seguinte = r['data_hora_seguinte']
+        if seguinte is not None and (seguinte - r['data_hora']).total_seconds() <= RESUMO_LACUNA_MAX:
+            f = (instante - r['data_hora']) / (seguinte - r['data_hora'])
+            p['latitude'] += f * (r['lat_seguinte'] - r['latitude'])
+            p['longitude'] += f * (r['lng_seguinte'] - r['longitude'])
+            p['interpolado'] = f > 0
+        posicoes.append(p)
+    return posicoes
+
+def ler_instante(cur, valor, tipo='timestamptz'):
+    """Texto do parâmetro -> timestamptz pelo Postgres (mesmas regras de fuso das outras rotas).
+    tipo='timestamp' para colunas em hora local do aparelho (checklists)."""
+    try:
+        cur.execute(f'SELECT %s::{tipo} AS t', (valor,))
+    except psycopg2.DataError:
+        cur.connection.rollback()
+        raise ValueError(f"Data inválida: {valor}")
+    return cur.fetchone()['t']
+
+@app.route('/api/frota/instante')
+def get_frota_instante():
+    """Onde cada ativo estava em t (padrão: agora). interpolar=1 posiciona entre o ponto
+    anterior e o seguinte; max_idade (s) descarta ativos sem ponto recente."""
+    interpolar = request.args.get('interpolar') in ('1', 'true')
+    max_idade = request.args.get('max_idade', type=float)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        instante = ler_instante(cur, request.args.get('t')) if request.args.get('t') else datetime.now(timezone.utc)
+    except ValueError as e:
+        cur.close()
+        conn.close()
+        return jsonify({"erro": str(e)}), 400
+    inicio = time.perf_counter()
+    posicoes = posicoes_no_instante(cur, instante, interpolar, max_idade, request.args.get('equipamento'))
+    cur.close()
+    conn.close()
+    return jsonify({"t": instante, "interpolado": interpolar, "ativos": posicoes,
+                    "ms": round((time.perf_counter() - inicio) * 1000, 2)})
+
+@app.route('/api/frota/reproducao')
+def get_frota_reproducao():
+    """Quadros de inicio a fim a cada passo (s), em streaming (?formato=ndjson: um quadro por
+    linha). O primeiro quadro traz todos os ativos; os seguintes só os que mudaram de posição
+    e, em "removidos", os que ficaram sem ponto na janela de max_idade."""
+    passo = request.args.get('passo', 60, type=float)
+    interpolar = request.args.get('interpolar') in ('1', 'true')
+    max_idade = request.args.get('max_idade', type=float)
+    equipamento = request.args.get('equipamento')
+    if not request.args.get('inicio') or not request.args.get('fim'):
+        return jsonify({"erro": "inicio e fim obrigatórios"}), 400
+    if passo <= 0:
+        return jsonify({"erro": "passo deve ser positivo"}), 400
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        inicio, fim = ler_instante(cur, request.args['inicio']), ler_instante(cur, request.args['fim'])
+    except ValueError as e:
+        return jsonify({"erro": str(e)}), 400
+    finally:
+        cur.close()
+        conn.close()
+    quadros = int((fim - inicio).total_seconds() // passo) + 1
+    if quadros < 1:
+        return jsonify({"erro": "fim antes do inicio"}), 400
+    if quadros > REPRODUCAO_MAX_QUADROS:
+        return jsonify({"erro": f"{quadros} quadros; o máximo é {REPRODUCAO_MAX_QUADROS} (aumente o passo)"}), 400
+
+    def chunks():
+        conn = get_db_connection()
+        cur = conn.cursor()
+        anteriores = {}
+        try:
+            for n in range(quadros):
+                instante = inicio + timedelta(seconds=n * passo)
+                atuais = {p['equipamento']: p for p in posicoes_no_instante(cur, instante, interpolar, max_idade, equipamento)}
+                mudaram = [p for e, p in atuais.items() if e not in anteriores or
+                           (anteriores[e]['latitude'], anteriores[e]['longitude']) != (p['latitude'], p['longitude'])]
+                yield [{"quadro": n, "t": instante, "ativos": mudaram,
+                        "removidos": [e for e in anteriores if e not in atuais]}]
+                anteriores = atuais
+        finally:
+            cur.close()
+    return stream_json(chunks(), formato_stream())
+
+# --- GEOFENCING (MOTOR DE CERCAS) ---
+# As áreas são compiladas em memória (bbox + anéis em numpy) e cada lote ingerido
+# é testado de uma vez: filtro vetorizado pelos bboxes e ponto-em-polígono só nos
+# candidatos. A versão em config_sistema ('areas_versao') avisa todos os workers
+# quando alguma geometria muda.
+
+def _dentro_aneis(px, py, aneis):
+    """Regra par-ímpar sobre todos os anéis (exterior e buracos) de uma vez"""
+    dentro = np.zeros(len(px), dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for anel in aneis:
+            xa, ya = anel[:, 0], anel[:, 1]
+            xb, yb = np.roll(xa, -1), np.roll(ya, -1)
+            for x1, y1, x2, y2 in zip(xa, ya, xb, yb):
+                cruza = ((y1 > py) != (y2 > py)) & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+                dentro ^= cruza
+    return dentro
+
+class MotorGeofence:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dados = (None, [], {}, np.empty((0, 4)), [])  # versao, ids, nomes, bboxes, aneis
+
+    @staticmethod
+    def _compilar(geometria):
+        geo = json.loads(geometria) if isinstance(geometria, str) else geometria
+        if geo.get('type') == 'Feature': geo = geo.get('geometry') or {}
+        if geo.get('type') == 'Polygon':
+            poligonos = [geo['coordinates']]
+        elif geo.get('type') == 'MultiPolygon':
+            poligonos = geo['coordinates']
+        else:
+            return []
+        return [np.array(anel, dtype=float)[:, :2] for poligono in poligonos for anel in poligono if len(anel) >= 3]
+
+    def garantir_atualizado(self, cur):
+        cur.execute("SELECT valor FROM config_sistema WHERE chave = 'areas_versao'")
+        row = cur.fetchone()
+        versao = row['valor'] if row else '0'
+        if versao == self._dados[0]: return
+        with self._lock:
+            if versao == self._dados[0]: return
+            cur.execute('SELECT id, nome, geometria FROM areas')
+            ids, nomes, bboxes, aneis = [], {}, [], []
+            for a in cur.fetchall():
+                try:
+                    compilada = self._compilar(a['geometria'])
+                except (ValueError, KeyError, TypeError):
+                    compilada = []
+                if not compilada: continue
+                pontos = np.vstack(compilada)
+                ids.append(a['id'])
+                nomes[a['id']] = a['nome']
+                bboxes.append((pontos[:, 0].min(), pontos[:, 1].min(), pontos[:, 0].max(), pontos[:, 1].max()))
+                aneis.append(compilada)
+            self._dados = (versao, ids, nomes, np.array(bboxes, dtype=float).reshape(-1, 4), aneis)
+
+    def areas_contendo(self, lats, lngs):
+        """Para cada ponto, o conjunto de ids de áreas que o contêm"""
+        _, ids, _, bboxes, aneis = self._dados
+        resultado = [set() for _ in range(len(lats))]
+        if not ids or not len(lats): return resultado
+        px, py = np.asarray(lngs, dtype=float), np.asarray(lats, dtype=float)
+        candidatos = ((px[:, None] >= bboxes[None, :, 0]) & (px[:, None] <= bboxes[None, :, 2]) &
+                      (py[:, None] >= bboxes[None, :, 1]) & (py[:, None] <= bboxes[None, :, 3]))
+        for j in np.flatnonzero(candidatos.any(axis=0)):
+            idx = np.flatnonzero(candidatos[:, j])
+            for i in idx[_dentro_aneis(px[idx], py[idx], aneis[j])]:
+                resultado[i].add(ids[j])
+        return resultado
+
+    def centro(self, area_id):
+        """Centro do bbox da área (lat, lng), ou None se ela não existir"""
+        _, ids, _, bboxes, _ = self._dados
+        if area_id not in ids: return None
+        oeste, sul, leste, norte = bboxes[ids.index(area_id)]
+        return (sul + norte) / 2, (oeste + leste) / 2
+
+    @property
+    def nomes(self):
+        return self._dados[2]
+
+motor_geofence = MotorGeofence()
+
+def marcar_areas_alteradas(cur):
+    cur.execute('''
+        INSERT INTO config_sistema (chave, valor) VALUES ('areas_versao', %s)
+        ON CONFLICT (chave) DO UPDATE SET valor = EXCLUDED.valor
+    ''', (uuid.uuid4().hex,))
+
+def avaliar_geofences(cur, inseridos):
+    """Gera eventos de entrada/saída para os pontos recém-gravados (mesmas tuplas de
+    atualizar_posicoes_atuais). Pontos mais antigos que o último avaliado do equipamento
+    (fila offline atrasada) não alteram o estado."""
+    motor_geofence.garantir_atualizado(cur)
+    if not inseridos or not motor_geofence.nomes: return
+    nomes = motor_geofence.nomes
+    dentro = motor_geofence.areas_contendo([r[2] for r in inseridos], [r[3] for r in inseridos])
+
+    cur.execute('SELECT equipamento, areas, data_hora FROM geofence_estado WHERE equipamento = ANY(%s)',
+                (list({r[1] for r in inseridos}),))
+    estado = {row['equipamento']: (set(row['areas']), row['data_hora']) for row in cur.fetchall()}
+
+    eventos, alterados = [], {}
+    for i in sorted(range(len(inseridos)), key=lambda i: (inseridos[i][4], inseridos[i][0])):
+        registro_id, equipamento, lat, lng, data_hora = inseridos[i][:5]
+        anteriores, ultimo = estado.get(equipamento, (set(), None))
+        if ultimo is not None and data_hora < ultimo: continue
+        anteriores = {a for a in anteriores if a in nomes}  # Ignora áreas apagadas
+        for area_id in dentro[i] - anteriores:
+            eventos.append((equipamento, area_id, nomes[area_id], 'entrada', registro_id, data_hora, lat, lng))
+        for area_id in anteriores - dentro[i]:
+            eventos.append((equipamento, area_id, nomes[area_id], 'saida', registro_id, data_hora, lat, lng))
+        estado[equipamento] = alterados[equipamento] = (dentro[i], data_hora)
+
+    if eventos:
+        execute_values(cur, '''
+            INSERT INTO geofence_eventos (equipamento, area_id, area_nome, tipo, registro_id, data_hora, latitude, longitude)
+            VALUES %s''', eventos)
+    if alterados:
+        execute_values(cur, '''
+            INSERT INTO geofence_estado (equipamento, areas, data_hora) VALUES %s
+            ON CONFLICT (equipamento) DO UPDATE SET areas = EXCLUDED.areas, data_hora = EXCLUDED.data_hora
+        ''', [(eq, sorted(areas), dh) for eq, (areas, dh) in alterados.items()], template='(%s, %s::integer[], %s)')
+
+@app.route('/api/geofence/eventos')
+def get_geofence_eventos():
+    # Mesmo formato de delta do /api/locais: {dados, ultimo_id, tem_mais}
+    since_id = request.args.get('since_id', 0, type=int)
+    limite = max(1, min(request.args.get('limite', 1000, type=int), LOCAIS_PAGINA_MAX))
+    condicoes, params = ['id > %s'], [since_id]
+    if request.args.get('equipamento'):
+        condicoes.append('equipamento = %s')
+        params.append(request.args['equipamento'])
+    if request.args.get('area_id'):
+        condicoes.append('area_id = %s')
+        params.append(request.args.get('area_id', type=int))
+    if request.args.get('tipo'):
+        condicoes.append('tipo = %s')
+        params.append(request.args['tipo'])
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        if request.args.get('inicio'):
+            condicoes.append('data_hora >= %s')
+            params.append(ler_instante(cur, request.args['inicio']))
+        if request.args.get('fim'):
+            condicoes.append('data_hora <= %s')
+            params.append(ler_instante(cur, request.args['fim']))
+    except ValueError as e:
+        cur.close()
+        conn.close()
+        return jsonify({"erro": str(e)}), 400
+    cur.execute(f"SELECT * FROM geofence_eventos WHERE {' AND '.join(condicoes)} ORDER BY id LIMIT %s", params + [limite + 1])
+    eventos = cur.fetchall()
+    cur.close()
+    conn.close()
+
+    tem_mais = len(eventos) > limite
+    eventos = eventos[:limite]
+    return jsonify({
+        "dados": [dict(row) for row in eventos],
+        "ultimo_id": eventos[-1]['id'] if eventos else since_id,
+        "tem_mais": tem_mais
+    })
+
+@app.route('/api/geofence/estado')
+def get_geofence_estado():
+    # Áreas em que cada equipamento está agora (pela última posição avaliada)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT g.equipamento, g.data_hora, a.id AS area_id, a.nome AS area_nome
+        FROM geofence_estado g
+        JOIN areas a ON a.id = ANY(g.areas)
+        ORDER BY g.equipamento, a.nome
+    ''')
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    resultado = {}
+    for r in rows:
+        item = resultado.setdefault(r['equipamento'], {"equipamento": r['equipamento'], "data_hora": r['data_hora'], "areas": []})
+        item['areas'].append({"id": r['area_id'], "nome": r['area_nome']})
+    return jsonify(list(resultado.values()))
+
+# --- ATIVOS PRÓXIMOS (ÍNDICE ESPACIAL) ---
+# Última posição de cada ativo numa grade de células de PROXIMOS_CELULA_GRAUS em memória
+# (por worker). A ingestão deste worker atualiza o índice na hora; o que entrou por outros
+# workers, edições e restores chegam na recarga de posicoes_atuais a cada PROXIMOS_RECARGA s.
+# Raio: só as células do bbox do círculo. k mais próximos: anéis de células a partir do
+# ponto até que nenhum ativo ainda não visto possa estar mais perto que o k-ésimo.
+# Distâncias por haversine vetorizado (numpy) sobre os candidatos.
+
+M_POR_GRAU = math.pi * RAIO_TERRA_M / 180
+
+def distancias_m(lat, lng, lats, lngs):
+    f1, f2 = math.radians(lat), np.radians(lats)
+    a = (np.sin((f2 - f1) / 2) ** 2
+         + math.cos(f1) * np.cos(f2) * np.sin(np.radians(lngs - lng) / 2) ** 2)
+    return 2 * RAIO_TERRA_M * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+class IndiceProximos:
+    def __init__(self, celula, recarga):
+        self.celula = celula
+        self.recarga = recarga
+        self._lock = threading.Lock()
+        self._ativos = {}   # equipamento -> dict da posição (latitude, longitude, data_hora, ...)
+        self._celulas = {}  # (i, j) -> set de equipamentos
+        self._carregado_em = None
+        self._pid = os.getpid()
+
+    def _chave(self, lat, lng):
+        return int(math.floor(lat / self.celula)), int(math.floor(lng / self.celula))
+
+    def _colocar(self, p):
+        # Chamado com o lock
+        anterior = self._ativos.get(p['equipamento'])
+        if anterior is not None:
+            self._celulas[anterior['celula']].discard(p['equipamento'])
+            if not self._celulas[anterior['celula']]: del self._celulas[anterior['celula']]
+        p['celula'] = self._chave(p['latitude'], p['longitude'])
+        self._ativos[p['equipamento']] = p
+        self._celulas.setdefault(p['celula'], set()).add(p['equipamento'])
+
+    def garantir_atualizado(self, cur):
+        if os.getpid() == self._pid and self._carregado_em is not None \
+                and time.monotonic() - self._carregado_em < self.recarga:
+            return
+        cur.execute('''
+            SELECT p.equipamento, p.latitude, p.longitude, p.data_hora, p.registro_id, p.cor,
+                   e.tipo_id, t.nome AS tipo
+            FROM posicoes_atuais p
+            LEFT JOIN equipamentos_cadastrados e ON e.nome = p.equipamento
+            LEFT JOIN tipos_equipamento t ON t.id = e.tipo_id
+        ''')
+        linhas = cur.fetchall()
+        with self._lock:
+            self._ativos, self._celulas = {}, {}
+            for r in linhas:
+                self._colocar(dict(r))
+            self._carregado_em = time.monotonic()
+            self._pid = os.getpid()
+
+    def atualizar(self, inseridos):
+        """Gancho da ingestão (mesmas tuplas de atualizar_posicoes_atuais)"""
+        with self._lock:
+            if self._carregado_em is None: return  # Ainda não carregado: a primeira consulta lê tudo
+            for r in inseridos:
+                atual = self._ativos.get(r[1])
+                if atual is not None and (r[4], r[0]) < (atual['data_hora'], atual['registro_id']): continue
+                self._colocar({
+                    'equipamento': r[1], 'latitude': r[2], 'longitude': r[3], 'data_hora': r[4],
+                    'registro_id': r[0], 'cor': r[7],
+                    'tipo_id': atual['tipo_id'] if atual else None, 'tipo': atual['tipo'] if atual else None
+                })
+
+    def _medir(self, lat, lng, nomes, filtro):
+        ativos = [self._ativos[n] for n in nomes]
+        if filtro: ativos = [a for a in ativos if filtro(a)]
+        if not ativos: return [], np.empty(0)
+        lats = np.fromiter((a['latitude'] for a in ativos), dtype=float, count=len(ativos))
+        lngs = np.fromiter((a['longitude'] for a in ativos), dtype=float, count=len(ativos))
+        return ativos, distancias_m(lat, lng, lats, lngs)
+
+    def no_raio(self, lat, lng, raio, filtro=None):
+        """Ativos a até `raio` metros, do mais perto ao mais longe: [(distância, posição)]"""
+        dlat = raio / M_POR_GRAU
+        dlng = raio / (M_POR_GRAU * max(math.cos(math.radians(min(89.0, abs(lat) + dlat))), 1e-3))
+        i0, j0 = self._chave(lat - dlat, lng - dlng)
+        i1, j1 = self._chave(lat + dlat, lng + dlng)
+        with self._lock:
+            if (i1 - i0 + 1) * (j1 - j0 + 1) > len(self._celulas):
+                # Círculo maior que a área ocupada: mais barato percorrer as células com gente
+                celulas = [c for c in self._celulas if i0 <= c[0] <= i1 and j0 <= c[1] <= j1]
+            else:
+                celulas = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1) if (i, j) in self._celulas]
+            ativos, dist = self._medir(lat, lng, [n for c in celulas for n in self._celulas[c]], filtro)
+        ordem = np.argsort(dist, kind='stable')
+        return [(float(dist[i]), ativos[i]) for i in ordem if dist[i] <= raio]
+
+    def mais_proximos(self, lat, lng, k, raio=None, filtro=None):
+        """Os k ativos mais perto (opcionalmente só dentro do raio): [(distância, posição)]"""
+        ci, cj = self._chave(lat, lng)
+        melhores = []
+        with self._lock:
+            total, vistos, r = len(self._ativos), 0, 0
+            while vistos < total:
+                if (2 * r + 1) ** 2 > len(self._celulas):
+                    # Já olhou mais células que as ocupadas (ativos longe ou esparsos): mede todos de uma vez
+                    nomes, melhores, r = list(self._ativos), [], None
+                elif r == 0:
+                    nomes = list(self._celulas.get((ci, cj), ()))
+                else:
+                    anel = [(ci + d, cj + e) for d in range(-r, r + 1) for e in (-r, r)]
+                    anel += [(ci + d, cj + e) for d in (-r, r) for e in range(-r + 1, r)]
+                    nomes = [n for c in anel for n in self._celulas.get(c, ())]
+                vistos += len(nomes)
+                ativos, dist = self._medir(lat, lng, nomes, filtro)
+                perto = np.argpartition(dist, k - 1)[:k] if len(dist) > k else range(len(dist))
+                melhores = sorted(melhores + [(float(dist[i]), ativos[i]) for i in perto], key=lambda m: m[0])[:k]
+                if r is None: break
+                # Quem ainda não foi visto está a pelo menos r células de distância
+                minimo = r * self.celula * M_POR_GRAU * math.cos(math.radians(min(89.0, abs(lat) + (r + 1) * self.celula)))
+                if raio is not None and minimo > raio: break
+                if len(melhores) == k and melhores[-1][0] <= minimo: break
+                r += 1
+        return [m for m in melhores if raio is None or m[0] <= raio]
+
+    def estatisticas(self):
+        with self._lock:
+            return {'ativos': len(self._ativos), 'celulas': len(self._celulas),
+                    'idade_s': round(time.monotonic() - self._carregado_em, 1) if self._carregado_em else None}
+
+indice_proximos = IndiceProximos(PROXIMOS_CELULA_GRAUS, PROXIMOS_RECARGA)
+
+@app.route('/api/proximos')
+def get_proximos():
+    """Ativos perto de um ponto (lat/lng) ou do centro de uma área (area=id):
+    raio=metros devolve todos dentro do raio; k=n os n mais próximos (com raio, só dentro dele).
+    tipo=id ou nome filtra pelo tipo do ativo."""
+    lat, lng = request.args.get('lat', type=float), request.args.get('lng', type=float)
+    area_id = request.args.get('area', type=int)
+    raio = request.args.get('raio', type=float)
+    k = request.args.get('k', type=int)
+    tipo = request.args.get('tipo')
+    if raio is None and k is None: k = 5
+    if k is not None and not 1 <= k <= PROXIMOS_K_MAX:
+        return jsonify({"erro": f"k deve estar entre 1 e {PROXIMOS_K_MAX}"}), 400
+    if raio is not None and not 0 < raio <= PROXIMOS_RAIO_MAX:
+        return jsonify({"erro": f"raio deve estar entre 0 e {PROXIMOS_RAIO_MAX:g} m"}), 400
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    if area_id is not None:
+        motor_geofence.garantir_atualizado(cur)
+        centro = motor_geofence.centro(area_id)
+        if centro is None:
+            cur.close()
+            conn.close()
+            return jsonify({"erro": "Área não encontrada"}), 404
+        lat, lng = centro
+    if lat is None or lng is None or abs(lat) > 90 or abs(lng) > 180:
+        cur.close()
+        conn.close()
+        return jsonify({"erro": "Informe lat e lng válidos ou area"}), 400
+    indice_proximos.garantir_atualizado(cur)
+    cur.close()
+    conn.close()
+
+    filtro = None
+    if tipo:
+        filtro = (lambda a: a['tipo_id'] == int(tipo)) if tipo.isdigit() else (lambda a: a['tipo'] == tipo)
+    inicio = time.perf_counter()
+    if k is None:
+        encontrados = indice_proximos.no_raio(lat, lng, raio, filtro)
+    else:
+        encontrados = indice_proximos.mais_proximos(lat, lng, k, raio, filtro)
+    ms = (time.perf_counter() - inicio) * 1000
+
+    ativos = [{
+        "equipamento": a['equipamento'], "latitude": a['latitude'], "longitude": a['longitude'],
+        "data_hora": a['data_hora'], "distancia_m": round(d, 1), "tipo": a['tipo'], "cor": a['cor']
+    } for d, a in encontrados]
+    if area_id is not None and ativos:
+        # Com area, marca quem está dentro do polígono (não só perto do centro)
+        dentro = motor_geofence.areas_contendo([a['latitude'] for a in ativos], [a['longitude'] for a in ativos])
+        for a, areas in zip(ativos, dentro):
+            a['na_area'] = area_id in areas
+    return jsonify({"centro": {"lat": lat, "lng": lng}, "raio": raio, "k": k,
+                    "ativos": ativos, "ms": round(ms, 3)})
+
+# --- CLUSTERS POR VIEWPORT ---
+# registros.geokey intercala os bits de longitude/latitude quantizadas (Z-order).
+# Cada célula da grade em qualquer nível é um intervalo contínuo de geokey, então o
+# viewport vira uma lista de intervalos e cada um é um range scan no índice.
+
+def _quantizar(valor, minimo, amplitude):
+    q = math.floor((valor - minimo) / amplitude * (1 << GEO_BITS))
+    return min(max(q, 0), (1 << GEO_BITS) - 1)
+
+def _espalhar(v):
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+def geokey(lat, lng):
+    return _espalhar(_quantizar(lng, -180, 360)) | (_espalhar(_quantizar(lat, -90, 180)) << 1)
+
+def cobertura_geokey(oeste, sul, leste, norte, nivel):
+    """Intervalos [ini, fim) de geokey que cobrem o bbox, com células de até `nivel`.
+    Células inteiramente dentro do bbox são emitidas no nível mais grosso possível."""
+    x0, x1 = _quantizar(oeste, -180, 360), _quantizar(leste, -180, 360)
+    y0, y1 = _quantizar(sul, -90, 180), _quantizar(norte, -90, 180)
+    intervalos = []
+
+    def visitar(cx, cy, n):
+        lado = 1 << (GEO_BITS - n)
+        ax, ay = cx * lado, cy * lado
+        bx, by = ax + lado - 1, ay + lado - 1
+        if bx < x0 or ax > x1 or by < y0 or ay > y1: return
+        if n == nivel or (ax >= x0 and bx <= x1 and ay >= y0 and by <= y1):
+            deslocamento = 2 * (GEO_BITS - n)
+            ini = (_espalhar(cx) | (_espalhar(cy) << 1)) << deslocamento
+            fim = ini + (1 << deslocamento)
+            if intervalos and intervalos[-1][1] == ini:
+                intervalos[-1][1] = fim  # Emenda células contíguas na curva
+            else:
+                intervalos.append([ini, fim])
+            return
+        for dy in (0, 1):  # Ordem Z: filhos saem em ordem crescente de geokey
+            for dx in (0, 1):
+                visitar(2 * cx + dx, 2 * cy + dy, n + 1)
+
+    visitar(0, 0, 0)
+    return intervalos
+
+@app.route('/api/mapa/clusters')
+def get_clusters():
+    try:
+        oeste, sul, leste, norte = [float(v) for v in request.args['bbox'].split(',')]
+    except (KeyError, ValueError):
+        return jsonify({"erro": "bbox obrigatório: oeste,sul,leste,norte"}), 400
+    oeste, leste = max(oeste, -180.0), min(leste, 180.0)
+    sul, norte = max(sul, -90.0), min(norte, 90.0)
+    zoom = request.args.get('zoom', 4, type=int)
+    nivel = min(GEO_BITS, max(0, zoom + 2))  # Célula ~1/4 de tile: ~64px na tela
+    # A cobertura usa no máximo ~64 células por eixo, mesmo se zoom e bbox não baterem
+    largura, altura = max(leste - oeste, 1e-9), max(norte - sul, 1e-9)
+    nivel_cobertura = max(0, min(nivel, int(math.log2(64 * 360 / largura)), int(math.log2(64 * 180 / altura))))
+    intervalos = cobertura_geokey(oeste, sul, leste, norte, nivel_cobertura)
+    if not intervalos: return jsonify({"modo": "clusters", "nivel": nivel, "clusters": []})
+
+    params = {
+        "ini": [i[0] for i in intervalos], "fim": [i[1] for i in intervalos],
+        "oeste": oeste, "sul": sul, "leste": leste, "norte": norte,
+        "equipamento": request.args.get('equipamento'),
+        "deslocamento": 2 * (GEO_BITS - nivel), "limite": CLUSTER_MAX_PONTOS
+    }
+    base = '''
+        FROM unnest(%(ini)s::bigint[], %(fim)s::bigint[]) AS c(ini, fim)
+        JOIN registros r ON r.geokey >= c.ini AND r.geokey < c.fim
+        WHERE r.latitude BETWEEN %(sul)s AND %(norte)s AND r.longitude BETWEEN %(oeste)s AND %(leste)s
+    ''' + (' AND r.equipamento = %(equipamento)s' if params['equipamento'] else '')
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    if zoom >= CLUSTER_ZOOM_PONTOS:
+        cur.execute(f'SELECT r.* {base} ORDER BY r.id DESC LIMIT %(limite)s', params)
+        pontos = [dict(row) for row in cur.fetchall()]
+        cur.close()
+        conn.close()
+        return jsonify({"modo": "pontos", "nivel": nivel, "pontos": pontos})
+
+    cur.execute(f'''
+        SELECT r.geokey >> %(deslocamento)s AS celula, count(*) AS qtd,
+               avg(r.latitude) AS latitude, avg(r.longitude) AS longitude,
+               max(r.data_hora) AS ultima, mode() WITHIN GROUP (ORDER BY r.cor) AS cor
+        {base}
+        GROUP BY 1
+    ''', params)
+    clusters = [dict(row) for row in cur.fetchall()]
+    cur.close()
+    conn.close()
+    return jsonify({"modo": "clusters", "nivel": nivel, "clusters": clusters})
+
+# --- EVENTOS EM TEMPO REAL (SSE) ---
+# Ingestão e checklists fazem pg_notify na mesma transação (entregue só no commit).
+# Cada worker mantém UMA conexão em LISTEN e repassa o evento, já formatado,
+# para a fila de cada painel conectado em /api/eventos.
+
+CANAL_EVENTOS = 'maprix_eventos'
+EVENTO_PAYLOAD_MAX = 7500  # NOTIFY aceita até 8000 bytes
+
+def notificar_evento(cur, tipo, dados):
+    cur.execute('SELECT pg_notify(%s, %s)', (CANAL_EVENTOS, json.dumps({"tipo": tipo, "dados": dados}, default=json_padrao)))
+
+def notificar_posicoes(cur, inseridos):
+    if not inseridos: return
+    pontos = [{
+        "id": r[0], "equipamento": r[1], "latitude": r[2], "longitude": r[3],
+        "data_hora": r[4], "sincronizado_em": r[5], "observacao": r[6], "cor": r[7]
+    } for r in inseridos]
+    dados = {"ultimo_id": max(r[0] for r in inseridos), "qtd": len(pontos), "pontos": pontos}
+    if len(json.dumps(dados, default=json_padrao)) > EVENTO_PAYLOAD_MAX:
+        # Lote grande: avisa só o cursor e o painel busca o delta em /api/locais
+        dados = {"ultimo_id": dados['ultimo_id'], "qtd": len(pontos), "truncado": True}
+    notificar_evento(cur, 'posicoes', dados)
+
+def formatar_sse(tipo, dados):
+    return f"event: {tipo}\ndata: {dados}\n\n"
+
+class CanalEventos:
+    """Listener compartilhado do worker: uma conexão LISTEN, uma fila por cliente SSE."""
+
+    RESYNC = formatar_sse('resync', '{}')
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self._lock = threading.Lock()
+        self._clientes = set()
+        self._thread = None
+        self._pid = os.getpid()
+        self.stats = {'recebidos': 0, 'entregues': 0, 'resyncs': 0, 'reconexoes': 0, 'recusados': 0}
+
+    def assinar(self):
+        with self._lock:
+            if os.getpid() != self._pid:
+                # Fork do gunicorn: a thread do processo pai não existe aqui
+                self._clientes.clear()
+                self._thread = None
+                self._pid = os.getpid()
+            if len(self._clientes) >= SSE_MAX_CLIENTES:
+                self.stats['recusados'] += 1
+                return None
+            fila = queue.Queue(maxsize=SSE_FILA_MAX)
+            self._clientes.add(fila)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._escutar, name='maprix-listen', daemon=True)
+                self._thread.start()
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._clientes.discard(fila)
+
+    def _distribuir(self, texto):
+        with self._lock:
+            clientes = list(self._clientes)
+            self.stats['recebidos'] += 1
+        for fila in clientes:
+            try:
+                fila.put_nowait(texto)
+                entregue = True
+            except queue.Full:
+                # Cliente lento: descarta o acumulado e pede para ele buscar o delta
+                with fila.mutex:
+                    fila.queue.clear()
+                fila.put_nowait(self.RESYNC)
+                entregue = False
+            with self._lock:
+                self.stats['entregues' if entregue else 'resyncs'] += 1
+
+    def _escutar(self):
+        espera = 1
+        primeira = True
+        while True:
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                conn.cursor().execute(f'LISTEN {CANAL_EVENTOS}')
+                if not primeira:
+                    # Eventos perdidos enquanto a conexão caiu: clientes refazem o delta
+                    with self._lock:
+                        self.stats['reconexoes'] += 1
+                    self._distribuir(self.RESYNC)
+                primeira, espera = False, 1
+                while True:
+                    with self._lock:
+                        if not self._clientes:
+                            # Ninguém ouvindo: libera a conexão; o próximo cliente reabre
+                            self._thread = None
+                            return
+                    if select.select([conn], [], [], SSE_PING) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        n = conn.notifies.pop(0)
+                        try:
+                            evento = json.loads(n.payload)
+                            self._distribuir(formatar_sse(evento['tipo'], json.dumps(evento['dados'])))
+                        except (ValueError, KeyError) as e:
+                            app.logger.warning(f"Evento inválido em {CANAL_EVENTOS}: {e}")
+            except Exception as e:
+                app.logger.warning(f"Listener de eventos caiu: {e}")
+                time.sleep(espera)
+                espera = min(espera * 2, 30)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+    def estatisticas(self):
+        with self._lock:
+            s = dict(self.stats)
+            clientes = len(self._clientes)
+            ativo = self._thread is not None
+        return {"clientes": clientes, "max_clientes": SSE_MAX_CLIENTES, "listener_ativo": ativo, **s}
+
+canal_eventos = CanalEventos(DATABASE_URL)
+
+@app.route('/api/eventos')
+def stream_eventos():
+    fila = canal_eventos.assinar()
+    if fila is None:
+        return jsonify({"erro": "Limite de conexões em tempo real atingido"}), 503
+
+    def gerar():
+        fim = time.monotonic() + SSE_DURACAO_MAX
+        yield 'retry: 3000\n\n'
+        while time.monotonic() < fim:
+            try:
+                yield fila.get(timeout=SSE_PING)
+            except queue.Empty:
+                yield ': ping\n\n'  # Mantém proxies abertos e detecta cliente desconectado
+
+    resp = Response(gerar(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.call_on_close(lambda: canal_eventos.cancelar(fila))
+    return resp
+
+@app.route('/api/eventos/stats')
+def status_eventos():
+    return jsonify(canal_eventos.estatisticas())
+
 # ==========================================
 # 4. API: GESTÃO (ATIVOS, TIPOS, ÁREAS, BATERIA)
 # ==========================================
 
 # --- TIPOS (COM UPLOAD CLOUDINARY) ---
+def listar_tipos():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT * FROM tipos_equipamento ORDER BY nome')
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return [dict(row) for row in rows]
+
 @app.route('/api/tipos', methods=['GET', 'POST'])
 def manage_tipos():
+    if request.method == 'GET':
+        return responder_cacheado(('tipos',), listar_tipos)
     conn = get_db_connection()
     cur = conn.cursor()
     if request.method == 'POST':
@@ -295,14 +2999,15 @@ def manage_tipos():
         # Upload para Cloudinary
         if file and allowed_file(file.filename):
             try:
-                res = cloudinary.uploader.upload(file)
+                res = upload_cloudinary(file, 'icone')
                 icone_path = res['secure_url']
             except Exception as e:
-                print(f"Erro Cloudinary: {e}")
+                app.logger.warning(f"Erro Cloudinary: {e}")
 
         try:
             cur.execute('INSERT INTO tipos_equipamento (nome, icone) VALUES (%s, %s)', (nome, icone_path))
             conn.commit()
+            cache_referencia.invalidar('tipos')
             return jsonify({"status": "sucesso"}), 201
         except psycopg2.IntegrityError:
             conn.rollback()
@@ -310,12 +3015,6 @@ def manage_tipos():
         finally:
             cur.close()
             conn.close()
-    else:
-        cur.execute('SELECT * FROM tipos_equipamento ORDER BY nome')
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        return jsonify([dict(row) for row in rows])
 
 @app.route('/api/tipos/<int:id>', methods=['DELETE'])
 def delete_tipo(id):
@@ -323,13 +3022,40 @@ def delete_tipo(id):
     cur = conn.cursor()
     cur.execute('DELETE FROM tipos_equipamento WHERE id = %s', (id,))
     conn.commit()
+    cache_referencia.invalidar('tipos', 'ativos', 'checklist_config')
     cur.close()
     conn.close()
     return jsonify({"status": "deletado"})
 
 # --- ATIVOS ---
+def listar_ativos():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    query = '''
+        SELECT e.*, t.nome as nome_tipo 
+        FROM equipamentos_cadastrados e 
+        LEFT JOIN tipos_equipamento t ON e.tipo_id = t.id 
+        ORDER BY e.nome
+    '''
+    cur.execute(query)
+    rows = cur.fetchall()
+    limites = carregar_limites_bateria(cur)
+    cur.close()
+    conn.close()
+    hoje = datetime.now()
+    lista = []
+    for r in rows:
+        item = dict(r)
+        status, cor_status = calcular_status_bateria(item['bateria_fabricacao'], limites, hoje)
+        item['status_bateria'] = status
+        item['cor_bateria'] = cor_status
+        lista.append(item)
+    return lista
+
 @app.route('/api/ativos', methods=['GET', 'POST'])
 def manage_ativos():
+    if request.method == 'GET':
+        return responder_cacheado(('ativos',), listar_ativos)
     conn = get_db_connection()
     cur = conn.cursor()
     if request.method == 'POST':
@@ -340,6 +3066,7 @@ def manage_ativos():
                 VALUES (%s, %s, %s, %s)''',
                 (d['nome'], d['tipo_id'], d['cor'], d.get('bateria_fabricacao')))
             conn.commit()
+            cache_referencia.invalidar('ativos')
             return jsonify({"status": "sucesso"}), 201
         except psycopg2.IntegrityError:
             conn.rollback()
@@ -347,25 +3074,39 @@ def manage_ativos():
         finally:
             cur.close()
             conn.close()
-    else:
-        query = '''
-            SELECT e.*, t.nome as nome_tipo 
-            FROM equipamentos_cadastrados e 
-            LEFT JOIN tipos_equipamento t ON e.tipo_id = t.id 
-            ORDER BY e.nome
-        '''
-        cur.execute(query)
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-        lista = []
-        for r in rows:
-            item = dict(r)
-            status, cor_status = calcular_status_bateria(item['bateria_fabricacao'])
-            item['status_bateria'] = status
-            item['cor_bateria'] = cor_status
-            lista.append(item)
-        return jsonify(lista)
+
+@app.route('/api/bateria/resumo')
+def resumo_bateria():
+    # Contagem por status e os ativos mais perto de vencer, sem devolver a frota inteira
+    limite = max(1, min(request.args.get('limite', 10, type=int), 100))
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT id, nome, bateria_fabricacao FROM equipamentos_cadastrados')
+    rows = cur.fetchall()
+    limites = carregar_limites_bateria(cur)
+    cur.close()
+    conn.close()
+
+    hoje = datetime.now()
+    contagem = {"verde": 0, "laranja": 0, "vermelho": 0, "cinza": 0}
+    proximos = []
+    for r in rows:
+        status, cor = calcular_status_bateria(r['bateria_fabricacao'], limites, hoje)
+        contagem[cor] += 1
+        if cor in ('verde', 'laranja'):
+            meses_uso = meses_de_uso(r['bateria_fabricacao'], hoje)
+            proximos.append({
+                "id": r['id'], "nome": r['nome'], "bateria_fabricacao": r['bateria_fabricacao'],
+                "status_bateria": status, "cor_bateria": cor,
+                "meses_uso": meses_uso, "meses_restantes": limites[1] - meses_uso
+            })
+    proximos.sort(key=lambda p: (p['meses_restantes'], p['nome']))
+    return jsonify({
+        "total": len(rows),
+        "contagem": contagem,
+        "limites": {"aviso": limites[0], "critico": limites[1]},
+        "proximos_vencimento": proximos[:limite]
+    })
 
 @app.route('/api/ativos_update/<int:id>', methods=['PUT'])
 def update_ativo(id):
@@ -379,6 +3120,7 @@ def update_ativo(id):
             WHERE id = %s
         ''', (d['nome'], d['cor'], d['bateria_fabricacao'], id))
         conn.commit()
+        cache_referencia.invalidar('ativos')
         return jsonify({"status": "sucesso"})
     except Exception as e:
         return jsonify({"erro": str(e)}), 500
@@ -392,6 +3134,7 @@ def delete_ativo(id):
     cur = conn.cursor()
     cur.execute('DELETE FROM equipamentos_cadastrados WHERE id = %s', (id,))
     conn.commit()
+    cache_referencia.invalidar('ativos')
     cur.close()
     conn.close()
     return jsonify({"status": "deletado"})
@@ -406,6 +3149,7 @@ def update_bateria_operador():
     try:
         cur.execute('UPDATE equipamentos_cadastrados SET bateria_fabricacao = %s WHERE nome = %s', (nova_data, equipamento_nome))
         conn.commit()
+        cache_referencia.invalidar('ativos')
         status, cor = calcular_status_bateria(nova_data)
         return jsonify({"status": "sucesso", "novo_status": status, "nova_cor": cor})
     except Exception as e:
@@ -414,29 +3158,35 @@ def update_bateria_operador():
         cur.close()
         conn.close()
 
+def ler_config_bateria():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT valor FROM config_sistema WHERE chave='bat_aviso'")
+        aviso = cur.fetchone()['valor']
+        cur.execute("SELECT valor FROM config_sistema WHERE chave='bat_critico'")
+        critico = cur.fetchone()['valor']
+    except:
+        aviso, critico = 48, 54
+    cur.close()
+    conn.close()
+    return {"aviso": aviso, "critico": critico}
+
 @app.route('/api/config/bateria', methods=['GET', 'POST'])
 def manage_config_bateria():
+    if request.method == 'GET':
+        return responder_cacheado(('config_bateria',), ler_config_bateria)
     conn = get_db_connection()
     cur = conn.cursor()
-    if request.method == 'POST':
-        d = request.json
-        cur.execute("UPDATE config_sistema SET valor = %s WHERE chave = 'bat_aviso'", (d['aviso'],))
-        cur.execute("UPDATE config_sistema SET valor = %s WHERE chave = 'bat_critico'", (d['critico'],))
-        conn.commit()
-        cur.close()
-        conn.close()
-        return jsonify({"status": "sucesso"})
-    else:
-        try:
-            cur.execute("SELECT valor FROM config_sistema WHERE chave='bat_aviso'")
-            aviso = cur.fetchone()['valor']
-            cur.execute("SELECT valor FROM config_sistema WHERE chave='bat_critico'")
-            critico = cur.fetchone()['valor']
-        except:
-            aviso, critico = 48, 54
-        cur.close()
-        conn.close()
-        return jsonify({"aviso": aviso, "critico": critico})
+    d = request.json
+    cur.execute("UPDATE config_sistema SET valor = %s WHERE chave = 'bat_aviso'", (d['aviso'],))
+    cur.execute("UPDATE config_sistema SET valor = %s WHERE chave = 'bat_critico'", (d['critico'],))
+    conn.commit()
+    cur.close()
+    conn.close()
+    # O status de bateria da lista de ativos depende dos limites
+    cache_referencia.invalidar('config_bateria', 'ativos')
+    return jsonify({"status": "sucesso"})
 
 # --- ÁREAS & REGIÕES ---
 @app.route('/api/salvar_area', methods=['POST'])
@@ -446,20 +3196,25 @@ def salvar_area():
     cur = conn.cursor()
     cur.execute('INSERT INTO areas (nome, geometria, cor) VALUES (%s, %s, %s)',
                  (d['nome'], json.dumps(d['geometry']), d['cor']))
+    marcar_areas_alteradas(cur)
     conn.commit()
+    cache_referencia.invalidar('areas')
     cur.close()
     conn.close()
     return jsonify({"status": "sucesso"}), 201
 
-@app.route('/api/areas', methods=['GET'])
-def get_areas():
+def listar_areas():
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT * FROM areas')
     rows = cur.fetchall()
     cur.close()
     conn.close()
-    return jsonify([{"id":r['id'], "nome":r['nome'], "geometry":json.loads(r['geometria']), "cor":r['cor']} for r in rows])
+    return [{"id":r['id'], "nome":r['nome'], "geometry":json.loads(r['geometria']), "cor":r['cor']} for r in rows]
+
+@app.route('/api/areas', methods=['GET'])
+def get_areas():
+    return responder_cacheado(('areas',), listar_areas)
 
 @app.route('/api/area/<int:id>', methods=['DELETE', 'PUT'])
 def manage_area(id):
@@ -468,16 +3223,20 @@ def manage_area(id):
     try:
         if request.method == 'DELETE':
             cur.execute('DELETE FROM areas WHERE id = %s', (id,))
+            marcar_areas_alteradas(cur)
             conn.commit()
+            cache_referencia.invalidar('areas')
             return jsonify({"status": "deletado"})
         
         elif request.method == 'PUT':
             dados = request.json
             if 'geometry' in dados:
                 cur.execute('UPDATE areas SET geometria = %s WHERE id = %s', (json.dumps(dados['geometry']), id))
+                marcar_areas_alteradas(cur)
             if 'cor' in dados:
                 cur.execute('UPDATE areas SET cor = %s WHERE id = %s', (dados['cor'], id))
             conn.commit()
+            cache_referencia.invalidar('areas')
             return jsonify({"status": "sucesso"}), 200
             
     except Exception as e:
@@ -486,23 +3245,29 @@ def manage_area(id):
         cur.close()
         conn.close()
 
+def listar_regioes():
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT * FROM regioes')
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return [dict(row) for row in rows]
+
 @app.route('/api/regioes', methods=['GET', 'POST'])
 def manage_regioes():
+    if request.method == 'GET':
+        return responder_cacheado(('regioes',), listar_regioes)
     conn = get_db_connection()
     cur = conn.cursor()
-    if request.method == 'POST':
-        d = request.json
-        cur.execute('INSERT INTO regioes (nome, latitude, longitude, zoom) VALUES (%s, %s, %s, %s)',
-                     (d['nome'], d['latitude'], d['longitude'], d['zoom']))
-        conn.commit()
-        res = {"status": "sucesso"}
-    else:
-        cur.execute('SELECT * FROM regioes')
-        rows = cur.fetchall()
-        res = [dict(row) for row in rows]
+    d = request.json
+    cur.execute('INSERT INTO regioes (nome, latitude, longitude, zoom) VALUES (%s, %s, %s, %s)',
+                 (d['nome'], d['latitude'], d['longitude'], d['zoom']))
+    conn.commit()
     cur.close()
     conn.close()
-    return jsonify(res)
+    cache_referencia.invalidar('regioes')
+    return jsonify({"status": "sucesso"})
 
 @app.route('/api/regioes/<int:id>', methods=['DELETE'])
 def delete_regiao(id):
@@ -510,6 +3275,7 @@ def delete_regiao(id):
     cur = conn.cursor()
     cur.execute('DELETE FROM regioes WHERE id = %s', (id,))
     conn.commit()
+    cache_referencia.invalidar('regioes')
     cur.close()
     conn.close()
     return jsonify({"status": "deletado"})
@@ -518,63 +3284,340 @@ def delete_regiao(id):
 # 5. IMPORTAÇÃO, EXPORTAÇÃO E BACKUP
 # ==========================================
 
+def ler_coordenada(valor, limite):
+    # Aceita vírgula decimal ("-23,55"); rejeita vazio, NaN/inf e fora da faixa
+    v = float(valor.strip().replace(',', '.'))
+    if not math.isfinite(v) or abs(v) > limite:
+        raise ValueError(f"fora da faixa: {valor}")
+    return v
+
+FORMATOS_DATA_CSV = ('%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d/%m/%Y')
+
+def ler_data_hora(valor):
+    # ISO 8601 (com ou sem fuso) ou o formato brasileiro das planilhas
+    try:
+        return datetime.fromisoformat(valor)
+    except ValueError:
+        pass
+    for formato in FORMATOS_DATA_CSV:
+        try:
+            return datetime.strptime(valor, formato)
+        except ValueError:
+            continue
+    raise ValueError(f"data_hora inválida: {valor}")
+
+def validar_linha_csv(row):
+    """Colunas: id (ignorado), equipamento, latitude, longitude, data_hora[, observacao].
+    Devolve o ponto ou levanta ValueError com o motivo."""
+    if len(row) < 5: raise ValueError("colunas insuficientes")
+    equipamento, data_hora = row[1].strip(), row[4].strip()
+    if not equipamento: raise ValueError("equipamento vazio")
+    if not data_hora: raise ValueError("data_hora vazia")
+    data_hora = ler_data_hora(data_hora)
+    try:
+        latitude = ler_coordenada(row[2], 90)
+    except ValueError as e:
+        raise ValueError(f"latitude inválida ({e})")
+    try:
+        longitude = ler_coordenada(row[3], 180)
+    except ValueError as e:
+        raise ValueError(f"longitude inválida ({e})")
+    return {'equipamento': equipamento, 'latitude': latitude, 'longitude': longitude, 'data_hora': data_hora,
+            'observacao': row[5] if len(row) > 5 else "", 'cor': '#007bff'}
+
 @app.route('/api/importar_csv', methods=['POST'])
 def importar_csv():
+    # Decodifica e valida o arquivo linha a linha; grava a cada IMPORT_CHUNK pontos
+    # válidos (memória constante). Linhas com erro vão para o relatório, não abortam.
+    # Cada lote tem a sua transação: um erro do banco rejeita só as linhas daquele lote.
     if 'file' not in request.files: return jsonify({"erro": "Sem arquivo"}), 400
     file = request.files['file']
-    stream = io.StringIO(file.stream.read().decode("UTF8"), newline=None)
-    csv_input = csv.reader(stream)
+    csv_input = csv.reader(codecs.iterdecode(file.stream, 'utf-8-sig', errors='replace'))
     next(csv_input, None)
+
+    inicio = time.perf_counter()
+    relatorio = io.StringIO()
+    rejeicoes = csv.writer(relatorio)
+    rejeicoes.writerow(['linha', 'motivo', 'conteudo'])
+    linhas = importadas = rejeitadas = lotes_com_erro = 0
+    chunk = []  # (linha, conteúdo, ponto)
+
+    def rejeitar(num, motivo, row):
+        nonlocal rejeitadas
+        rejeitadas += 1
+        if rejeitadas <= IMPORT_REJEITADAS_MAX:
+            rejeicoes.writerow([num, motivo, ','.join(row)])
+
+    def gravar(lote):
+        nonlocal importadas, lotes_com_erro
+        try:
+            inserir_registros(cur, [p for _, _, p in lote])  # Também atualiza posicoes_atuais
+            conn.commit()
+            importadas += len(lote)
+        except psycopg2.Error as e:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass  # Conexão perdida: os próximos lotes também caem aqui
+            lotes_com_erro += 1
+            motivo = f"lote não gravado ({(str(e).strip() or type(e).__name__).splitlines()[0]})"
+            for num, row, _ in lote:
+                rejeitar(num, motivo, row)
+
     conn = get_db_connection()
     cur = conn.cursor()
-    c = 0
-    for row in csv_input:
-        if len(row) >= 5:
-            cur.execute('INSERT INTO registros (equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor) VALUES (%s,%s,%s,%s,%s,%s,%s)',
-                         (row[1], float(row[2]), float(row[3]), row[4], datetime.now().isoformat(), row[5] if len(row)>5 else "", '#007bff'))
-            c += 1
-    conn.commit()
+    for num, row in enumerate(csv_input, start=2):
+        if not any(c.strip() for c in row): continue
+        linhas += 1
+        try:
+            chunk.append((num, row, validar_linha_csv(row)))
+        except ValueError as e:
+            rejeitar(num, str(e), row)
+            continue
+        if len(chunk) >= IMPORT_CHUNK:
+            gravar(chunk)
+            chunk = []
+    if chunk:
+        gravar(chunk)
+
+    segundos = time.perf_counter() - inicio
+    importacao_id = uuid.uuid4().hex
+    resposta = {
+        "status": "parcial" if lotes_com_erro else "sucesso",
+        "importacao_id": importacao_id,
+        "linhas": linhas,
+        "importados": importadas,
+        "rejeitados": rejeitadas,
+        "lotes_com_erro": lotes_com_erro,
+        "segundos": round(segundos, 3),
+        "linhas_por_seg": round(linhas / segundos, 1) if segundos else None,
+        "relatorio": f"/api/importar_csv/{importacao_id}/rejeitados" if rejeitadas else None
+    }
+    try:
+        cur.execute('''
+            INSERT INTO importacoes (id, arquivo, data_hora, linhas, importadas, rejeitadas, segundos, relatorio)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ''', (importacao_id, secure_filename(file.filename or ''), datetime.now(timezone.utc), linhas, importadas,
+              rejeitadas, round(segundos, 3), relatorio.getvalue() if rejeitadas else None))
+        conn.commit()
+    except psycopg2.Error:
+        # Sem banco para guardar o relatório: ele vai na própria resposta
+        resposta.update({"importacao_id": None, "relatorio": None, "relatorio_csv": relatorio.getvalue()})
     cur.close()
     conn.close()
-    return jsonify({"status": "sucesso", "importados": c}), 201
+    return jsonify(resposta), 201
+
+@app.route('/api/importar_csv/<importacao_id>/rejeitados')
+def relatorio_importacao(importacao_id):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute('SELECT relatorio FROM importacoes WHERE id = %s', (importacao_id,))
+    row = cur.fetchone()
+    cur.close()
+    conn.close()
+    if not row or not row['relatorio']: return jsonify({"erro": "Relatório não encontrado"}), 404
+    return Response(row['relatorio'], mimetype='text/csv',
+                    headers={"Content-Disposition": f"attachment; filename=rejeitadas_{importacao_id}.csv"})
+
+# --- BACKUP E RESTORE ---
+# Formato 3.0: NDJSON comprimido com gzip, escrito e lido em streaming.
+#   {"metadata": {...}}
+#   {"tabela": "registros", "colunas": ["id", "equipamento", ...]}
+#   [1, "CAM-01", ...]        <- uma linha por registro, na ordem das colunas
+# A restauração faz COPY de lotes em tabelas temporárias e mescla com INSERT ... SELECT.
+# O formato JSON 2.0 continua aceito (e gerado com ?formato=json).
+
+# Ordem respeita as chaves estrangeiras
+TABELAS_BACKUP = [
+    'config_sistema', 'tipos_equipamento', 'equipamentos_cadastrados',
+    'regioes', 'areas', 'registros', 'checklist_perguntas',
+    'checklist_realizados', 'checklist_itens'
+]
+
+def colunas_gravaveis(cur, tabela):
+    # Colunas reais da tabela, sem as geradas (ex.: registros.geokey)
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER'
+        ORDER BY ordinal_position
+    """, (tabela,))
+    return [r['column_name'] for r in cur.fetchall()]
 
-# --- BACKUP E RESTORE (JSON COMPLETO E ROBUSTO) ---
+def gerar_tabela_ndjson(conn, tabela, colunas, origem=None):
+    """Cabeçalho da tabela e suas linhas no formato 3.0 (origem: tabela/partição lida)"""
+    yield json.dumps({"tabela": tabela, "colunas": colunas}) + '\n'
+    sql = f"SELECT {', '.join(colunas)} FROM {origem or tabela} ORDER BY 1"
+    for linhas in ler_em_chunks(conn, sql):
+        yield ''.join(json.dumps([l[c] for c in colunas], default=json_padrao) + '\n' for l in linhas)
+
+def gerar_backup_ndjson(conn):
+    cur = conn.cursor()
+    yield json.dumps({"metadata": {"versao": "3.0", "formato": "ndjson", "data": datetime.now().isoformat(),
+                                   "tabelas": TABELAS_BACKUP}}) + '\n'
+    for tabela in TABELAS_BACKUP:
+        yield from gerar_tabela_ndjson(conn, tabela, colunas_gravaveis(cur, tabela))
+    cur.close()
 
 @app.route('/api/backup_dados')
 def backup_dados():
-    try:
+    data = datetime.now().strftime('%Y-%m-%d_%Hh%M')
+
+    if request.args.get('formato') == 'json':
+        # Documento JSON 2.0 (formato antigo), escrito tabela a tabela em chunks
+        def gerar():
+            conn = get_db_connection()
+            yield '{"metadata": ' + json.dumps({"versao": "2.0", "data": datetime.now().isoformat()})
+            for tabela in TABELAS_BACKUP:
+                yield f', "{tabela}": '
+                yield from array_json(ler_em_chunks(conn, f"SELECT * FROM {tabela}"))
+            yield '}'
+        return Response(stream_with_context(gerar()), mimetype='application/json',
+                        headers={"Content-Disposition": f"attachment; filename=Maprix_FullBackup_{data}.json"})
+
+    def gerar_gzip():
         conn = get_db_connection()
-        cur = conn.cursor()
-        
-        dados = {
-            "metadata": {
-                "versao": "2.0",
-                "data": datetime.now().isoformat()
-            }
-        }
-        
-        tabelas = [
-            'config_sistema', 'tipos_equipamento', 'equipamentos_cadastrados',
-            'regioes', 'areas', 'registros', 'checklist_perguntas',
-            'checklist_realizados', 'checklist_itens'
-        ]
-        
-        for tabela in tabelas:
-            cur.execute(f"SELECT * FROM {tabela}")
-            dados[tabela] = [dict(row) for row in cur.fetchall()]
-        
-        cur.close()
-        conn.close()
-        
-        str_io = io.BytesIO()
-        str_io.write(json.dumps(dados, indent=4, default=str).encode('utf-8'))
-        str_io.seek(0)
-        
-        nome_arquivo = f"Maprix_FullBackup_{datetime.now().strftime('%Y-%m-%d_%Hh%M')}.json"
-        
-        return send_file(str_io, mimetype='application/json', as_attachment=True, download_name=nome_arquivo)
-    except Exception as e:
-        return jsonify({"erro": str(e)}), 500
+        z = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = cabeçalho gzip
+        for parte in gerar_backup_ndjson(conn):
+            comprimido = z.compress(parte.encode('utf-8'))
+            if comprimido: yield comprimido
+        yield z.flush()
+
+    return Response(stream_with_context(gerar_gzip()), mimetype='application/gzip',
+                    headers={"Content-Disposition": f"attachment; filename=Maprix_FullBackup_{data}.ndjson.gz"})
+
+def ler_backup_ndjson(arquivo):
+    """Lotes (tabela, colunas, linhas) de um backup 3.0, descomprimido sob demanda"""
+    texto = io.TextIOWrapper(gzip.GzipFile(fileobj=arquivo, mode='rb'), encoding='utf-8')
+    tabela, colunas, lote = None, None, []
+    for linha in texto:
+        if not linha.strip(): continue
+        obj = json.loads(linha)
+        if isinstance(obj, list):
+            lote.append(obj)
+            if len(lote) >= RESTORE_LOTE:
+                yield tabela, colunas, lote
+                lote = []
+        elif 'tabela' in obj:
+            if lote: yield tabela, colunas, lote
+            tabela, colunas, lote = obj['tabela'], obj['colunas'], []
+    if lote: yield tabela, colunas, lote
+
+def ler_backup_json(arquivo):
+    """Backups 2.0 (um único documento JSON): convertidos para os mesmos lotes"""
+    dados = json.load(arquivo)
+    for tabela in TABELAS_BACKUP:
+        registros = dados.get(tabela) or []
+        if not registros: continue
+        colunas = list(registros[0].keys())
+        for i in range(0, len(registros), RESTORE_LOTE):
+            yield tabela, colunas, [[r.get(c) for c in colunas] for r in registros[i:i + RESTORE_LOTE]]
+
+def em_paralelo(lotes, fila_max=4):
+    """Descomprime/decodifica o arquivo em outra thread enquanto o banco grava o lote
+    anterior. A fila limitada mantém no máximo `fila_max` lotes em memória."""
+    fila = queue.Queue(maxsize=fila_max)
+    parar = threading.Event()
+    FIM = object()
+
+    def entregar(item):
+        # Desiste se o consumidor já parou (erro na gravação)
+        while not parar.is_set():
+            try:
+                fila.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def produzir():
+        try:
+            for item in itertools.chain(lotes, [FIM]):
+                entregar(item)
+        except Exception as e:
+            entregar(e)
+
+    threading.Thread(target=produzir, name='maprix-restore', daemon=True).start()
+    try:
+        while True:
+            item = fila.get()
+            if item is FIM: return
+            if isinstance(item, Exception): raise item
+            yield item
+    finally:
+        parar.set()
+
+def valor_copy(v):
+    # Formato texto do COPY: \N é NULL; barra, tab e quebras de linha escapadas
+    if v is None: return '\\N'
+    if isinstance(v, (dict, list)): v = json.dumps(v)
+    return str(v).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+# Backups 2.0 vêm do schema antigo, com datas em texto livre: convertidas como na migração 8
+# (texto sem fuso lido em MIGRACAO_FUSO; ilegível cai para sincronizado_em e, por fim, 'epoch').
+# Cada regra recebe as colunas do arquivo e devolve (expressões por coluna, coluna conferida, função).
+def _datas_registros(colunas):
+    alternativa = 'maprix_ts(sincronizado_em), ' if 'sincronizado_em' in colunas else ''
+    return {'data_hora': f"coalesce(maprix_ts(data_hora), {alternativa}'epoch')",
+            'sincronizado_em': 'maprix_ts(sincronizado_em)'}, 'maprix_ts'
+
+def _datas_checklists(colunas):
+    # Hora local do aparelho: timestamp sem fuso
+    return {'data_hora': "coalesce(maprix_ts_local(data_hora), 'epoch')"}, 'maprix_ts_local'
+
+DATAS_LEGADO = {'registros': _datas_registros, 'checklist_realizados': _datas_checklists}
+
+def copiar_legado(cur, tabela, staging, colunas, buf):
+    """COPY do lote 2.0 numa staging só de texto e conversão para a staging tipada.
+    Devolve quantas linhas tiveram a data ilegível (gravadas com a alternativa)."""
+    texto = f"{staging}_texto"
+    cur.execute(f"DROP TABLE IF EXISTS {texto}")
+    cur.execute(f"CREATE TEMP TABLE {texto} ({', '.join(f'{c} TEXT' for c in colunas)}) ON COMMIT DROP")
+    cur.copy_expert(f"COPY {texto} ({', '.join(colunas)}) FROM STDIN", buf)
+    cur.execute("""
+        SELECT attname, format_type(atttypid, atttypmod) AS tipo FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+    """, (staging,))
+    tipos = {r['attname']: r['tipo'] for r in cur.fetchall()}
+    regras, funcao = DATAS_LEGADO[tabela](colunas)
+    expressoes = [regras.get(c, f"{c}::{tipos[c]}") for c in colunas]
+    cur.execute(f"INSERT INTO {staging} ({', '.join(colunas)}) SELECT {', '.join(expressoes)} FROM {texto}")
+    if 'data_hora' not in colunas: return 0
+    cur.execute(f"SELECT count(*) AS n FROM {texto} WHERE {funcao}(data_hora) IS NULL")
+    return cur.fetchone()['n']
+
+def mesclar_lote(cur, tabela, colunas, linhas, destino, legado=False, contagem=None):
+    """COPY do lote na staging da tabela e INSERT ... SELECT com as regras de mescla.
+    legado: lote de backup 2.0 (datas convertidas; as ilegíveis somadas em contagem['datas_corrigidas'])"""
+    staging = f"restore_{tabela}"
+    cur.execute(f"CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {tabela}) ON COMMIT DROP")
+    cur.execute(f"TRUNCATE {staging}")
+    buf = io.StringIO(''.join('\t'.join(valor_copy(v) for v in l) + '\n' for l in linhas))
+    if legado and tabela in DATAS_LEGADO:
+        corrigidas = copiar_legado(cur, tabela, staging, colunas, buf)
+        if contagem is not None:
+            contagem['datas_corrigidas'] = contagem.get('datas_corrigidas', 0) + corrigidas
+    else:
+        cur.copy_expert(f"COPY {staging} ({', '.join(colunas)}) FROM STDIN", buf)
+
+    cols = ', '.join(c for c in colunas if c in destino)
+    if tabela == 'config_sistema':
+        cur.execute(f"INSERT INTO config_sistema ({cols}) SELECT DISTINCT ON (chave) {cols} FROM {staging} "
+                    f"ON CONFLICT (chave) DO UPDATE SET valor = EXCLUDED.valor")
+    elif tabela == 'checklist_itens':
+        # Ignora item se o checklist pai não existir (semi-join do lote inteiro)
+        cur.execute(f"INSERT INTO checklist_itens ({cols}) SELECT {cols} FROM {staging} s "
+                    f"WHERE EXISTS (SELECT 1 FROM checklist_realizados c WHERE c.id = s.checklist_id) "
+                    f"ON CONFLICT DO NOTHING")
+    else:
+        cur.execute(f"INSERT INTO {tabela} ({cols}) SELECT {cols} FROM {staging} ON CONFLICT DO NOTHING")
+    gravadas = cur.rowcount
+    if tabela == 'registros':
+        # Dias tocados pelo lote são refeitos no resumo diário
+        cur.execute(f'''
+            INSERT INTO resumo_diario (equipamento, dia, recalcular)
+            SELECT DISTINCT equipamento, (data_hora AT TIME ZONE %s)::date, true FROM {staging}
+            ON CONFLICT (equipamento, dia) DO UPDATE SET recalcular = true
+        ''', (RESUMO_FUSO,))
+    return gravadas
 
 @app.route('/api/restaurar_dados', methods=['POST'])
 def restaurar_dados():
@@ -582,79 +3625,391 @@ def restaurar_dados():
     file = request.files['file']
     
     try:
-        dados = json.load(file)
+        inicio = time.perf_counter()
+        comprimido = file.stream.read(2) == b'\x1f\x8b'
+        file.stream.seek(0)
+        lotes = ler_backup_ndjson(file.stream) if comprimido else ler_backup_json(file.stream)
+
         conn = get_db_connection()
         cur = conn.cursor()
-        
-        if 'config_sistema' in dados:
-            for c in dados['config_sistema']:
-                cur.execute("INSERT INTO config_sistema (chave, valor) VALUES (%s, %s) ON CONFLICT (chave) DO UPDATE SET valor = EXCLUDED.valor", (c['chave'], c['valor']))
-
-        if 'tipos_equipamento' in dados:
-            for t in dados['tipos_equipamento']:
-                cur.execute("INSERT INTO tipos_equipamento (id, nome, icone) VALUES (%s, %s, %s) ON CONFLICT (id) DO NOTHING", (t['id'], t['nome'], t['icone']))
-
-        if 'regioes' in dados:
-            for r in dados['regioes']:
-                cur.execute("INSERT INTO regioes (id, nome, latitude, longitude, zoom) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (id) DO NOTHING", (r['id'], r['nome'], r['latitude'], r['longitude'], r['zoom']))
-
-        if 'areas' in dados:
-            for a in dados['areas']:
-                cur.execute("INSERT INTO areas (id, nome, geometria, cor) VALUES (%s, %s, %s, %s) ON CONFLICT (id) DO NOTHING", (a['id'], a['nome'], a['geometria'], a['cor']))
-
-        if 'equipamentos_cadastrados' in dados:
-            for e in dados['equipamentos_cadastrados']:
-                cur.execute("INSERT INTO equipamentos_cadastrados (id, nome, tipo_id, cor_padrao, bateria_fabricacao) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (id) DO NOTHING", 
-                            (e['id'], e['nome'], e['tipo_id'], e['cor_padrao'], e['bateria_fabricacao']))
-
-        if 'registros' in dados:
-            for r in dados['registros']:
-                cur.execute("INSERT INTO registros (id, equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor) VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (id) DO NOTHING", 
-                            (r['id'], r['equipamento'], r['latitude'], r['longitude'], r['data_hora'], r['sincronizado_em'], r['observacao'], r['cor']))
-
-        if 'checklist_perguntas' in dados:
-            for p in dados['checklist_perguntas']:
-                cur.execute("INSERT INTO checklist_perguntas (id, tipo_id, texto) VALUES (%s, %s, %s) ON CONFLICT (id) DO NOTHING", (p['id'], p['tipo_id'], p['texto']))
-
-        if 'checklist_realizados' in dados:
-            for c in dados['checklist_realizados']:
-                cur.execute("INSERT INTO checklist_realizados (id, equipamento, operador, data_hora) VALUES (%s, %s, %s, %s) ON CONFLICT (id) DO NOTHING", 
-                            (c['id'], c['equipamento'], c['operador'], c['data_hora']))
-
-        if 'checklist_itens' in dados:
-            for i in dados['checklist_itens']:
-                # INSERT SEGURO: Ignora item se o checklist pai não existir
-                cur.execute("""
-                    INSERT INTO checklist_itens (id, checklist_id, pergunta, conforme, observacao, foto_path)
-                    SELECT %s, %s, %s, %s, %s, %s
-                    WHERE EXISTS (SELECT 1 FROM checklist_realizados WHERE id = %s)
-                    ON CONFLICT (id) DO NOTHING
-                """, (i['id'], i['checklist_id'], i['pergunta'], i['conforme'], i['observacao'], i['foto_path'], i['checklist_id']))
+        if not comprimido:
+            # Datas sem fuso dos backups 2.0: mesmo fuso da migração 8 (só nesta transação)
+            cur.execute("SELECT set_config('TimeZone', %s, true)", (MIGRACAO_FUSO,))
+        destinos = {t: set(colunas_gravaveis(cur, t)) for t in TABELAS_BACKUP}
+        resumo = {}
+        for tabela, colunas, linhas in em_paralelo(lotes):
+            # Nomes vêm do arquivo: só tabelas conhecidas e colunas que existem
+            if tabela not in destinos: continue
+            uteis = [i for i, c in enumerate(colunas) if c in destinos[tabela]]
+            if len(uteis) != len(colunas):
+                colunas = [colunas[i] for i in uteis]
+                linhas = [[l[i] for i in uteis] for l in linhas]
+            r = resumo.setdefault(tabela, {"lidas": 0, "gravadas": 0})
+            gravadas = mesclar_lote(cur, tabela, colunas, linhas, destinos[tabela], legado=not comprimido, contagem=r)
+            r['lidas'] += len(linhas)
+            r['gravadas'] += gravadas
+
+        recalcular_posicao_atual(cur)
+        marcar_areas_alteradas(cur)
 
         conn.commit()
         cur.close()
         conn.close()
+        cache_referencia.invalidar()
         
         reset_sequences()
         
-        return jsonify({"status": "sucesso", "mensagem": "Backup restaurado com sucesso! (Itens órfãos ignorados)"}), 200
+        return jsonify({
+            "status": "sucesso",
+            "mensagem": "Backup restaurado com sucesso! (Itens órfãos ignorados)",
+            "tabelas": resumo,
+            "segundos": round(time.perf_counter() - inicio, 3)
+        }), 200
     except Exception as e:
         if 'conn' in locals() and conn: conn.rollback()
         return jsonify({"erro": str(e)}), 500
 
+# --- PARTIÇÕES MENSAIS E ARQUIVO DO HISTÓRICO ---
+# registros é particionada por mês (UTC): registros_AAAA_MM, mais registros_default para
+# datas sem partição. Consultas com filtro de data só leem os meses do intervalo.
+# Meses além da retenção viram arquivos NDJSON gzip (mesmo formato do backup 3.0) em
+# ARQUIVO_DIR e saem do banco; podem ser consultados direto do arquivo ou reanexados.
+
+COLUNAS_REGISTROS = ['id', 'equipamento', 'latitude', 'longitude', 'data_hora', 'sincronizado_em', 'observacao', 'cor', 'ponto_uid']
+PARTICAO_LOCK = MIGRACAO_LOCK + 1  # Serializa criação/arquivamento de partições entre workers
+
+_particoes_verificadas = None  # Mês já garantido neste worker
+
+def inicio_mes(d):
+    return date(d.year, d.month, 1)
+
+def somar_meses(mes, n):
+    anos, m = divmod(mes.month - 1 + n, 12)
+    return date(mes.year + anos, m + 1, 1)
+
+def ler_mes(texto):
+    """'AAAA-MM' -> date do primeiro dia (ValueError se inválido)"""
+    return datetime.strptime(str(texto or ''), '%Y-%m').date()
+
+def nome_particao(mes):
+    return f"registros_{mes:%Y_%m}"
+
+def criar_particao(cur, mes):
+    """Cria a partição do mês se faltar. Linhas desse mês que estavam na partição
+    default são movidas para ela (senão o CREATE falha). Devolve se criou."""
+    nome = nome_particao(mes)
+    cur.execute('SELECT to_regclass(%s) IS NOT NULL AS existe', (nome,))
+    if cur.fetchone()['existe']: return False
+    limites = (f"{mes:%Y-%m-%d} 00:00+00", f"{somar_meses(mes, 1):%Y-%m-%d} 00:00+00")
+    cols = ', '.join(COLUNAS_REGISTROS)
+    cur.execute('SELECT EXISTS (SELECT 1 FROM registros_default WHERE data_hora >= %s AND data_hora < %s) AS tem', limites)
+    mover = cur.fetchone()['tem']
+    if mover:
+        cur.execute(f'''
+            CREATE TEMP TABLE IF NOT EXISTS mover_particao ON COMMIT DROP AS
+                SELECT {cols} FROM registros_default WITH NO DATA;
+            TRUNCATE mover_particao;
+            WITH movidas AS (
+                DELETE FROM registros_default WHERE data_hora >= %s AND data_hora < %s RETURNING {cols}
+            ) INSERT INTO mover_particao SELECT * FROM movidas;
+        ''', limites)
+    cur.execute(f'CREATE TABLE {nome} PARTITION OF registros FOR VALUES FROM (%s) TO (%s)', limites)
+    if mover:
+        cur.execute(f'INSERT INTO registros ({cols}) SELECT {cols} FROM mover_particao')
+    return True
+
+def garantir_particoes(cur, forcar=False):
+    """Partições do mês corrente e das PARTICOES_A_FRENTE seguintes. Chamada a cada
+    ingestão, mas só consulta o banco uma vez por mês em cada worker."""
+    global _particoes_verificadas
+    atual = inicio_mes(datetime.now(timezone.utc))
+    if not forcar and _particoes_verificadas == atual: return []
+    cur.execute("SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('registros')) AS ok")
+    if not cur.fetchone()['ok']: return []  # Migração 9 ainda não aplicada
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', (PARTICAO_LOCK,))
+    criadas = [nome_particao(m) for m in (somar_meses(atual, i) for i in range(PARTICOES_A_FRENTE + 1))
+               if criar_particao(cur, m)]
+    _particoes_verificadas = atual
+    return criadas
+
+def listar_particoes(cur):
+    cur.execute('''
+        SELECT c.relname AS nome, GREATEST(c.reltuples, 0)::bigint AS linhas_estimadas,
+               pg_total_relation_size(c.oid) AS bytes
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('registros')
+        ORDER BY c.relname
+    ''')
+    particoes = []
+    for r in cur.fetchall():
+        try:
+            mes = datetime.strptime(r['nome'], 'registros_%Y_%m').date()
+        except ValueError:
+            mes = None  # registros_default
+        particoes.append({**r, "mes": mes})
+    return particoes
+
+def caminho_arquivo(mes):
+    return os.path.join(ARQUIVO_DIR, f"{nome_particao(mes)}.ndjson.gz")
+
+def arquivar_particao(conn, mes):
+    """Exporta a partição do mês para ARQUIVO_DIR e a remove do banco, numa transação.
+    O arquivo é gravado (e sincronizado no disco) antes do DROP."""
+    nome, caminho = nome_particao(mes), caminho_arquivo(mes)
+    temporario = caminho + '.tmp'
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (PARTICAO_LOCK,))
+        # Leitura continua liberada; escrita no mês espera até o DROP
+        cur.execute(f'LOCK TABLE {nome} IN EXCLUSIVE MODE')
+        os.makedirs(ARQUIVO_DIR, exist_ok=True)
+        linhas = -1  # Desconta a linha de cabeçalho da tabela
+        with open(temporario, 'wb') as bruto:
+            with gzip.GzipFile(fileobj=bruto, mode='wb') as gz:
+                gz.write((json.dumps({"metadata": {"versao": "3.0", "formato": "ndjson", "data": datetime.now().isoformat(),
+                                                   "tabelas": ["registros"], "mes": f"{mes:%Y-%m}"}}) + '\n').encode('utf-8'))
+                for parte in gerar_tabela_ndjson(conn, 'registros', COLUNAS_REGISTROS, origem=nome):
+                    gz.write(parte.encode('utf-8'))
+                    linhas += parte.count('\n')
+            bruto.flush()
+            os.fsync(bruto.fileno())
+        os.replace(temporario, caminho)
+        tamanho = os.path.getsize(caminho)
+        cur.execute(f'ALTER TABLE registros DETACH PARTITION {nome}')
+        cur.execute(f'DROP TABLE {nome}')
+        cur.execute('''
+            INSERT INTO registros_arquivo (mes, arquivo, linhas, bytes) VALUES (%s, %s, %s, %s)
+            ON CONFLICT (mes) DO UPDATE SET arquivo = EXCLUDED.arquivo, linhas = EXCLUDED.linhas,
+                bytes = EXCLUDED.bytes, arquivado_em = now(), reanexado_em = NULL
+        ''', (mes, os.path.basename(caminho), linhas, tamanho))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        if os.path.exists(temporario): os.remove(temporario)
+        raise
+    finally:
+        cur.close()
+    return {"mes": f"{mes:%Y-%m}", "arquivo": caminho, "linhas": linhas, "bytes": tamanho}
+
+def arquivar_particoes(meses):
+    """Arquiva as partições com mais de `meses` meses (o mês corrente não conta)"""
+    limite = somar_meses(inicio_mes(datetime.now(timezone.utc)), -meses)
+    conn = get_db_connection()
+    cur = conn.cursor()
+    antigas = [p['mes'] for p in listar_particoes(cur) if p['mes'] and p['mes'] < limite]
+    conn.commit()
+    cur.close()
+    return [arquivar_particao(conn, mes) for mes in antigas]
+
+def reanexar_particao(conn, mes):
+    """Recria a partição do mês e carrega o arquivo nela (COPY em lotes, como o restore)"""
+    caminho = caminho_arquivo(mes)
+    if not os.path.exists(caminho):
+        raise FileNotFoundError(f"Arquivo de {mes:%Y-%m} não encontrado em {ARQUIVO_DIR}")
+    cur = conn.cursor()
+    try:
+        cur.execute('SELECT pg_advisory_xact_lock(%s)', (PARTICAO_LOCK,))
+        criar_particao(cur, mes)
+        destino = set(COLUNAS_REGISTROS)
+        lidas = gravadas = 0
+        with open(caminho, 'rb') as f:
+            for tabela, colunas, linhas in em_paralelo(ler_backup_ndjson(f)):
+                if tabela != 'registros' or not set(colunas) <= destino: continue
+                gravadas += mesclar_lote(cur, 'registros', colunas, linhas, destino)
+                lidas += len(linhas)
+        cur.execute('UPDATE registros_arquivo SET reanexado_em = now() WHERE mes = %s', (mes,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return {"mes": f"{mes:%Y-%m}", "lidas": lidas, "gravadas": gravadas}
+
+def ler_arquivo(mes, equipamento=None, inicio=None, fim=None):
+    """Linhas de um mês arquivado, lidas do arquivo sem voltar ao banco (chunks de dicts)"""
+    with open(caminho_arquivo(mes), 'rb') as f:
+        for _, colunas, linhas in ler_backup_ndjson(f):
+            dados = []
+            for l in linhas:
+                r = dict(zip(colunas, l))
+                if equipamento and r['equipamento'] != equipamento: continue
+                if inicio or fim:
+                    dh = datetime.fromisoformat(r['data_hora'])
+                    if (inicio and dh < inicio) or (fim and dh > fim): continue
+                dados.append(r)
+            if dados: yield dados
+
+@app.route('/api/particoes')
+def get_particoes():
+    try:
+        conn = get_db_connection()
+        cur = conn.cursor()
+        particoes = listar_particoes(cur)
+        cur.execute("SELECT to_regclass('registros_arquivo') IS NOT NULL AS existe")
+        arquivados = []
+        if cur.fetchone()['existe']:
+            cur.execute('SELECT * FROM registros_arquivo ORDER BY mes')
+            arquivados = cur.fetchall()
+        cur.close()
+        conn.close()
+        return jsonify({"particoes": particoes, "arquivados": arquivados, "retencao_meses": RETENCAO_MESES})
+    except Exception as e:
+        return jsonify({"erro": str(e)}), 500
+
+@app.route('/api/particoes/reanexar', methods=['POST'])
+def post_reanexar_particao():
+    try:
+        mes = ler_mes((request.json or {}).get('mes'))
+    except ValueError:
+        return jsonify({"erro": "Informe mes no formato AAAA-MM"}), 400
+    try:
+        resultado = reanexar_particao(get_db_connection(), mes)
+        return jsonify({"status": "sucesso", **resultado})
+    except FileNotFoundError as e:
+        return jsonify({"erro": str(e)}), 404
+    except Exception as e:
+        return jsonify({"erro": str(e)}), 500
+
+@app.route('/api/arquivo/registros')
+def consultar_arquivo():
+    """?mes=AAAA-MM[&equipamento=][&inicio=][&fim=]: pontos de um mês arquivado"""
+    try:
+        mes = ler_mes(request.args.get('mes'))
+        # Datas sem fuso são lidas em UTC (o arquivo guarda timestamptz)
+        inicio, fim = (ler_data_hora(request.args[k]) if request.args.get(k) else None for k in ('inicio', 'fim'))
+        inicio, fim = (d.replace(tzinfo=timezone.utc) if d and d.tzinfo is None else d for d in (inicio, fim))
+    except (ValueError, TypeError):
+        return jsonify({"erro": "Parâmetros inválidos (mes=AAAA-MM, inicio/fim em ISO 8601)"}), 400
+    if not os.path.exists(caminho_arquivo(mes)):
+        return jsonify({"erro": f"Mês {mes:%Y-%m} não está arquivado"}), 404
+    return stream_json(ler_arquivo(mes, request.args.get('equipamento'), inicio, fim), formato_stream())
+
+@app.cli.group('particoes')
+def comando_particoes():
+    """Partições mensais do histórico de posições (registros)."""
+
+@comando_particoes.command('manter')
+@click.option('--meses', type=int, default=None, help='Arquiva partições com mais de N meses (padrão: RETENCAO_MESES).')
+def comando_manter_particoes(meses):
+    """Cria as partições dos próximos meses e arquiva as antigas (rodar diariamente)."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    criadas = garantir_particoes(cur, forcar=True)
+    conn.commit()
+    cur.close()
+    for nome in criadas:
+        click.echo(f"Criada {nome}")
+    meses = RETENCAO_MESES if meses is None else meses
+    if meses > 0:
+        for r in arquivar_particoes(meses):
+            click.echo(f"Arquivado {r['mes']}: {r['linhas']} linhas, {r['bytes']} bytes -> {r['arquivo']}")
+
+@comando_particoes.command('reanexar')
+@click.argument('mes')
+def comando_reanexar_particao(mes):
+    """Carrega de volta no banco um mês arquivado (AAAA-MM)."""
+    r = reanexar_particao(get_db_connection(), ler_mes(mes))
+    click.echo(f"Reanexado {r['mes']}: {r['gravadas']} de {r['lidas']} linhas")
+
+@comando_particoes.command('listar')
+def comando_listar_particoes():
+    """Lista as partições no banco."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    for p in listar_particoes(cur):
+        click.echo(f"{p['nome']:<22} ~{p['linhas_estimadas']:>12} linhas {p['bytes'] / 1048576:>10.1f} MB")
+    cur.close()
+
 # ==========================================
 # GESTÃO DE CHECKLIST (ADMIN & OPERADOR)
 # ==========================================
 
-@app.route('/api/checklist/config/<int:tipo_id>', methods=['GET'])
-def get_checklist_config(tipo_id):
+# --- UPLOAD DE FOTOS ---
+# Cada foto vira uma tarefa no pool de threads (por worker). A requisição só pega
+# conexão depois dos uploads; o que não terminar a tempo (ou tudo, no modo
+# assíncrono) tem o foto_path gravado por callback quando o upload concluir.
+
+_upload_executor = None
+_upload_pid = None
+_upload_lock = threading.Lock()
+upload_stats = {'enviadas': 0, 'falhas': 0, 'retentativas': 0, 'tempo_total': 0.0, 'preenchidas_depois': 0}
+
+def get_upload_executor():
+    global _upload_executor, _upload_pid
+    with _upload_lock:
+        # Threads não sobrevivem ao fork do gunicorn: recria no processo filho
+        if _upload_executor is None or _upload_pid != os.getpid():
+            _upload_executor = ThreadPoolExecutor(max_workers=FOTO_UPLOAD_WORKERS, thread_name_prefix='maprix-upload')
+            _upload_pid = os.getpid()
+        return _upload_executor
+
+def enviar_foto(conteudo, nome):
+    """Upload com timeout por tentativa e backoff entre tentativas. Devolve a URL ou None."""
+    inicio = time.monotonic()
+    url = None
+    for tentativa in range(FOTO_UPLOAD_TENTATIVAS):
+        try:
+            arquivo = io.BytesIO(conteudo)
+            arquivo.name = nome
+            res = upload_cloudinary(arquivo, 'checklist', folder="checklist", timeout=FOTO_UPLOAD_TIMEOUT)
+            url = res['secure_url']
+            break
+        except Exception as e:
+            app.logger.warning(f"Erro foto {nome} (tentativa {tentativa + 1}/{FOTO_UPLOAD_TENTATIVAS}): {e}")
+            if tentativa + 1 < FOTO_UPLOAD_TENTATIVAS:
+                with _upload_lock:
+                    upload_stats['retentativas'] += 1
+                time.sleep(0.5 * 2 ** tentativa)
+    with _upload_lock:
+        upload_stats['enviadas' if url else 'falhas'] += 1
+        upload_stats['tempo_total'] += time.monotonic() - inicio
+    return url
+
+def preencher_foto(item_id, futuro):
+    # Roda na thread do upload, fora de qualquer requisição: conexão própria do pool
+    url = futuro.result()
+    if not url: return
+    conn = get_db_pool().obter()
+    cur = conn.cursor()
+    try:
+        cur.execute('UPDATE checklist_itens SET foto_path = %s WHERE id = %s', (url, item_id))
+        conn.commit()
+        with _upload_lock:
+            upload_stats['preenchidas_depois'] += 1
+    except Exception as e:
+        conn.rollback()
+        app.logger.warning(f"Erro ao gravar foto do item {item_id}: {e}")
+    finally:
+        cur.close()
+        conn.close()
+
+@app.route('/api/checklist/uploads')
+def status_uploads():
+    with _upload_lock:
+        s = dict(upload_stats)
+    total = s['enviadas'] + s['falhas']
+    return jsonify({
+        "workers": FOTO_UPLOAD_WORKERS,
+        "enviadas": s['enviadas'],
+        "falhas": s['falhas'],
+        "retentativas": s['retentativas'],
+        "preenchidas_depois": s['preenchidas_depois'],
+        "tempo_medio_ms": round(1000 * s['tempo_total'] / total, 1) if total else 0.0
+    })
+
+def listar_checklist_perguntas(tipo_id):
     conn = get_db_connection()
     cur = conn.cursor()
     cur.execute('SELECT * FROM checklist_perguntas WHERE tipo_id = %s', (tipo_id,))
     rows = cur.fetchall()
     cur.close()
     conn.close()
-    return jsonify([dict(row) for row in rows])
+    return [dict(row) for row in rows]
+
+@app.route('/api/checklist/config/<int:tipo_id>', methods=['GET'])
+def get_checklist_config(tipo_id):
+    return responder_cacheado(('checklist_config', tipo_id), lambda: listar_checklist_perguntas(tipo_id))
 
 @app.route('/api/checklist/config', methods=['POST'])
 def add_checklist_item():
@@ -663,6 +4018,7 @@ def add_checklist_item():
     cur = conn.cursor()
     cur.execute('INSERT INTO checklist_perguntas (tipo_id, texto) VALUES (%s, %s)', (d['tipo_id'], d['texto']))
     conn.commit()
+    cache_referencia.invalidar('checklist_config')
     cur.close()
     conn.close()
     return jsonify({"status": "sucesso"}), 201
@@ -673,6 +4029,7 @@ def delete_checklist_item(id):
     cur = conn.cursor()
     cur.execute('DELETE FROM checklist_perguntas WHERE id = %s', (id,))
     conn.commit()
+    cache_referencia.invalidar('checklist_config')
     cur.close()
     conn.close()
     return jsonify({"status": "deletado"})
@@ -692,16 +4049,6 @@ def submit_checklist():
             data_final = datetime.now().isoformat()
         # ------------------------------------------------------------
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Insere Cabeçalho
-        cur.execute(
-            'INSERT INTO checklist_realizados (equipamento, operador, data_hora) VALUES (%s, %s, %s) RETURNING id',
-            (equipamento, operador, data_final)
-        )
-        checklist_id = cur.fetchone()['id']
-        
         # Processa Itens
         perguntas_map = {} 
         for key in request.form:
@@ -712,56 +4059,166 @@ def submit_checklist():
                 if p_id not in perguntas_map: perguntas_map[p_id] = {}
                 perguntas_map[p_id][tipo_campo] = request.form[key]
 
+        # Dispara os uploads em paralelo (o arquivo é lido agora: não vive além da requisição)
+        itens, futuros = [], {}
         for p_id, dados in perguntas_map.items():
             texto = dados.get('texto', 'Item')
             valor_recebido = dados.get('conforme')
             conforme = 1 if valor_recebido in ['on', 'true', '1'] else 0
             obs = dados.get('obs', '')
+            itens.append((p_id, texto, conforme, obs))
             
-            foto_path = None
             foto_file = request.files.get(f'item_{p_id}_foto')
-            
             if foto_file and allowed_file(foto_file.filename):
-                try:
-                    res = cloudinary.uploader.upload(foto_file, folder="checklist")
-                    foto_path = res['secure_url']
-                except Exception as e:
-                    print(f"Erro foto: {e}")
+                futuros[p_id] = get_upload_executor().submit(
+                    enviar_foto, foto_file.read(), secure_filename(foto_file.filename))
 
-            cur.execute('''
-                INSERT INTO checklist_itens (checklist_id, pergunta, conforme, observacao, foto_path)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (checklist_id, texto, conforme, obs, foto_path))
-            
+        assincrono = (request.form.get('assincrono', '1' if FOTO_UPLOAD_ASSINCRONO else '0') == '1') and not DB_SERVERLESS
+        if futuros and not assincrono:
+            wait(futuros.values(), timeout=FOTO_UPLOAD_ESPERA)
+        fotos = {p_id: f.result() for p_id, f in futuros.items() if f.done()}
+        pendentes = {p_id: f for p_id, f in futuros.items() if not f.done()}
+
+        # Transação curta: cabeçalho + todos os itens em um INSERT multi-linha
+        conn = get_db_connection()
+        cur = conn.cursor()
+        cur.execute(
+            'INSERT INTO checklist_realizados (equipamento, operador, data_hora) VALUES (%s, %s, %s) RETURNING id',
+            (equipamento, operador, data_final)
+        )
+        checklist_id = cur.fetchone()['id']
+        notificar_evento(cur, 'checklist', {"id": checklist_id, "equipamento": equipamento,
+                                            "operador": operador, "data_hora": data_final})
+        ids_itens = {}
+        if itens:
+            # O Postgres não garante a ordem das linhas do RETURNING de um INSERT multi-linha:
+            # os ids são reservados na sequência antes, e cada foto pendente sabe o seu item
+            cur.execute("SELECT nextval(pg_get_serial_sequence('checklist_itens', 'id')) AS id "
+                        "FROM generate_series(1, %s)", (len(itens),))
+            ids_itens = {p_id: r['id'] for (p_id, *_), r in zip(itens, cur.fetchall())}
+            execute_values(cur, '''
+                INSERT INTO checklist_itens (id, checklist_id, pergunta, conforme, observacao, foto_path)
+                VALUES %s
+            ''', [(ids_itens[p_id], checklist_id, texto, conforme, obs, fotos.get(p_id))
+                  for p_id, texto, conforme, obs in itens], page_size=len(itens))
         conn.commit()
         cur.close()
         conn.close()
-        return jsonify({"status": "sucesso"}), 201
+
+        for p_id, f in pendentes.items():
+            f.add_done_callback(lambda f, item_id=ids_itens[p_id]: preencher_foto(item_id, f))
+        return jsonify({"status": "sucesso", "id": checklist_id, "fotos_pendentes": len(pendentes)}), 201
 
     except Exception as e:
         return jsonify({"erro": str(e)}), 500
 
+def agrupar_checklists(linhas):
+    """Monta cabeçalho + itens em uma passada sobre o JOIN (linhas ordenadas por checklist)"""
+    resultado = []
+    atual = None
+    for l in linhas:
+        if atual is None or atual['id'] != l['id']:
+            atual = {
+                "id": l['id'],
+                "equipamento": l['equipamento'],
+                "operador": l['operador'],
+                "data_hora": l['data_hora'],
+                "itens": []
+            }
+            resultado.append(atual)
+        if l['item_id'] is not None:
+            atual['itens'].append({
+                "id": l['item_id'],
+                "checklist_id": l['id'],
+                "pergunta": l['pergunta'],
+                "conforme": l['conforme'],
+                "observacao": l['observacao'],
+                "foto_path": l['foto_path']
+            })
+    return resultado
+
 @app.route('/api/checklists/all')
 def get_all_checklists():
+    # ?stream=1 ou ?formato=ndjson: histórico completo em streaming, itens buscados por chunk
+    if request.args.get('stream') == '1' or formato_stream() == 'ndjson':
+        def chunks():
+            conn = get_db_connection()
+            cur = conn.cursor()
+            for headers in ler_em_chunks(conn, 'SELECT * FROM checklist_realizados ORDER BY id DESC'):
+                cur.execute('SELECT * FROM checklist_itens WHERE checklist_id = ANY(%s) ORDER BY id',
+                            ([h['id'] for h in headers],))
+                itens = {}
+                for i in cur.fetchall():
+                    itens.setdefault(i['checklist_id'], []).append(dict(i))
+                yield [{
+                    "id": h['id'],
+                    "equipamento": h['equipamento'],
+                    "operador": h['operador'],
+                    "data_hora": h['data_hora'],
+                    "itens": itens.get(h['id'], [])
+                } for h in headers]
+            cur.close()
+        return stream_json(chunks(), formato_stream())
+
+    # Paginação por keyset (id decrescente): antes_id = último id da página anterior.
+    # Sem parâmetros mantém o formato antigo (lista com os 50 mais recentes).
+    paginado = any(k in request.args for k in ('antes_id', 'limite', 'equipamento', 'operador', 'inicio', 'fim', 'nao_conforme'))
+    limite = max(1, min(request.args.get('limite', CHECKLISTS_PAGINA_PADRAO, type=int), CHECKLISTS_PAGINA_MAX))
+    condicoes, params = [], []
+    if request.args.get('antes_id'):
+        condicoes.append('c.id < %s')
+        params.append(request.args.get('antes_id', type=int))
+    if request.args.get('equipamento'):
+        condicoes.append('c.equipamento = %s')
+        params.append(request.args['equipamento'])
+    if request.args.get('operador'):
+        condicoes.append('c.operador = %s')
+        params.append(request.args['operador'])
+    if request.args.get('nao_conforme') in ('1', 'true'):
+        condicoes.append('''EXISTS (SELECT 1 FROM checklist_itens n
+                                    WHERE n.checklist_id = c.id AND (n.conforme = 0 OR n.conforme IS NULL))''')
+
     conn = get_db_connection()
     cur = conn.cursor()
-    cur.execute('SELECT * FROM checklist_realizados ORDER BY id DESC LIMIT 50')
-    headers = cur.fetchall()
-    
-    resultado = []
-    for h in headers:
-        cur.execute('SELECT * FROM checklist_itens WHERE checklist_id = %s', (h['id'],))
-        itens = cur.fetchall()
-        resultado.append({
-            "id": h['id'],
-            "equipamento": h['equipamento'],
-            "operador": h['operador'],
-            "data_hora": h['data_hora'],
-            "itens": [dict(i) for i in itens]
-        })
+    try:
+        # data_hora do checklist é a hora local do aparelho (timestamp sem fuso)
+        if request.args.get('inicio'):
+            condicoes.append('c.data_hora >= %s')
+            params.append(ler_instante(cur, request.args['inicio'], 'timestamp'))
+        if request.args.get('fim'):
+            condicoes.append('c.data_hora <= %s')
+            params.append(ler_instante(cur, request.args['fim'], 'timestamp'))
+    except ValueError as e:
+        cur.close()
+        conn.close()
+        return jsonify({"erro": str(e)}), 400
+    where = f"WHERE {' AND '.join(condicoes)}" if condicoes else ''
+
+    # Cabeçalhos da página + itens em uma única consulta
+    cur.execute(f'''
+        WITH pagina AS (
+            SELECT c.* FROM checklist_realizados c {where}
+            ORDER BY c.id DESC LIMIT %s
+        )
+        SELECT p.id, p.equipamento, p.operador, p.data_hora,
+               i.id AS item_id, i.pergunta, i.conforme, i.observacao, i.foto_path
+        FROM pagina p
+        LEFT JOIN checklist_itens i ON i.checklist_id = p.id
+        ORDER BY p.id DESC, i.id
+    ''', params + [limite + 1])
+    resultado = agrupar_checklists(cur.fetchall())
     cur.close()
     conn.close()
-    return jsonify(resultado)
+
+    tem_mais = len(resultado) > limite
+    resultado = resultado[:limite]
+    if not paginado:
+        return jsonify(resultado)
+    return jsonify({
+        "dados": resultado,
+        "ultimo_id": resultado[-1]['id'] if resultado else None,
+        "tem_mais": tem_mais
+    })
 
 @app.route('/api/checklists/novos')
 def check_novos_checklists():
@@ -0,0 +1,479 @@
+"""Benchmark de carga e latência do Maprix contra um PostgreSQL local.
+
+Recria o banco indicado, semeia uma frota sintética (ativos, posições, áreas,
+checklists com itens), sobe o app em outro processo e mede as rotas reais por
+HTTP. Para cada cenário grava vazão, latência p50/p95/p99 e pico de RSS do
+servidor num JSON comparável entre commits:
+
+    createdb maprix_bench
+    python benchmark.py --database-url postgresql://localhost/maprix_bench --saida bench.json
+    python benchmark.py --database-url ... --saida novo.json --comparar bench.json --tolerancia 20
+
+ATENÇÃO: o schema public do banco indicado é apagado a cada execução.
+"""
+import argparse
+import csv
+import http.client
+import io
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import psycopg2
+
+RAIZ = os.path.dirname(os.path.abspath(__file__))
+CENARIOS = ['registrar', 'locais', 'locais_colunar', 'ativos', 'checklists', 'importar_csv', 'backup', 'restaurar']
+BASE_LAT, BASE_LNG = -23.55, -46.63  # Centro da frota sintética
+
+
+def argumentos():
+    p = argparse.ArgumentParser(description='Benchmark de carga do Maprix contra um Postgres local.')
+    p.add_argument('--database-url', default=os.getenv('BENCH_DATABASE_URL'),
+                   help='Banco descartável (padrão: BENCH_DATABASE_URL). É apagado!')
+    p.add_argument('--saida', default='bench.json', help='Arquivo JSON do resultado.')
+    p.add_argument('--comparar', help='Resultado anterior para comparar (vazão, p95, RSS).')
+    p.add_argument('--tolerancia', type=float,
+                   help='Sai com código 1 se o p95 de algum cenário piorar mais que essa %% sobre --comparar.')
+    p.add_argument('--cenarios', default=','.join(CENARIOS), help='Lista separada por vírgula.')
+    p.add_argument('--servidor', choices=['werkzeug', 'gunicorn'], default='werkzeug')
+    p.add_argument('--workers', type=int, default=1, help='Workers do gunicorn.')
+    p.add_argument('--porta', type=int, default=5055)
+    p.add_argument('--semente', type=int, default=42, help='Semente aleatória (dados reprodutíveis).')
+    g = p.add_argument_group('frota sintética')
+    g.add_argument('--ativos', type=int, default=50)
+    g.add_argument('--pontos', type=int, default=200000)
+    g.add_argument('--dias', type=int, default=30, help='Período coberto pelas posições semeadas.')
+    g.add_argument('--areas', type=int, default=20)
+    g.add_argument('--checklists', type=int, default=2000)
+    g.add_argument('--itens', type=int, default=8, help='Perguntas por tipo / itens por checklist.')
+    g = p.add_argument_group('carga')
+    g.add_argument('--concorrencia', type=int, default=8)
+    g.add_argument('--requisicoes', type=int, default=500, help='Requisições por cenário leve.')
+    g.add_argument('--repeticoes', type=int, default=3, help='Requisições por cenário pesado (import, backup, restore).')
+    g.add_argument('--lote', type=int, default=100, help='Posições por POST /api/registrar.')
+    g.add_argument('--csv-linhas', type=int, default=20000)
+    return p.parse_args()
+
+
+# --- BANCO ---
+
+def preparar_banco(args):
+    """Schema do zero pelas próprias migrações do app e frota sintética"""
+    conn = psycopg2.connect(args.database_url)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute('DROP SCHEMA public CASCADE; CREATE SCHEMA public;')
+    conn.close()
+
+    os.environ['DATABASE_URL'] = args.database_url
+    sys.path.insert(0, RAIZ)
+    import app as maprix
+    with maprix.app.app_context():
+        maprix.migrar()
+        conn = maprix.get_db_connection()
+        inicio = time.perf_counter()
+        semear(maprix, conn, args)
+        segundos = round(time.perf_counter() - inicio, 1)
+        cur = conn.cursor()
+        cur.execute('SHOW server_version')
+        versao = cur.fetchone()['server_version']
+        cur.close()
+    return versao, segundos
+
+
+def semear(maprix, conn, args):
+    rnd = random.Random(args.semente)
+    cur = conn.cursor()
+
+    cur.execute('SELECT id FROM tipos_equipamento ORDER BY id')
+    tipos = [r['id'] for r in cur.fetchall()]
+    cur.execute('INSERT INTO checklist_perguntas (tipo_id, texto) SELECT t, %s || n FROM unnest(%s::int[]) t, '
+                'generate_series(1, %s) n', ('Item ', tipos, args.itens))
+
+    cores = ['#007bff', '#28a745', '#dc3545', '#ffc107', '#6f42c1']
+    ativos = [f"BENCH-{i:04d}" for i in range(1, args.ativos + 1)]
+    cur.executemany('INSERT INTO equipamentos_cadastrados (nome, tipo_id, cor_padrao, bateria_fabricacao) '
+                    'VALUES (%s, %s, %s, %s)',
+                    [(a, rnd.choice(tipos), rnd.choice(cores), f"202{rnd.randint(0, 5)}-{rnd.randint(1, 12):02d}")
+                     for a in ativos])
+
+    for i in range(args.areas):
+        lat, lng, r = BASE_LAT + rnd.uniform(-0.05, 0.05), BASE_LNG + rnd.uniform(-0.05, 0.05), rnd.uniform(0.002, 0.01)
+        anel = [[lng - r, lat - r], [lng + r, lat - r], [lng + r, lat + r], [lng - r, lat + r], [lng - r, lat - r]]
+        cur.execute('INSERT INTO areas (nome, geometria, cor) VALUES (%s, %s, %s)',
+                    (f"Área {i + 1}", json.dumps({"type": "Polygon", "coordinates": [anel]}), rnd.choice(cores)))
+    maprix.marcar_areas_alteradas(cur)
+
+    # Posições: passeio aleatório por ativo, em ordem de tempo, gravado com COPY
+    fim = datetime.now(timezone.utc)
+    inicio = fim - timedelta(days=args.dias)
+    mes = maprix.inicio_mes(inicio)
+    while mes <= maprix.inicio_mes(fim):
+        maprix.criar_particao(cur, mes)
+        mes = maprix.somar_meses(mes, 1)
+    passo = (fim - inicio) / max(1, args.pontos)
+    posicoes = {a: [BASE_LAT + rnd.uniform(-0.05, 0.05), BASE_LNG + rnd.uniform(-0.05, 0.05)] for a in ativos}
+    buf = io.StringIO()
+    for i in range(args.pontos):
+        a = ativos[i % len(ativos)]
+        p = posicoes[a]
+        p[0] += rnd.gauss(0, 0.0002)
+        p[1] += rnd.gauss(0, 0.0002)
+        dh = inicio + passo * i
+        buf.write(f"{a}\t{p[0]:.7f}\t{p[1]:.7f}\t{dh.isoformat()}\t{(dh + timedelta(seconds=5)).isoformat()}\t\t#007bff\n")
+        if buf.tell() > 8 << 20 or i == args.pontos - 1:
+            buf.seek(0)
+            cur.copy_expert('COPY registros (equipamento, latitude, longitude, data_hora, sincronizado_em, observacao, cor) '
+                            'FROM STDIN', buf)
+            buf = io.StringIO()
+    maprix.recalcular_posicao_atual(cur)
+    cur.execute('''
+        INSERT INTO resumo_diario (equipamento, dia, recalcular)
+        SELECT DISTINCT equipamento, (data_hora AT TIME ZONE %s)::date, true FROM registros
+        ON CONFLICT DO NOTHING
+    ''', (maprix.RESUMO_FUSO,))
+
+    buf_cab, buf_itens = io.StringIO(), io.StringIO()
+    for c in range(1, args.checklists + 1):
+        dh = (inicio + (fim - inicio) * c / max(1, args.checklists)).replace(tzinfo=None)
+        buf_cab.write(f"{c}\t{rnd.choice(ativos)}\tOperador {rnd.randint(1, 30)}\t{dh.isoformat()}\n")
+        for n in range(1, args.itens + 1):
+            conforme = 0 if rnd.random() < 0.05 else 1
+            buf_itens.write(f"{c}\tItem {n}\t{conforme}\t{'' if conforme else 'Avaria'}\t\\N\n")
+    buf_cab.seek(0)
+    buf_itens.seek(0)
+    cur.copy_expert('COPY checklist_realizados (id, equipamento, operador, data_hora) FROM STDIN', buf_cab)
+    cur.copy_expert('COPY checklist_itens (checklist_id, pergunta, conforme, observacao, foto_path) FROM STDIN', buf_itens)
+    conn.commit()
+
+    cur.execute('ANALYZE')
+    conn.commit()
+    cur.close()
+    maprix.reset_sequences()
+
+
+# --- SERVIDOR ---
+
+def servir(porta):
+    """Modo interno (--servir): o app no servidor de desenvolvimento com threads, HTTP/1.1"""
+    sys.path.insert(0, RAIZ)
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    import app as maprix
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # Sem uma linha de log por requisição
+    WSGIRequestHandler.protocol_version = 'HTTP/1.1'
+    make_server('127.0.0.1', porta, maprix.app, threaded=True).serve_forever()
+
+
+def iniciar_servidor(args):
+    env = dict(os.environ, DATABASE_URL=args.database_url, DB_POOL_MAX=str(max(10, args.concorrencia)))
+    if args.servidor == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', 'app:app', '--worker-class', 'gthread', '--threads', '64',
+               '-w', str(args.workers), '-b', f'127.0.0.1:{args.porta}', '--log-level', 'warning']
+    else:
+        cmd = [sys.executable, os.path.abspath(__file__), '--servir', str(args.porta)]
+    proc = subprocess.Popen(cmd, cwd=RAIZ, env=env)
+    limite = time.monotonic() + 30
+    while time.monotonic() < limite:
+        if proc.poll() is not None:
+            raise RuntimeError(f"Servidor saiu com código {proc.returncode}")
+        try:
+            c = http.client.HTTPConnection('127.0.0.1', args.porta, timeout=2)
+            c.request('GET', '/api/db/pool')
+            if c.getresponse().status == 200:
+                return proc
+        except OSError:
+            pass
+        time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('Servidor não respondeu em 30 s')
+
+
+def rss_arvore(pid):
+    """RSS (bytes) do processo e dos filhos (workers do gunicorn), lido de /proc"""
+    filhos = {}
+    for d in os.listdir('/proc'):
+        if not d.isdigit(): continue
+        try:
+            with open(f'/proc/{d}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            filhos.setdefault(ppid, []).append(int(d))
+        except (OSError, ValueError, IndexError):
+            continue
+    total, pendentes = 0, [pid]
+    while pendentes:
+        atual = pendentes.pop()
+        pendentes.extend(filhos.get(atual, []))
+        try:
+            with open(f'/proc/{atual}/status') as f:
+                for linha in f:
+                    if linha.startswith('VmRSS:'):
+                        total += int(linha.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+class MedidorRSS:
+    """Amostra o RSS do servidor durante um cenário e guarda o pico"""
+
+    def __init__(self, pid, intervalo=0.05):
+        self.pid, self.intervalo = pid, intervalo
+        self.pico = 0
+        self._parar = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        if os.path.exists('/proc'):
+            self._thread = threading.Thread(target=self._amostrar, daemon=True)
+            self._thread.start()
+        return self
+
+    def _amostrar(self):
+        while not self._parar.is_set():
+            self.pico = max(self.pico, rss_arvore(self.pid))
+            self._parar.wait(self.intervalo)
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        if self._thread: self._thread.join()
+
+
+# --- CLIENTE E CENÁRIOS ---
+
+class Cliente:
+    """Uma conexão HTTP/1.1 persistente por thread"""
+
+    def __init__(self, porta):
+        self.porta = porta
+        self._local = threading.local()
+
+    def _conexao(self, nova=False):
+        if nova or getattr(self._local, 'conn', None) is None:
+            conn = http.client.HTTPConnection('127.0.0.1', self.porta, timeout=600)
+            conn.connect()
+            # Sem Nagle: cabeçalho e corpo pequenos não esperam o ACK atrasado (+40 ms)
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._local.conn = conn
+        return self._local.conn
+
+    def requisitar(self, metodo, caminho, corpo=None, headers=None):
+        """(status, corpo) com o corpo lido até o fim"""
+        for tentativa in range(2):
+            conn = self._conexao(nova=tentativa > 0)
+            try:
+                conn.request(metodo, caminho, body=corpo, headers=headers or {})
+                resp = conn.getresponse()
+                return resp.status, resp.read()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if tentativa: raise
+
+
+def multipart(campo, nome, conteudo, tipo):
+    limite = uuid.uuid4().hex
+    corpo = (f'--{limite}\r\nContent-Disposition: form-data; name="{campo}"; filename="{nome}"\r\n'
+             f'Content-Type: {tipo}\r\n\r\n').encode() + conteudo + f'\r\n--{limite}--\r\n'.encode()
+    return corpo, {'Content-Type': f'multipart/form-data; boundary={limite}'}
+
+
+def executar(cliente, pid, requisicoes, concorrencia, itens_por_requisicao=1, aquecimento=0):
+    """Dispara as requisições (metodo, caminho, corpo, headers) com `concorrencia` threads"""
+    for r in requisicoes[:aquecimento]:
+        cliente.requisitar(*r)
+    requisicoes = requisicoes[aquecimento:]
+    latencias, erros, bytes_, ultimo = [], 0, 0, b''
+    lock = threading.Lock()
+
+    def uma(r):
+        nonlocal erros, bytes_, ultimo
+        inicio = time.perf_counter()
+        try:
+            status, corpo = cliente.requisitar(*r)
+            ok = status < 400
+        except (http.client.HTTPException, OSError):
+            ok, corpo = False, b''
+        ms = (time.perf_counter() - inicio) * 1000
+        with lock:
+            latencias.append(ms)
+            bytes_ += len(corpo)
+            ultimo = corpo  # Só o último corpo fica em memória (o backup usado no restore)
+            if not ok: erros += 1
+
+    with MedidorRSS(pid) as rss:
+        inicio = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concorrencia) as pool:
+            list(pool.map(uma, requisicoes))
+        segundos = time.perf_counter() - inicio
+
+    lat = np.array(latencias) if latencias else np.zeros(1)
+    n = len(requisicoes)
+    return {
+        "requisicoes": n,
+        "erros": erros,
+        "concorrencia": concorrencia,
+        "segundos": round(segundos, 3),
+        "req_s": round(n / segundos, 2) if segundos else None,
+        "itens_s": round(n * itens_por_requisicao / segundos, 1) if segundos else None,
+        "bytes_resposta_medio": round(bytes_ / n) if n else 0,
+        "latencia_ms": {
+            "p50": round(float(np.percentile(lat, 50)), 2),
+            "p95": round(float(np.percentile(lat, 95)), 2),
+            "p99": round(float(np.percentile(lat, 99)), 2),
+            "max": round(float(lat.max()), 2),
+            "media": round(float(lat.mean()), 2)
+        },
+        "rss_pico_mb": round(rss.pico / 1048576, 1) if rss.pico else None
+    }, ultimo
+
+
+def gerar_pontos(rnd, ativos, n):
+    agora = datetime.now(timezone.utc)
+    return [{"equipamento": rnd.choice(ativos), "latitude": BASE_LAT + rnd.uniform(-0.05, 0.05),
+             "longitude": BASE_LNG + rnd.uniform(-0.05, 0.05),
+             "data_hora": (agora + timedelta(milliseconds=i)).isoformat()} for i in range(n)]
+
+
+def rodar_cenarios(args, cliente, pid):
+    rnd = random.Random(args.semente + 1)
+    ativos = [f"BENCH-{i:04d}" for i in range(1, args.ativos + 1)]
+    json_h = {'Content-Type': 'application/json'}
+    gzip_h = {'Accept-Encoding': 'gzip'}
+    aquecer = min(20, args.requisicoes // 10)
+    resultados, backup = {}, None
+    pedidos = [c.strip() for c in args.cenarios.split(',') if c.strip()]
+
+    for nome in pedidos:
+        print(f"-> {nome}", file=sys.stderr, flush=True)
+        if nome == 'registrar':
+            reqs = [('POST', '/api/registrar', json.dumps(gerar_pontos(rnd, ativos, args.lote)).encode(), json_h)
+                    for _ in range(args.requisicoes + aquecer)]
+            r, _ = executar(cliente, pid, reqs, args.concorrencia, args.lote, aquecer)
+        elif nome in ('locais', 'locais_colunar'):
+            # Ids semeados são sequenciais: cada página é independente (since_id = k * limite)
+            limite = 5000
+            formato = '&formato=colunar' if nome == 'locais_colunar' else ''
+            paginas = max(1, args.pontos // limite)
+            reqs = [('GET', f'/api/locais?since_id={(k % paginas) * limite}&limite={limite}{formato}', None, gzip_h)
+                    for k in range(min(args.requisicoes, paginas * 4))]
+            r, _ = executar(cliente, pid, reqs, args.concorrencia, limite)
+        elif nome == 'ativos':
+            reqs = [('GET', '/api/ativos', None, gzip_h)] * (args.requisicoes + aquecer)
+            r, _ = executar(cliente, pid, reqs, args.concorrencia, 1, aquecer)
+        elif nome == 'checklists':
+            reqs = []
+            for _ in range(args.requisicoes + aquecer):
+                filtro = rnd.choice(['', f'&equipamento={rnd.choice(ativos)}', '&nao_conforme=1'])
+                reqs.append(('GET', f'/api/checklists/all?limite=50&antes_id={rnd.randint(50, args.checklists + 1)}{filtro}',
+                             None, gzip_h))
+            r, _ = executar(cliente, pid, reqs, args.concorrencia, 50, aquecer)
+        elif nome == 'importar_csv':
+            reqs = []
+            for _ in range(args.repeticoes):
+                texto = io.StringIO()
+                w = csv.writer(texto)
+                w.writerow(['id', 'equipamento', 'latitude', 'longitude', 'data_hora', 'observacao'])
+                for i, p in enumerate(gerar_pontos(rnd, ativos, args.csv_linhas)):
+                    w.writerow(['', p['equipamento'], p['latitude'], p['longitude'], p['data_hora'], 'bench'])
+                reqs.append(('POST', '/api/importar_csv',
+                             *multipart('file', 'bench.csv', texto.getvalue().encode(), 'text/csv')))
+            r, _ = executar(cliente, pid, reqs, 1, args.csv_linhas)
+        elif nome == 'backup':
+            reqs = [('GET', '/api/backup_dados', None, None)] * args.repeticoes
+            r, backup = executar(cliente, pid, reqs, 1)
+        elif nome == 'restaurar':
+            if backup is None:
+                _, backup = cliente.requisitar('GET', '/api/backup_dados')
+            reqs = [('POST', '/api/restaurar_dados', *multipart('file', 'bench.ndjson.gz', backup, 'application/gzip'))]
+            r, _ = executar(cliente, pid, reqs * args.repeticoes, 1)
+            r['bytes_arquivo'] = len(backup)
+        else:
+            print(f"   cenário desconhecido: {nome}", file=sys.stderr)
+            continue
+        resultados[nome] = r
+        print(f"   {r['req_s']} req/s  p50 {r['latencia_ms']['p50']} ms  p95 {r['latencia_ms']['p95']} ms  "
+              f"p99 {r['latencia_ms']['p99']} ms  RSS {r['rss_pico_mb']} MB  erros {r['erros']}", file=sys.stderr)
+    return resultados
+
+
+def comparar(atual, anterior, tolerancia):
+    """Tabela de variação por cenário; devolve se o p95 de algum piorou além da tolerância"""
+    regrediu = False
+    print(f"{'cenário':<16}{'req/s':>10}{'Δ':>9}{'p95 ms':>10}{'Δ':>9}{'RSS MB':>9}{'Δ':>9}")
+    for nome, r in atual['cenarios'].items():
+        a = anterior.get('cenarios', {}).get(nome)
+        if not a:
+            print(f"{nome:<16}{r['req_s']:>10}{'novo':>9}")
+            continue
+        var = lambda novo, velho: (novo - velho) / velho * 100 if novo is not None and velho else None
+        fmt = lambda v: f"{v:+.1f}%" if v is not None else '-'
+        d_vazao = var(r['req_s'], a['req_s'])
+        d_p95 = var(r['latencia_ms']['p95'], a['latencia_ms']['p95'])
+        d_rss = var(r['rss_pico_mb'], a['rss_pico_mb'])
+        print(f"{nome:<16}{r['req_s']:>10}{fmt(d_vazao):>9}{r['latencia_ms']['p95']:>10}{fmt(d_p95):>9}"
+              f"{r['rss_pico_mb'] or '-':>9}{fmt(d_rss):>9}")
+        if tolerancia is not None and d_p95 is not None and d_p95 > tolerancia:
+            regrediu = True
+    return regrediu
+
+
+def commit_atual():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--servir':
+        return servir(int(sys.argv[2]))
+    args = argumentos()
+    if not args.database_url:
+        sys.exit('Informe --database-url (ou BENCH_DATABASE_URL) de um banco descartável.')
+    if args.database_url == os.getenv('DATABASE_URL') and not os.getenv('BENCH_CONFIRMO_APAGAR'):
+        sys.exit('--database-url é o DATABASE_URL do app: use um banco separado (ou BENCH_CONFIRMO_APAGAR=1).')
+
+    print('Semeando banco...', file=sys.stderr, flush=True)
+    versao_pg, semeadura_s = preparar_banco(args)
+    proc = iniciar_servidor(args)
+    try:
+        cenarios = rodar_cenarios(args, Cliente(args.porta), proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait(timeout=30)
+
+    resultado = {
+        "versao": 1,
+        "commit": commit_atual(),
+        "data": datetime.now(timezone.utc).isoformat(),
+        "ambiente": {"python": platform.python_version(), "postgres": versao_pg, "plataforma": platform.platform(),
+                     "cpus": os.cpu_count(), "servidor": args.servidor, "workers": args.workers},
+        "config": {k: getattr(args, k) for k in ('ativos', 'pontos', 'dias', 'areas', 'checklists', 'itens',
+                                                  'concorrencia', 'requisicoes', 'repeticoes', 'lote',
+                                                  'csv_linhas', 'semente')},
+        "semeadura_s": semeadura_s,
+        "cenarios": cenarios
+    }
+    with open(args.saida, 'w') as f:
+        json.dump(resultado, f, indent=2)
+    print(f"Resultado em {args.saida}", file=sys.stderr)
+
+    if args.comparar:
+        with open(args.comparar) as f:
+            if comparar(resultado, json.load(f), args.tolerancia):
+                sys.exit(f"p95 piorou mais de {args.tolerancia}% em algum cenário.")
+
+
+if __name__ == '__main__':
+    main()
@@ -16,6 +16,7 @@ let dadosGlobais = [];
 let cacheTipos = {};  // ID do Tipo -> URL da Imagem (Local ou Cloudinary)
 let cacheAtivos = {}; // Nome do Equipamento -> ID do Tipo
 let lastChecklistId = 0; // Controle de notificação
+let ultimoIdPontos = 0;  // Cursor do delta de /api/locais
 
 // =========================================================
 // 2. UTILITÁRIOS (UI & URLS)
@@ -177,7 +178,7 @@ async function carregarTudo() {
         carregarRegioes();
         carregarAreas();
         carregarConfigBateria();
-        iniciarMonitoramentoChecklists();
+        iniciarEventos();
         
         // Await garante que ícones existam antes de desenhar o mapa
         await carregarTipos();
@@ -408,18 +409,55 @@ function criarIcone(nomeEquipamento, cor) {
     });
 }
 
-function carregarPontos() {
-    fetch('/api/locais').then(r => r.json()).then(dados => {
-        dadosGlobais = dados;
-        popularFiltro(dados);
-        aplicarFiltro();
-        
-        const total = [...new Set(dados.map(d => d.equipamento))].length;
-        const elTotal = document.getElementById('statTotal');
-        const elReg = document.getElementById('statRegistros');
-        if(elTotal) elTotal.innerText = total;
-        if(elReg) elReg.innerText = dados.length;
-    });
+// Página no formato colunar do /api/locais: dicionários para os textos repetidos e
+// deltas para id, coordenadas e data (ver codificar_colunar no app.py)
+function decodificarColunar(p) {
+    const c = p.colunas, d = p.dicionarios;
+    const nulos = new Set(p.nulos.sincronizado_em);
+    const linhas = new Array(p.n);
+    let id = 0, lat = 0, lon = 0, t = 0;
+    for (let i = 0; i < p.n; i++) {
+        id += c.id[i]; lat += c.latitude[i]; lon += c.longitude[i]; t += c.data_hora[i];
+        linhas[i] = {
+            id,
+            equipamento: d.equipamento[c.equipamento[i]],
+            latitude: lat / p.escala_coord,
+            longitude: lon / p.escala_coord,
+            data_hora: new Date(t).toISOString(),
+            sincronizado_em: nulos.has(i) ? null : new Date(t + c.sincronizado_em[i]).toISOString(),
+            observacao: d.observacao[c.observacao[i]],
+            cor: d.cor[c.cor[i]]
+        };
+    }
+    return linhas;
+}
+
+// Busca só o que chegou depois do último id carregado (delta paginado).
+// completo = true refaz o histórico do zero (após editar/apagar registros).
+async function carregarPontos(completo = false) {
+    if (completo) {
+        dadosGlobais = [];
+        ultimoIdPontos = 0;
+    }
+
+    let temMais = true;
+    while (temMais) {
+        const r = await fetch(`/api/locais?since_id=${ultimoIdPontos}&limite=5000&formato=colunar`);
+        const pagina = await r.json();
+        for (const p of decodificarColunar(pagina)) dadosGlobais.push(p);
+        ultimoIdPontos = pagina.ultimo_id;
+        temMais = pagina.tem_mais;
+    }
+
+    const dados = dadosGlobais;
+    popularFiltro(dados);
+    aplicarFiltro();
+    
+    const total = [...new Set(dados.map(d => d.equipamento))].length;
+    const elTotal = document.getElementById('statTotal');
+    const elReg = document.getElementById('statRegistros');
+    if(elTotal) elTotal.innerText = total;
+    if(elReg) elReg.innerText = dados.length;
 }
 
 function popularFiltro(dados) {
@@ -449,70 +487,133 @@ function aplicarFiltro() {
     const infoTime = document.getElementById('infoTimeline');
     if(infoTime) infoTime.style.display = 'none';
 
-    let filtrados = dadosGlobais;
     if (filtro !== 'todos') {
-        filtrados = dadosGlobais.filter(d => d.equipamento === filtro);
-        const poly = desenharTrajeto(filtrados);
+        const filtrados = dadosGlobais.filter(d => d.equipamento === filtro);
         if(infoTime) {
             infoTime.style.display = 'block';
             document.getElementById('nomeTrajeto').innerText = filtro;
             document.getElementById('qtdPontos').innerText = filtrados.length;
         }
-        if (poly) map.fitBounds(poly.getBounds(), { padding: [50, 50] });
-        else if(filtrados.length > 0) map.setView([filtrados[0].latitude, filtrados[0].longitude], 16);
+        if (filtrados.length > 1) {
+            const bounds = L.latLngBounds(filtrados.map(p => [p.latitude, p.longitude]));
+            map.fitBounds(bounds, { padding: [50, 50] });
+            desenharTrajeto(filtro, map.getBoundsZoom(bounds, false, L.point(100, 100)));
+        }
+        else if(filtrados.length > 0) {
+            map.setView([filtrados[0].latitude, filtrados[0].longitude], 16);
+            adicionarMarcador(filtrados[0]);
+        }
+        return;
     }
 
-    filtrados.forEach(p => {
-        const icon = criarIcone(p.equipamento, p.cor);
-        const m = L.marker([p.latitude, p.longitude], { icon: icon });
-        
-        const obsHtml = p.observacao 
-            ? `<div class="popup-obs">"${p.observacao}"</div>` 
-            : '<div style="margin-bottom:10px;"></div>';
+    carregarViewport();
+}
 
-        m.bindPopup(`
-            <div class="popup-header">
-                <span>${p.equipamento}</span>
-            </div>
-            <div class="popup-body">
-                <div class="popup-row">
-                    <i class="far fa-clock"></i> 
-                    <span>${new Date(p.data_hora).toLocaleString()}</span>
-                </div>
-                <div class="popup-row">
-                    <i class="fas fa-map-marker-alt"></i> 
-                    <span>Lat: ${p.latitude.toFixed(4)}, Lng: ${p.longitude.toFixed(4)}</span>
-                </div>
-                ${obsHtml}
-            </div>
-            <div class="popup-footer">
-                <button class="btn-popup edit" onclick="abrirModalEdicao('${p.id}','${p.equipamento}','${p.cor}','${p.observacao}', 'registro')">
-                    <i class="fas fa-edit"></i> Editar
-                </button>
-                <button class="btn-popup del" onclick="deletarPonto(${p.id})">
-                    <i class="fas fa-trash"></i> Apagar
-                </button>
-            </div>
-        `);
+// Visão geral: clusters agregados no servidor para o viewport atual
+// (pontos individuais só a partir do zoom alto)
+let viewportSeq = 0;
+async function carregarViewport() {
+    const select = document.getElementById('filtroEquipamento');
+    if (select && select.value !== 'todos') return;
+
+    const seq = ++viewportSeq;
+    const r = await fetch(`/api/mapa/clusters?bbox=${map.getBounds().toBBoxString()}&zoom=${map.getZoom()}`);
+    const d = await r.json();
+    if (seq !== viewportSeq) return; // Um movimento mais recente já pediu outro viewport
+
+    layerPontos.clearLayers();
+    if (d.modo === 'pontos') {
+        d.pontos.forEach(p => adicionarMarcador(p));
+        return;
+    }
+
+    d.clusters.forEach(c => {
+        const tam = Math.round(Math.min(60, 26 + Math.log2(c.qtd) * 4));
+        const icon = L.divIcon({
+            className: 'marker-cluster-maprix',
+            html: `<div style="background:${c.cor || '#007bff'}; width:${tam}px; height:${tam}px; line-height:${tam}px;">${c.qtd}</div>`,
+            iconSize: [tam, tam],
+            iconAnchor: [tam / 2, tam / 2]
+        });
+        const m = L.marker([c.latitude, c.longitude], { icon: icon });
+        m.bindTooltip(`${c.qtd} registro(s)<br>Último: ${new Date(c.ultima).toLocaleString()}`);
+        m.on('click', () => map.setView([c.latitude, c.longitude], Math.min(map.getZoom() + 2, 19)));
         layerPontos.addLayer(m);
     });
 }
 
-function desenharTrajeto(dados) {
-    dados.sort((a,b) => new Date(a.data_hora) - new Date(b.data_hora));
+map.on('moveend', carregarViewport);
+
+function adicionarMarcador(p) {
+    const icon = criarIcone(p.equipamento, p.cor);
+    const m = L.marker([p.latitude, p.longitude], { icon: icon });
     
-    const latlngs = dados
-        .filter(d => d.latitude != null && d.longitude != null && !isNaN(d.latitude))
-        .map(d => [d.latitude, d.longitude]);
+    const obsHtml = p.observacao 
+        ? `<div class="popup-obs">"${p.observacao}"</div>` 
+        : '<div style="margin-bottom:10px;"></div>';
+
+    m.bindPopup(`
+        <div class="popup-header">
+            <span>${p.equipamento}</span>
+        </div>
+        <div class="popup-body">
+            <div class="popup-row">
+                <i class="far fa-clock"></i> 
+                <span>${new Date(p.data_hora).toLocaleString()}</span>
+            </div>
+            <div class="popup-row">
+                <i class="fas fa-map-marker-alt"></i> 
+                <span>Lat: ${p.latitude.toFixed(4)}, Lng: ${p.longitude.toFixed(4)}</span>
+            </div>
+            ${obsHtml}
+        </div>
+        <div class="popup-footer">
+            <button class="btn-popup edit" onclick="abrirModalEdicao('${p.id}','${p.equipamento}','${p.cor}','${p.observacao}', 'registro')">
+                <i class="fas fa-edit"></i> Editar
+            </button>
+            <button class="btn-popup del" onclick="deletarPonto(${p.id})">
+                <i class="fas fa-trash"></i> Apagar
+            </button>
+        </div>
+    `);
+    layerPontos.addLayer(m);
+}
 
+// Trajeto simplificado no servidor (Douglas-Peucker) conforme o zoom:
+// desenha a linha e só os marcadores dos pontos mantidos.
+async function desenharTrajeto(equipamento, zoom) {
+    const r = await fetch(`/api/trajeto?equipamento=${encodeURIComponent(equipamento)}&zoom=${Math.round(zoom)}`);
+    const t = await r.json();
+
+    const select = document.getElementById('filtroEquipamento');
+    if (!select || select.value !== equipamento) return; // Filtro mudou enquanto carregava
+
+    layerPontos.clearLayers();
+    layerTrajeto.clearLayers();
+
+    const latlngs = t.pontos.map(p => [p[0], p[1]]);
     if (latlngs.length > 1) {
-        const poly = L.polyline(latlngs, { color: '#00bcd4', weight: 4, dashArray: '10, 10' });
-        poly.addTo(layerTrajeto);
-        return poly;
+        L.polyline(latlngs, { color: '#00bcd4', weight: 4, dashArray: '10, 10' }).addTo(layerTrajeto);
     }
-    return null;
+
+    const porId = new Map(dadosGlobais.map(p => [p.id, p]));
+    t.pontos.forEach(p => {
+        const reg = porId.get(p[3]);
+        if (reg) adicionarMarcador(reg);
+    });
+
+    const elQtd = document.getElementById('qtdPontos');
+    if (elQtd) elQtd.innerText = `${t.simplificados} de ${t.originais}`;
 }
 
+// Ao mudar o zoom com um equipamento filtrado, pede o trajeto na nova tolerância
+map.on('zoomend', () => {
+    const select = document.getElementById('filtroEquipamento');
+    if (select && select.value !== 'todos' && layerTrajeto.getLayers().length > 0) {
+        desenharTrajeto(select.value, map.getZoom());
+    }
+});
+
 function focarTrajeto() {
     if (layerTrajeto.getLayers().length > 0) {
         const group = new L.FeatureGroup(layerTrajeto.getLayers());
@@ -525,7 +626,7 @@ function focarTrajeto() {
 function deletarPonto(id) {
     showConfirm("Apagar registro?", () => {
         fetch(`/api/registro/${id}`, { method: 'DELETE' }).then(() => {
-            carregarPontos();
+            carregarPontos(true);
             showToast("Registro apagado", "success");
         });
     });
@@ -635,7 +736,7 @@ function salvarEdicao() {
             method: 'PUT', headers: {'Content-Type': 'application/json'},
             body: JSON.stringify({ equipamento: nome, cor: cor, observacao: obs })
         }).then(() => {
-            fecharModal('modalEdicao'); carregarPontos(); showToast("Registro atualizado!", "success");
+            fecharModal('modalEdicao'); carregarPontos(true); showToast("Registro atualizado!", "success");
         });
     } 
     else if (contexto === 'ativo') {
@@ -660,17 +761,72 @@ function salvarEdicao() {
 // 9. CHECKLIST MONITORING (ADMIN)
 // =========================================================
 
+// Canal em tempo real (SSE): posições novas e checklists recebidos.
+// Sem EventSource, ou com o servidor recusando a conexão, volta ao polling.
+function iniciarEventos() {
+    if (!window.EventSource) { iniciarMonitoramentoChecklists(); return; }
+
+    let conectou = false;
+    const fonte = new EventSource('/api/eventos');
+    fonte.addEventListener('open', () => {
+        // Reconexão: busca o que chegou enquanto o canal esteve fora
+        if (conectou) ressincronizarEventos();
+        conectou = true;
+    });
+    fonte.addEventListener('posicoes', e => receberPosicoes(JSON.parse(e.data)));
+    fonte.addEventListener('checklist', e => notificarChecklists(JSON.parse(e.data).id, 1));
+    fonte.addEventListener('resync', () => ressincronizarEventos());
+    fonte.addEventListener('error', () => {
+        if (fonte.readyState === EventSource.CLOSED) iniciarMonitoramentoChecklists();
+    });
+}
+
+function ressincronizarEventos() {
+    carregarPontos();
+    fetch(`/api/checklists/novos?last_id=${lastChecklistId}`)
+    .then(r=>r.json()).then(d => { if(d.qtd > 0) notificarChecklists(d.max_id, d.qtd); });
+}
+
+async function receberPosicoes(d) {
+    if (d.truncado) { await carregarPontos(); return; }
+
+    const novos = d.pontos.filter(p => p.id > ultimoIdPontos);
+    if (novos.length === 0) return;
+    const conhecidos = new Set(dadosGlobais.map(p => p.equipamento));
+    for (const p of novos) dadosGlobais.push(p);
+    ultimoIdPontos = Math.max(ultimoIdPontos, d.ultimo_id);
+
+    if (novos.some(p => !conhecidos.has(p.equipamento))) popularFiltro(dadosGlobais);
+    const elTotal = document.getElementById('statTotal');
+    const elReg = document.getElementById('statRegistros');
+    if(elTotal) elTotal.innerText = new Set(dadosGlobais.map(p => p.equipamento)).size;
+    if(elReg) elReg.innerText = dadosGlobais.length;
+
+    // Redesenha só a visão atual, agrupando rajadas de eventos
+    const select = document.getElementById('filtroEquipamento');
+    const filtro = select ? select.value : 'todos';
+    if (filtro !== 'todos' && !novos.some(p => p.equipamento === filtro)) return;
+    clearTimeout(receberPosicoes.timer);
+    receberPosicoes.timer = setTimeout(() => {
+        if (filtro === 'todos') carregarViewport();
+        else desenharTrajeto(filtro, map.getZoom());
+    }, 500);
+}
+
+function notificarChecklists(maxId, qtd) {
+    if (maxId <= lastChecklistId) return;
+    lastChecklistId = maxId;
+    showToast(`🔔 ${qtd} Novo(s) Checklist(s)!`, "info");
+    if(document.getElementById('content-checklist') && document.getElementById('content-checklist').style.display === 'block') {
+        carregarChecklistsAdmin();
+    }
+}
+
 function iniciarMonitoramentoChecklists() {
     setInterval(() => {
         fetch(`/api/checklists/novos?last_id=${lastChecklistId}`)
         .then(r=>r.json()).then(d => {
-            if(d.qtd > 0) {
-                lastChecklistId = d.max_id;
-                showToast(`🔔 ${d.qtd} Novo(s) Checklist(s)!`, "info");
-                if(document.getElementById('content-checklist') && document.getElementById('content-checklist').style.display === 'block') {
-                    carregarChecklistsAdmin();
-                }
-            }
+            if(d.qtd > 0) notificarChecklists(d.max_id, d.qtd);
         });
     }, 10000); // Polling 10s
 }
@@ -679,19 +835,32 @@ function iniciarMonitoramentoChecklists() {
 // MÓDULO CHECKLIST: VISUALIZAÇÃO E FILTRO
 // =========================================================
 
-function carregarChecklistsAdmin() {
+// Páginas de 50 por keyset (antes_id); "Carregar mais" busca a próxima
+let checklistsAntesId = null;
+
+function carregarChecklistsAdmin(mais = false) {
     const div = document.getElementById('listaChecklistsAdmin');
-    div.innerHTML = '<div style="text-align:center; padding:20px; color:#999"><i class="fas fa-spinner fa-spin"></i> Carregando...</div>';
+    const btnMais = document.getElementById('btnMaisChecklists');
+    if (btnMais) btnMais.remove();
+    if (!mais) {
+        checklistsAntesId = null;
+        div.innerHTML = '<div style="text-align:center; padding:20px; color:#999"><i class="fas fa-spinner fa-spin"></i> Carregando...</div>';
+    }
 
-    fetch('/api/checklists/all').then(r => r.json()).then(lista => {
-        div.innerHTML = "";
+    let url = '/api/checklists/all?limite=50';
+    if (mais && checklistsAntesId) url += `&antes_id=${checklistsAntesId}`;
+
+    fetch(url).then(r => r.json()).then(pagina => {
+        const lista = pagina.dados;
+        if (!mais) div.innerHTML = "";
         
-        if(lista.length === 0) {
+        if(lista.length === 0 && !mais) {
             div.innerHTML = '<div style="text-align:center; padding:20px; color:#999">Nenhum checklist recebido ainda.</div>';
             return;
         }
 
-        if(lista.length > 0) lastChecklistId = lista[0].id;
+        if(lista.length > 0 && !mais) lastChecklistId = lista[0].id;
+        checklistsAntesId = pagina.ultimo_id;
 
         lista.forEach(c => {
             let itensHtml = "";
@@ -784,8 +953,16 @@ function carregarChecklistsAdmin() {
                     </div>
                 </div>`;
             
-            div.innerHTML += cardHtml;
+            div.insertAdjacentHTML('beforeend', cardHtml);
         });
+
+        if (pagina.tem_mais) {
+            div.insertAdjacentHTML('beforeend', `
+                <button id="btnMaisChecklists" class="btn-secondary" style="width:100%; margin-top:10px;" onclick="carregarChecklistsAdmin(true)">
+                    <i class="fas fa-chevron-down"></i> Carregar mais
+                </button>`);
+        }
+        filtrarChecklists();
     });
 }
 
@@ -1018,7 +1195,7 @@ function deletarRegiao() {
 
 function backupDados() { 
     window.location.href = '/api/backup_dados'; 
-    showToast("Gerando arquivo JSON...", "info"); 
+    showToast("Gerando backup (.ndjson.gz)...", "info"); 
 }
 
 function restaurarDados() {
@@ -1034,7 +1211,8 @@ function restaurarDados() {
             .then(r => r.json())
             .then(d => {
                 if(d.status === 'sucesso') { 
-                    alert("Dados importados com sucesso!"); 
+                    const lidas = Object.values(d.tabelas || {}).reduce((t, x) => t + x.lidas, 0);
+                    alert(`Dados importados com sucesso! (${lidas} linhas em ${d.segundos}s)`); 
                     location.reload(); 
                 } else { 
                     showToast(d.erro, "error"); 
@@ -1053,7 +1231,17 @@ function exportarCSV() {
 }
 function importarCSV() {
     const f = document.getElementById('fileInput').files[0];
-    if(f) { const fd = new FormData(); fd.append('file', f); fetch('/api/importar_csv', {method:'POST', body:fd}).then(()=> { carregarTudo(); showToast("Importado!", "success"); }); }
+    if(!f) return;
+    const fd = new FormData(); fd.append('file', f);
+    showToast("Importando...", "info");
+    fetch('/api/importar_csv', {method:'POST', body:fd}).then(r => r.json()).then(d => {
+        if (d.erro) { showToast("Erro: " + d.erro, "error"); return; }
+        carregarTudo();
+        showToast(`Importado: ${d.importados} pontos (${d.linhas_por_seg || 0} linhas/s)`, "success");
+        if (d.rejeitados > 0) {
+            showConfirm(`${d.rejeitados} linha(s) rejeitada(s). Baixar relatório?`, () => { window.location = d.relatorio; });
+        }
+    }).catch(() => showToast("Erro na importação.", "error"));
 }
 
 // =========================================================
@@ -11,6 +11,8 @@ let listaCompletaAtivos = [];
 let checklistRealizado = false;
 let checklistNecessario = true; // Começa bloqueado por segurança, mas verifica rápido
 let tempEquipNome = "";
+let sincronizando = false;
+const SYNC_LOTE = 200; // Pontos por envio da fila offline (o servidor informa o máximo dele)
 
 // =========================================================
 // 2. UTILITÁRIOS VISUAIS
@@ -260,7 +262,7 @@ function capturarLocalizacao() {
         navigator.geolocation.getCurrentPosition(
             (pos) => {
                 const dados = {
-                    equipamento: session.equipamento, operador: session.operador,
+                    id: novoIdPonto(), equipamento: session.equipamento, operador: session.operador,
                     latitude: pos.coords.latitude, longitude: pos.coords.longitude,
                     data_hora: new Date().toISOString(), observacao: obsInput.value.trim()
                 };
@@ -501,32 +503,77 @@ function abrirModalLogout() { document.getElementById('modalLogout').style.displ
 function fecharModalLogout() { document.getElementById('modalLogout').style.display = 'none'; }
 function confirmarLogout() { localStorage.removeItem('maprix_session'); location.reload(); }
 
+// Id do ponto gerado no aparelho: o servidor ignora reenvios do mesmo ponto
+function novoIdPonto() {
+    if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+    // randomUUID só existe em HTTPS: monta o UUID v4 na mão
+    const b = crypto.getRandomValues(new Uint8Array(16));
+    b[6] = (b[6] & 0x0f) | 0x40; b[8] = (b[8] & 0x3f) | 0x80;
+    const h = Array.from(b, x => x.toString(16).padStart(2, '0')).join('');
+    return `${h.slice(0, 8)}-${h.slice(8, 12)}-${h.slice(12, 16)}-${h.slice(16, 20)}-${h.slice(20)}`;
+}
+
+function lerFila() { return JSON.parse(localStorage.getItem('maprix_fila')) || []; }
+
 function salvarLocal(dados) {
-    let f = JSON.parse(localStorage.getItem('maprix_fila')) || [];
+    let f = lerFila();
+    if (!dados.id) dados.id = novoIdPonto();
     f.push(dados);
     localStorage.setItem('maprix_fila', JSON.stringify(f));
     atualizarPendentes();
 }
 
 function atualizarPendentes() {
-    const f = JSON.parse(localStorage.getItem('maprix_fila')) || [];
+    const f = lerFila();
     document.getElementById('countPendentes').innerText = f.length;
-    document.getElementById('btnSync').disabled = f.length === 0;
+    document.getElementById('btnSync').disabled = f.length === 0 || sincronizando;
 }
 
-function sincronizarPendentes() {
-    const f = JSON.parse(localStorage.getItem('maprix_fila')) || [];
-    if(f.length === 0) return;
-    
-    document.getElementById('btnSync').disabled = true;
-    fetch('/api/registrar', { method: 'POST', headers: {'Content-Type':'application/json'}, body: JSON.stringify(f) })
-    .then(r => {
-        if(r.ok) { 
-            showToast("Sincronizado!", "success");
-            localStorage.removeItem('maprix_fila'); 
-            atualizarPendentes(); 
+// Envia a fila em lotes, um de cada vez. Cada lote confirmado sai da fila na hora:
+// se a conexão cair, a próxima tentativa recomeça do primeiro lote sem resposta
+// (e o servidor descarta o que já tinha gravado dele).
+async function sincronizarPendentes() {
+    if (sincronizando) return;
+    let f = lerFila();
+    if (f.length === 0) return;
+    // Pontos salvos antes do id por ponto ganham um agora e ficam com ele nos reenvios
+    if (f.some(p => !p.id)) {
+        f.forEach(p => { if (!p.id) p.id = novoIdPonto(); });
+        localStorage.setItem('maprix_fila', JSON.stringify(f));
+    }
+
+    sincronizando = true;
+    atualizarPendentes();
+    let tamanho = SYNC_LOTE, enviados = 0;
+    try {
+        while (f.length > 0) {
+            const pontos = f.slice(0, tamanho);
+            const r = await fetch('/api/sincronizar', {
+                method: 'POST', headers: {'Content-Type':'application/json'},
+                body: JSON.stringify({ lote: pontos[0].id, pontos })
+            });
+            if (r.status === 413) {
+                const d = await r.json();
+                tamanho = d.lote_max && d.lote_max < tamanho ? d.lote_max : Math.max(1, tamanho >> 1);
+                continue;
+            }
+            if (!r.ok) throw new Error(`HTTP ${r.status}`);
+            const d = await r.json();
+            const feitos = new Set(d.confirmados.concat(d.rejeitados.map(x => x.id)));
+            if (feitos.size === 0) throw new Error("Lote sem confirmação");
+            // Relê a fila: pontos capturados durante o envio continuam no fim
+            f = lerFila().filter(p => !feitos.has(p.id));
+            localStorage.setItem('maprix_fila', JSON.stringify(f));
+            enviados += d.confirmados.length;
+            atualizarPendentes();
         }
-    });
+        showToast("Sincronizado!", "success");
+    } catch (e) {
+        showToast(`Sincronização interrompida (${enviados} enviados). Tente de novo.`, "error");
+    } finally {
+        sincronizando = false;
+        atualizarPendentes();
+    }
 }
 
 function verificarConexao() {
@@ -0,0 +1,63 @@
+import os
+import sys
+from datetime import datetime
+
+import psycopg2
+import pytest
+
+# app.py fica na raiz do repositório; importá-lo não abre conexão com o banco
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as maprix
+
+
+@pytest.fixture
+def cliente():
+    maprix.app.config['TESTING'] = True
+    return maprix.app.test_client()
+
+
+class ConexaoFalsa:
+    """Conexão e cursor ao mesmo tempo. Só entende o SELECT %s::timestamp[tz] do ler_instante
+    (ISO 8601, como o Postgres); as demais consultas são registradas e não devolvem linhas.
+    Os testes substituem as funções que falam SQL de verdade."""
+
+    def __init__(self):
+        self.consultas = []
+        self.rollbacks = 0
+        self._linha = None
+
+    @property
+    def connection(self):
+        return self
+
+    def cursor(self, *args, **kwargs):
+        return self
+
+    def execute(self, sql, params=None):
+        self.consultas.append((sql, params))
+        self._linha = None
+        if '::timestamp' in sql:
+            try:
+                t = datetime.fromisoformat(params[0])
+            except ValueError:
+                raise psycopg2.DataError(f'invalid input syntax for type timestamp: "{params[0]}"')
+            # ::timestamp descarta o fuso do texto, como no Postgres
+            self._linha = {'t': t if '::timestamptz' in sql else t.replace(tzinfo=None)}
+
+    def fetchone(self):
+        return self._linha
+
+    def fetchall(self):
+        return []
+
+    def commit(self): pass
+    def rollback(self): self.rollbacks += 1
+    def close(self): pass
+
+
+@pytest.fixture
+def conexao_falsa(monkeypatch):
+    conn = ConexaoFalsa()
+    monkeypatch.setattr(maprix, 'get_db_connection', lambda: conn)
+    return conn
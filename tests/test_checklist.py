@@ -0,0 +1,65 @@
+import io
+
+import pytest
+
+import app as maprix
+from conftest import ConexaoFalsa
+
+
+class ConexaoChecklist(ConexaoFalsa):
+    """Devolve o id do cabeçalho e os ids reservados na sequência (fora de ordem de propósito)"""
+
+    def execute(self, sql, params=None):
+        super().execute(sql, params)
+        if 'INSERT INTO checklist_realizados' in sql:
+            self._linha = {'id': 7}
+        elif 'nextval' in sql:
+            self._linhas = [{'id': 100 + n} for n in reversed(range(params[0]))]
+
+    def fetchall(self):
+        return self._linhas
+
+
+class FuturoPendente:
+    def __init__(self):
+        self.callbacks = []
+
+    def done(self):
+        return False
+
+    def add_done_callback(self, fn):
+        self.callbacks.append(fn)
+
+
+def test_foto_pendente_vai_para_o_item_dela(cliente, monkeypatch):
+    conn = ConexaoChecklist()
+    monkeypatch.setattr(maprix, 'get_db_connection', lambda: conn)
+    gravados = []
+    monkeypatch.setattr(maprix, 'execute_values', lambda cur, sql, linhas, **kw: gravados.extend(linhas))
+    futuros = []
+
+    class Executor:
+        def submit(self, fn, *args):
+            futuros.append(FuturoPendente())
+            return futuros[-1]
+
+    monkeypatch.setattr(maprix, 'get_upload_executor', lambda: Executor())
+    monkeypatch.setattr(maprix, 'DB_SERVERLESS', False)
+    fotos = []
+    monkeypatch.setattr(maprix, 'preencher_foto', lambda item_id, f: fotos.append(item_id))
+
+    r = cliente.post('/api/checklist/submit', data={
+        'equipamento': 'CAM-01', 'operador': 'Ana', 'data_hora_local': '2026-10-18T07:00:00', 'assincrono': '1',
+        'item_1_texto': 'Pneus', 'item_1_conforme': 'on',
+        'item_2_texto': 'Freios', 'item_2_obs': 'ruído',
+        'item_2_foto': (io.BytesIO(b'jpg'), 'freio.jpg'),
+        'item_3_texto': 'Pneus', 'item_3_conforme': 'on',
+    }, content_type='multipart/form-data')
+
+    assert r.status_code == 201
+    assert r.get_json()['fotos_pendentes'] == 1
+    # Cada linha leva o id reservado; a foto pendente aponta para a linha de "Freios"
+    assert sorted(l[0] for l in gravados) == [100, 101, 102]
+    futuros[0].callbacks[0](futuros[0])
+    freios = [l for l in gravados if l[2] == 'Freios']
+    assert fotos == [freios[0][0]]
@@ -0,0 +1,69 @@
+import bisect
+import random
+
+import pytest
+
+import app as maprix
+
+LADO = 1 << maprix.GEO_BITS
+
+
+def desespalhar(v):
+    return sum(((v >> (2 * b)) & 1) << b for b in range(maprix.GEO_BITS))
+
+
+def test_geokey_intercala_longitude_e_latitude():
+    assert maprix.geokey(-90, -180) == 0
+    assert maprix.geokey(90, 180) == (1 << 2 * maprix.GEO_BITS) - 1  # Borda superior fica na última célula
+    k = maprix.geokey(-23.55, -46.63)
+    assert desespalhar(k) == maprix._quantizar(-46.63, -180, 360)
+    assert desespalhar(k >> 1) == maprix._quantizar(-23.55, -90, 180)
+
+
+def test_quantizar_limita_a_grade():
+    assert maprix._quantizar(-200, -180, 360) == 0
+    assert maprix._quantizar(200, -180, 360) == LADO - 1
+    assert maprix._quantizar(0, -180, 360) == LADO // 2
+
+
+def test_geokey_preserva_a_vizinhanca_no_nivel():
+    # Pontos na mesma célula de nível n compartilham os 2n bits mais altos
+    n = 10
+    a, b = maprix.geokey(-23.5501, -46.6301), maprix.geokey(-23.5502, -46.6302)
+    deslocamento = 2 * (maprix.GEO_BITS - n)
+    assert a >> deslocamento == b >> deslocamento
+
+
+def dentro(intervalos, k):
+    i = bisect.bisect_right([ini for ini, _ in intervalos], k) - 1
+    return i >= 0 and k < intervalos[i][1]
+
+
+@pytest.mark.parametrize('bbox, nivel', [
+    ((-46.8, -23.7, -46.4, -23.4), 8),
+    ((-46.8, -23.7, -46.4, -23.4), 14),
+    ((-180, -90, 180, 90), 3),
+    ((10.0, 0.0, 10.5, 0.3), 12),
+])
+def test_cobertura_contem_o_bbox(bbox, nivel):
+    oeste, sul, leste, norte = bbox
+    intervalos = maprix.cobertura_geokey(oeste, sul, leste, norte, nivel)
+    assert intervalos
+    # Ordenados, sem sobreposição e sem dois contíguos (já emendados)
+    for (_, fim), (ini, _) in zip(intervalos, intervalos[1:]):
+        assert fim < ini
+    rnd = random.Random(1)
+    for _ in range(500):
+        lat, lng = rnd.uniform(sul, norte), rnd.uniform(oeste, leste)
+        assert dentro(intervalos, maprix.geokey(lat, lng))
+
+
+def test_cobertura_nao_vai_longe_do_bbox():
+    intervalos = maprix.cobertura_geokey(-46.8, -23.7, -46.4, -23.4, 14)
+    # Células de nível 14 têm ~0,022° de lado: um ponto a 1° do bbox fica de fora
+    assert not dentro(intervalos, maprix.geokey(-23.55, -45.4))
+    assert not dentro(intervalos, maprix.geokey(-22.4, -46.6))
+
+
+def test_bbox_inteiro_vira_um_intervalo():
+    assert maprix.cobertura_geokey(-180, -90, 180, 90, 5) == [[0, 1 << 2 * maprix.GEO_BITS]]
@@ -0,0 +1,104 @@
+import json
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+import app as maprix
+
+
+def ler_varints(dados, n):
+    """Decodificador de referência: LEB128 + zigzag, um valor por vez"""
+    valores, pos = [], 0
+    for _ in range(n):
+        z = desloc = 0
+        while True:
+            b = dados[pos]
+            pos += 1
+            z |= (b & 0x7F) << desloc
+            desloc += 7
+            if not b & 0x80: break
+        valores.append((z >> 1) ^ -(z & 1))
+    return valores, pos
+
+
+@pytest.mark.parametrize('valores', [
+    [],
+    [0, 1, -1, 63, -64, 64, -65],
+    [2 ** 31, -(2 ** 31), 2 ** 62, -(2 ** 63), 2 ** 63 - 1],
+    list(np.random.default_rng(3).integers(-10 ** 12, 10 ** 12, 1000)),
+])
+def test_varints_ida_e_volta(valores):
+    dados = maprix.varints(valores)
+    assert ler_varints(dados, len(valores)) == ([int(v) for v in valores], len(dados))
+
+
+def test_varints_tamanhos():
+    assert len(maprix.varints([0, 63, -64])) == 3
+    assert len(maprix.varints([64])) == 2
+    assert len(maprix.varints([-(2 ** 63)])) == 10
+
+
+T0 = datetime(2026, 10, 18, 8, 0, tzinfo=timezone.utc)
+
+LINHAS = [
+    {'id': 10, 'equipamento': 'CAM-01', 'latitude': -23.550001, 'longitude': -46.633309, 'data_hora': T0,
+     'sincronizado_em': T0 + timedelta(seconds=2), 'observacao': '', 'cor': '#007bff'},
+    {'id': 11, 'equipamento': 'CAM-02', 'latitude': -23.551, 'longitude': -46.634, 'data_hora': T0 + timedelta(seconds=30),
+     'sincronizado_em': None, 'observacao': 'carga', 'cor': '#28a745'},
+    {'id': 15, 'equipamento': 'CAM-01', 'latitude': -23.5505, 'longitude': -46.6335, 'data_hora': T0 + timedelta(seconds=61),
+     'sincronizado_em': T0 + timedelta(hours=3), 'observacao': '', 'cor': '#007bff'},
+]
+
+
+def decodificar(cabecalho, colunas):
+    """O que o cliente faz: soma os deltas e resolve os dicionários"""
+    ids = np.cumsum(colunas['id'])
+    ms = np.cumsum(colunas['data_hora'])
+    escala = cabecalho['escala_coord']
+    linhas = []
+    for i in range(cabecalho['n']):
+        sinc = None if i in cabecalho['nulos']['sincronizado_em'] else ms[i] + colunas['sincronizado_em'][i]
+        linhas.append({
+            'id': int(ids[i]),
+            'equipamento': cabecalho['dicionarios']['equipamento'][colunas['equipamento'][i]],
+            'latitude': np.cumsum(colunas['latitude'])[i] / escala,
+            'longitude': np.cumsum(colunas['longitude'])[i] / escala,
+            'data_hora': int(ms[i]), 'sincronizado_em': None if sinc is None else int(sinc),
+            'observacao': cabecalho['dicionarios']['observacao'][colunas['observacao'][i]],
+            'cor': cabecalho['dicionarios']['cor'][colunas['cor'][i]],
+        })
+    return linhas
+
+
+def esperado(l):
+    return dict(l, latitude=pytest.approx(l['latitude'], abs=1e-6), longitude=pytest.approx(l['longitude'], abs=1e-6),
+                data_hora=int(l['data_hora'].timestamp() * 1000),
+                sincronizado_em=None if l['sincronizado_em'] is None else int(l['sincronizado_em'].timestamp() * 1000))
+
+
+def test_colunar_ida_e_volta():
+    cabecalho, colunas = maprix.codificar_colunar(LINHAS)
+    assert cabecalho['dicionarios']['equipamento'] == ['CAM-01', 'CAM-02']
+    assert colunas['id'].tolist() == [10, 1, 4]
+    assert decodificar(cabecalho, colunas) == [esperado(l) for l in LINHAS]
+
+
+def test_colunar_vazio():
+    cabecalho, colunas = maprix.codificar_colunar([])
+    assert cabecalho['n'] == 0 and all(len(c) == 0 for c in colunas.values())
+
+
+def test_binario_mesmas_colunas():
+    with maprix.app.test_request_context():
+        corpo = maprix.responder_colunar(LINHAS, 'binario', {"ultimo_id": 15, "tem_mais": False}).get_data()
+    assert corpo[:4] == b'MPX1'
+    tamanho = int.from_bytes(corpo[4:8], 'little')
+    cabecalho = json.loads(corpo[8:8 + tamanho])
+    assert cabecalho['ordem'] == maprix.COLUNAS_COLUNAR and cabecalho['ultimo_id'] == 15
+    dados, colunas = corpo[8 + tamanho:], {}
+    for c in cabecalho['ordem']:
+        colunas[c], lidos = ler_varints(dados, cabecalho['n'])
+        dados = dados[lidos:]
+    assert dados == b''
+    assert decodificar(cabecalho, {c: np.array(v) for c, v in colunas.items()}) == [esperado(l) for l in LINHAS]
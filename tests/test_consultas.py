@@ -0,0 +1,70 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as maprix
+from conftest import ConexaoFalsa
+
+
+# --- ler_instante ---
+
+def test_ler_instante_valido():
+    cur = ConexaoFalsa()
+    assert maprix.ler_instante(cur, '2026-10-18T14:00:00-03:00').utcoffset() == timedelta(hours=-3)
+    assert cur.rollbacks == 0
+
+
+def test_ler_instante_invalido_desfaz_a_transacao():
+    cur = ConexaoFalsa()
+    with pytest.raises(ValueError, match='Data inválida: ontem'):
+        maprix.ler_instante(cur, 'ontem')
+    assert cur.rollbacks == 1
+
+
+# --- datas nos filtros: JSON 400, nunca a página HTML do 500 ---
+
+@pytest.mark.parametrize('parametro', ['since', 'inicio', 'fim'])
+def test_locais_data_invalida(cliente, conexao_falsa, parametro):
+    r = cliente.get(f'/api/locais?{parametro}=lixo')
+    assert r.status_code == 400
+    assert r.get_json() == {"erro": "Data inválida: lixo"}
+
+
+def test_locais_filtra_pela_data_lida(cliente, conexao_falsa):
+    r = cliente.get('/api/locais?inicio=2026-10-01&fim=2026-10-18T23:59:59&since=2026-10-18T12:00:00')
+    assert r.status_code == 200
+    assert r.get_json() == {"dados": [], "ultimo_id": 0, "tem_mais": False}
+    sql, params = conexao_falsa.consultas[-1]
+    assert 'FROM registros' in sql
+    assert params[1:4] == [datetime(2026, 10, 18, 12), datetime(2026, 10, 1), datetime(2026, 10, 18, 23, 59, 59)]
+
+
+@pytest.mark.parametrize('parametro', ['inicio', 'fim'])
+def test_geofence_eventos_data_invalida(cliente, conexao_falsa, parametro):
+    r = cliente.get(f'/api/geofence/eventos?{parametro}=31/02/2026')
+    assert r.status_code == 400
+    assert r.get_json() == {"erro": "Data inválida: 31/02/2026"}
+
+
+def test_geofence_eventos_filtra_pela_data_lida(cliente, conexao_falsa):
+    r = cliente.get('/api/geofence/eventos?tipo=entrada&inicio=2026-10-01')
+    assert r.status_code == 200
+    sql, params = conexao_falsa.consultas[-1]
+    assert 'FROM geofence_eventos' in sql
+    assert params == [0, 'entrada', datetime(2026, 10, 1), 1001]
+
+
+@pytest.mark.parametrize('parametro', ['inicio', 'fim'])
+def test_checklists_data_invalida(cliente, conexao_falsa, parametro):
+    r = cliente.get(f'/api/checklists/all?{parametro}=amanha')
+    assert r.status_code == 400
+    assert r.get_json() == {"erro": "Data inválida: amanha"}
+
+
+def test_checklists_filtra_em_hora_local(cliente, conexao_falsa):
+    r = cliente.get('/api/checklists/all?inicio=2026-10-18T06:00:00-03:00&operador=Ana')
+    assert r.status_code == 200
+    assert r.get_json() == {"dados": [], "ultimo_id": None, "tem_mais": False}
+    sql, params = conexao_falsa.consultas[-1]
+    assert 'FROM checklist_realizados' in sql
+    assert params == ['Ana', datetime(2026, 10, 18, 6), maprix.CHECKLISTS_PAGINA_PADRAO + 1]
@@ -0,0 +1,86 @@
+import json
+
+import numpy as np
+import pytest
+
+import app as maprix
+
+QUADRADO = [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]]
+BURACO = [[4, 4], [6, 4], [6, 6], [4, 6], [4, 4]]
+
+
+def dentro(pontos, aneis):
+    px = np.array([p[0] for p in pontos], dtype=float)
+    py = np.array([p[1] for p in pontos], dtype=float)
+    return maprix._dentro_aneis(px, py, [np.array(a, dtype=float) for a in aneis]).tolist()
+
+
+def test_ponto_em_poligono():
+    assert dentro([(5, 5), (0.1, 9.9), (-1, 5), (11, 5), (5, -0.1)], [QUADRADO]) == [True, True, False, False, False]
+
+
+def test_buraco_fica_de_fora():
+    assert dentro([(5, 5), (2, 2), (4.5, 7)], [QUADRADO, BURACO]) == [False, True, True]
+
+
+def test_poligono_concavo():
+    u = [[0, 0], [9, 0], [9, 9], [6, 9], [6, 3], [3, 3], [3, 9], [0, 9]]  # Anel sem fechar também vale
+    assert dentro([(1, 8), (4.5, 8), (8, 8), (4.5, 1)], [u]) == [True, False, True, True]
+
+
+def test_lado_horizontal_nao_divide_por_zero():
+    with np.errstate(all='raise'):
+        assert dentro([(5, 0), (5, 10), (5, 5)], [QUADRADO]) == [True, False, True]
+
+
+class CursorAreas:
+    def __init__(self, areas, versao='1'):
+        self.areas, self.versao = areas, versao
+        self._resultado = None
+
+    def execute(self, sql, params=None):
+        self._resultado = [{'valor': self.versao}] if 'config_sistema' in sql else self.areas
+
+    def fetchone(self):
+        return self._resultado[0]
+
+    def fetchall(self):
+        return self._resultado
+
+
+def poligono(*aneis, tipo='Polygon'):
+    return {"type": tipo, "coordinates": list(aneis)}
+
+
+@pytest.fixture
+def motor():
+    m = maprix.MotorGeofence()
+    m.garantir_atualizado(CursorAreas([
+        {'id': 1, 'nome': 'Pátio', 'geometria': json.dumps(poligono(QUADRADO, BURACO))},
+        {'id': 2, 'nome': 'Oficina', 'geometria': {"type": "Feature", "geometry": poligono(BURACO)}},
+        {'id': 3, 'nome': 'Lotes', 'geometria': poligono([[[20, 0], [22, 0], [22, 2], [20, 0]]],
+                                                         [[[30, 0], [32, 0], [32, 2], [30, 0]]], tipo='MultiPolygon')},
+        {'id': 4, 'nome': 'Rota', 'geometria': {"type": "LineString", "coordinates": [[0, 0], [1, 1]]}},
+        {'id': 5, 'nome': 'Quebrada', 'geometria': '{nao é json'},
+    ]))
+    return m
+
+
+def test_areas_contendo(motor):
+    # Coordenadas do GeoJSON são [lng, lat]
+    lats, lngs = [5, 2, 0.5, 0.5, 50], [5, 2, 21.5, 31.5, 50]
+    assert motor.areas_contendo(lats, lngs) == [{2}, {1}, {3}, {3}, set()]
+
+
+def test_geometrias_que_nao_sao_poligono_ficam_de_fora(motor):
+    assert sorted(motor.nomes) == [1, 2, 3]
+    assert motor.centro(1) == (5.0, 5.0)
+    assert motor.centro(4) is None
+
+
+def test_so_recompila_quando_a_versao_muda(motor):
+    motor.garantir_atualizado(CursorAreas([], versao='1'))
+    assert sorted(motor.nomes) == [1, 2, 3]
+    motor.garantir_atualizado(CursorAreas([], versao='2'))
+    assert motor.nomes == {}
+    assert motor.areas_contendo([5], [5]) == [set()]
@@ -0,0 +1,70 @@
+import io
+
+import psycopg2
+import pytest
+
+import app as maprix
+
+CSV = (
+    "id,equipamento,latitude,longitude,data_hora,observacao\n"
+    "1,CAM-01,-23.5,-46.6,18/10/2026 08:00,\n"
+    "2,CAM-01,-23.5,-46.6,18/10/2026 08:01,\n"
+    "3,CAM-02,-23.5,abc,18/10/2026 08:02,\n"
+    "4,CAM-02,-23.5,-46.6,18/10/2026 08:03,\n"
+    "5,CAM-03,-23.5,-46.6,2026-10-18T08:04:00,\n"
+)
+
+
+@pytest.fixture
+def lotes(monkeypatch, conexao_falsa):
+    """Grava os lotes em memória; o segundo lote falha no banco"""
+    gravados = []
+
+    def inserir(cur, pontos, lote_max=None):
+        if len(gravados) == 1:
+            raise psycopg2.IntegrityError('duplicate key value violates unique constraint "x"\nDETAIL: ...')
+        gravados.append(pontos)
+        return []
+
+    monkeypatch.setattr(maprix, 'inserir_registros', inserir)
+    monkeypatch.setattr(maprix, 'IMPORT_CHUNK', 2)
+    return gravados
+
+
+def enviar(cliente):
+    return cliente.post('/api/importar_csv', data={'file': (io.BytesIO(CSV.encode()), 'pontos.csv')},
+                        content_type='multipart/form-data')
+
+
+def relatorio_gravado(conexao):
+    sql, params = conexao.consultas[-1]
+    assert 'INSERT INTO importacoes' in sql
+    return params[-1]
+
+
+def test_lote_com_erro_do_banco_vai_para_o_relatorio(cliente, lotes, conexao_falsa):
+    r = enviar(cliente)
+    assert r.status_code == 201
+    corpo = r.get_json()
+    assert (corpo['status'], corpo['linhas'], corpo['importados'], corpo['rejeitados'], corpo['lotes_com_erro']) == \
+        ('parcial', 5, 2, 3, 1)
+    assert [[p['equipamento'] for p in l] for l in lotes] == [['CAM-01', 'CAM-01']]
+    linhas = relatorio_gravado(conexao_falsa).splitlines()
+    assert linhas[1].startswith('4,longitude inválida')
+    motivo = '"lote não gravado (duplicate key value violates unique constraint ""x"")"'
+    assert linhas[2].startswith(f'5,{motivo}') and linhas[3].startswith(f'6,{motivo}')
+    assert len(linhas) == 4
+    assert conexao_falsa.rollbacks == 1
+
+
+def test_sem_banco_para_o_relatorio_ele_vai_na_resposta(cliente, lotes, conexao_falsa, monkeypatch):
+    execute = type(conexao_falsa).execute
+
+    def execute_sem_importacoes(self, sql, params=None):
+        if 'INSERT INTO importacoes' in sql: raise psycopg2.OperationalError('server closed the connection')
+        execute(self, sql, params)
+
+    monkeypatch.setattr(type(conexao_falsa), 'execute', execute_sem_importacoes)
+    corpo = enviar(cliente).get_json()
+    assert corpo['importacao_id'] is None and corpo['relatorio'] is None
+    assert corpo['relatorio_csv'].count('\n') == 4
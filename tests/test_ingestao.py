@@ -0,0 +1,186 @@
+import threading
+from datetime import datetime, timezone, timedelta
+
+import pytest
+
+import app as maprix
+
+
+def ponto(**campos):
+    p = {'equipamento': 'CAM-01', 'latitude': -23.5, 'longitude': -46.6, 'data_hora': '2026-10-18T14:00:00'}
+    p.update(campos)
+    return p
+
+
+# --- ler_data_hora ---
+
+@pytest.mark.parametrize('texto, esperado', [
+    ('2026-10-18T14:00:00', datetime(2026, 10, 18, 14, 0)),
+    ('2026-10-18 14:00:00', datetime(2026, 10, 18, 14, 0)),
+    ('18/10/2026 14:00:05', datetime(2026, 10, 18, 14, 0, 5)),
+    ('18/10/2026 14:00', datetime(2026, 10, 18, 14, 0)),
+    ('05/10/2026', datetime(2026, 10, 5)),
+])
+def test_ler_data_hora_formatos(texto, esperado):
+    assert maprix.ler_data_hora(texto) == esperado
+
+
+def test_ler_data_hora_mantem_fuso():
+    d = maprix.ler_data_hora('2026-10-18T14:00:00-03:00')
+    assert d.utcoffset() == timedelta(hours=-3)
+    assert maprix.ler_data_hora('2026-10-18T17:00:00Z') == d
+
+
+@pytest.mark.parametrize('texto', ['', 'ontem', '10/18/2026', '2026-13-01', '31/02/2026'])
+def test_ler_data_hora_invalida(texto):
+    with pytest.raises(ValueError):
+        maprix.ler_data_hora(texto)
+
+
+# --- validar_ponto ---
+
+def test_validar_ponto_devolve_data_lida():
+    p = maprix.validar_ponto(ponto(data_hora='05/10/2026 08:30', observacao=None))
+    assert p['data_hora'] == datetime(2026, 10, 5, 8, 30)
+    assert p['observacao'] == ''
+    assert p['ponto_uid'] is None
+    assert 'cor' not in p
+
+
+def test_validar_ponto_uid_canonico():
+    p = maprix.validar_ponto(ponto(id='A0E1B2C3D4E5F60718293A4B5C6D7E8F'))
+    assert p['ponto_uid'] == 'a0e1b2c3-d4e5-f607-1829-3a4b5c6d7e8f'
+
+
+@pytest.mark.parametrize('item, motivo', [
+    (None, 'campos obrigatórios'),
+    ([1, 2], 'campos obrigatórios'),
+    ({'equipamento': 'CAM-01', 'latitude': 1}, 'campos obrigatórios'),
+    (ponto(equipamento='  '), 'equipamento inválido'),
+    (ponto(equipamento=7), 'equipamento inválido'),
+    (ponto(latitude='-23.5'), 'coordenada inválida'),
+    (ponto(latitude=True), 'coordenada inválida'),
+    (ponto(latitude=90.5), 'coordenada inválida'),
+    (ponto(longitude=float('nan')), 'coordenada inválida'),
+    (ponto(longitude=-181), 'coordenada inválida'),
+    (ponto(data_hora=1760796000), 'data_hora inválida'),
+    (ponto(data_hora='18-10-2026'), 'data_hora inválida'),
+])
+def test_validar_ponto_rejeita(item, motivo):
+    with pytest.raises(ValueError, match=motivo):
+        maprix.validar_ponto(item)
+
+
+# --- /api/registrar: o que foi validado é o que vai para o banco, nos dois caminhos ---
+
+@pytest.fixture
+def gravados(monkeypatch, conexao_falsa):
+    lista = []
+
+    def inserir(cur, pontos, lote_max=None):
+        lista.extend(pontos)
+        return [{'linhas': len(pontos), 'duplicados': 0, 'ms': 0.0}]
+
+    monkeypatch.setattr(maprix, 'inserir_registros', inserir)
+    monkeypatch.setattr(maprix, 'INGEST_ASSINCRONO', False)
+    return lista
+
+
+@pytest.fixture
+def enfileirados(monkeypatch):
+    lista = []
+
+    def enfileirar(pontos, espera):
+        lista.extend(pontos)
+        return True
+
+    monkeypatch.setattr(maprix.fila_ingestao, 'enfileirar', enfileirar)
+    monkeypatch.setattr(maprix, 'INGEST_ASSINCRONO', True)
+    return lista
+
+
+def test_registrar_sincrono_data_brasileira(cliente, gravados):
+    r = cliente.post('/api/registrar', json=[ponto(data_hora='18/10/2026 14:00'), ponto(data_hora='05/10/2026')])
+    assert r.status_code == 201
+    assert [p['data_hora'] for p in gravados] == [datetime(2026, 10, 18, 14, 0), datetime(2026, 10, 5)]
+
+
+def test_registrar_fila_data_brasileira(cliente, enfileirados):
+    r = cliente.post('/api/registrar', json=[ponto(data_hora='18/10/2026 14:00'), ponto(data_hora='05/10/2026')])
+    assert r.status_code == 202
+    assert [p['data_hora'] for p in enfileirados] == [datetime(2026, 10, 18, 14, 0), datetime(2026, 10, 5)]
+
+
+def test_registrar_lote_maior_que_a_fila_vai_direto(cliente, gravados, monkeypatch):
+    monkeypatch.setattr(maprix, 'INGEST_ASSINCRONO', True)
+    monkeypatch.setattr(maprix, 'INGEST_FILA_MAX', 1)
+    r = cliente.post('/api/registrar', json=[ponto(), ponto(data_hora='18/10/2026 14:00')])
+    assert r.status_code == 201
+    assert gravados[1]['data_hora'] == datetime(2026, 10, 18, 14, 0)
+
+
+@pytest.mark.parametrize('assincrono', [False, True])
+@pytest.mark.parametrize('corpo', [
+    [{'equipamento': 'CAM-01', 'latitude': 1}],
+    [ponto(latitude='x')],
+    [ponto(data_hora='10/18/2026')],
+    [None],
+])
+def test_registrar_invalido_400_nos_dois_caminhos(cliente, gravados, enfileirados, monkeypatch, assincrono, corpo):
+    monkeypatch.setattr(maprix, 'INGEST_ASSINCRONO', assincrono)
+    r = cliente.post('/api/registrar', json=corpo)
+    assert r.status_code == 400
+    assert 'erro' in r.get_json()
+    assert gravados == [] and enfileirados == []
+
+
+@pytest.mark.parametrize('id_antigo', [17, '17', 'abc'])
+def test_registrar_ignora_id_que_nao_e_uuid(cliente, gravados, id_antigo):
+    r = cliente.post('/api/registrar', json=[ponto(id=id_antigo)])
+    assert r.status_code == 201
+    assert gravados[0]['ponto_uid'] is None
+
+
+def test_sincronizar_exige_uuid(cliente, gravados):
+    r = cliente.post('/api/sincronizar', json={'lote': 1, 'pontos': [ponto(id=17)]})
+    assert r.status_code == 400
+    assert gravados == []
+
+
+# --- FilaIngestao (com a gravação no banco substituída) ---
+
+@pytest.fixture
+def fila():
+    f = maprix.FilaIngestao(maximo=4, flush_ms=20, flush_linhas=3)
+    yield f
+    f.parar(timeout=2)
+
+
+def test_fila_grava_e_esvazia_no_parar(fila, monkeypatch):
+    lotes = []
+    monkeypatch.setattr(fila, '_gravar', lambda lote: lotes.append(lote) or len(lote))
+    assert fila.enfileirar([1, 2], espera=0)
+    assert fila.enfileirar([3], espera=0)
+    fila.parar(timeout=2)
+    assert sum(lotes, []) == [1, 2, 3]
+    assert fila.estatisticas()['profundidade'] == 0
+    assert not fila.enfileirar([4], espera=0)  # Encerrada não aceita mais
+
+
+def test_fila_cheia_recusa_e_nada_se_perde_com_o_banco_fora(fila, monkeypatch):
+    banco_no_ar, tentativas = threading.Event(), []
+
+    def gravar(lote):
+        # Como _gravar: devolve quantos pontos saíram da fila (0 com o banco fora)
+        tentativas.append(list(lote))
+        return len(lote) if banco_no_ar.is_set() else 0
+
+    monkeypatch.setattr(fila, '_gravar', gravar)
+    monkeypatch.setattr(maprix.time, 'sleep', lambda s: banco_no_ar.wait(0.01))  # Sem o backoff real
+    assert fila.enfileirar([1, 2, 3], espera=0)
+    assert not fila.enfileirar([4, 5], espera=0.05)
+    assert fila.estatisticas()['recusados_fila_cheia'] == 2
+    banco_no_ar.set()
+    fila.parar(timeout=5)
+    assert tentativas[-1] == [1, 2, 3]
+    assert fila.estatisticas()['profundidade'] == 0
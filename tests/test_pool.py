@@ -0,0 +1,90 @@
+import psycopg2
+import psycopg2.extensions
+import pytest
+
+import app as maprix
+
+
+class Info:
+    transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class ConexaoCrua:
+    """O que o pool usa de uma conexão psycopg2"""
+
+    def __init__(self):
+        self.closed = 0
+        self.info = Info()
+        self.autocommit = False
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = 1
+
+
+@pytest.fixture
+def abertas(monkeypatch):
+    lista = []
+    monkeypatch.setattr(maprix.psycopg2, 'connect', lambda *a, **k: lista.append(ConexaoCrua()) or lista[-1])
+    return lista
+
+
+def pool(**opcoes):
+    p = dict(dsn='postgresql://', minimo=0, maximo=2, timeout=0.05, max_lifetime=3600, idle_timeout=3600, ping_apos=3600)
+    p.update(opcoes)
+    return maprix.PoolConexoes(**p)
+
+
+def test_reaproveita_a_conexao_devolvida(abertas):
+    p = pool()
+    a = p.obter()
+    a.close()
+    b = p.obter()
+    assert b._raw is a._raw and len(abertas) == 1
+    assert p.estatisticas()['checkouts'] == 2
+
+
+def test_conexao_da_requisicao_so_volta_no_teardown(abertas):
+    p = pool()
+    c = p.obter(da_requisicao=True)
+    c.close()
+    assert p.estatisticas()['em_uso'] == 1
+    c.devolver()
+    c.devolver()  # Idempotente
+    assert p.estatisticas()['livres'] == 1
+
+
+def test_esgotado_espera_e_levanta_pool_error(abertas):
+    p = pool(maximo=1)
+    p.obter()
+    with pytest.raises(maprix.PoolError):
+        p.obter()
+    assert p.estatisticas()['timeouts'] == 1
+
+
+def test_transacao_esquecida_e_desfeita_na_devolucao(abertas):
+    p = pool()
+    c = p.obter()
+    c._raw.info.transaction_status = psycopg2.extensions.TRANSACTION_STATUS_INERROR
+    c.close()
+    assert c._raw.rollbacks == 1 and p.estatisticas()['livres'] == 1
+
+
+def test_conexao_quebrada_e_trocada(abertas):
+    p = pool()
+    c = p.obter()
+    c._raw.closed = 1
+    c.close()
+    assert p.estatisticas()['abertas'] == 0
+    assert p.obter()._raw is not c._raw and len(abertas) == 2
+
+
+def test_conexao_velha_e_reciclada(abertas):
+    p = pool(max_lifetime=0)
+    p.obter().close()
+    p.obter()
+    assert len(abertas) == 2 and p.estatisticas()['recicladas'] >= 1
@@ -0,0 +1,92 @@
+import random
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pytest
+
+import app as maprix
+
+T0 = datetime(2026, 10, 18, 8, 0, tzinfo=timezone.utc)
+
+
+class CursorPosicoes:
+    def __init__(self, linhas):
+        self.linhas = linhas
+
+    def execute(self, sql, params=None):
+        pass
+
+    def fetchall(self):
+        return self.linhas
+
+
+def frota(n, semente=5, centro=(-23.55, -46.63), espalhamento=0.2):
+    rnd = random.Random(semente)
+    return [{'equipamento': f'CAM-{i:03d}', 'latitude': centro[0] + rnd.uniform(-espalhamento, espalhamento),
+             'longitude': centro[1] + rnd.uniform(-espalhamento, espalhamento), 'data_hora': T0, 'registro_id': i,
+             'cor': '#007bff', 'tipo_id': i % 3, 'tipo': f'tipo{i % 3}'} for i in range(n)]
+
+
+@pytest.fixture
+def indice():
+    i = maprix.IndiceProximos(0.01, 3600)
+    i.garantir_atualizado(CursorPosicoes(frota(400)))
+    return i
+
+
+def forca_bruta(indice, lat, lng, filtro=None):
+    ativos = [a for a in indice._ativos.values() if not filtro or filtro(a)]
+    dist = maprix.distancias_m(lat, lng, np.array([a['latitude'] for a in ativos]), np.array([a['longitude'] for a in ativos]))
+    return sorted(zip(dist.tolist(), [a['equipamento'] for a in ativos]))
+
+
+def test_distancias_haversine():
+    # 1° de latitude ~ 111,2 km; mesma distância pelas duas funções
+    d = maprix.distancias_m(0.0, 0.0, np.array([1.0, 0.0]), np.array([0.0, 0.0]))
+    assert d[0] == pytest.approx(111195, rel=1e-4) and d[1] == 0
+    assert maprix.distancias_m(-23.5, -46.6, np.array([-22.9]), np.array([-43.2]))[0] == \
+        pytest.approx(maprix.haversine_m(-23.5, -46.6, -22.9, -43.2), rel=1e-9)
+
+
+@pytest.mark.parametrize('raio', [50, 800, 5000, 60000])
+def test_no_raio_igual_a_forca_bruta(indice, raio):
+    rnd = random.Random(raio)
+    for _ in range(20):
+        lat, lng = -23.55 + rnd.uniform(-0.25, 0.25), -46.63 + rnd.uniform(-0.25, 0.25)
+        achados = [(d, a['equipamento']) for d, a in indice.no_raio(lat, lng, raio)]
+        assert achados == [(d, e) for d, e in forca_bruta(indice, lat, lng) if d <= raio]
+
+
+@pytest.mark.parametrize('k', [1, 5, 50, 400, 500])
+def test_mais_proximos_igual_a_forca_bruta(indice, k):
+    rnd = random.Random(k)
+    # Inclui pontos longe da frota, onde a busca em anéis desiste e mede todos
+    for lat, lng in [(-23.55 + rnd.uniform(-0.3, 0.3), -46.63 + rnd.uniform(-0.3, 0.3)) for _ in range(20)] + [(10.0, 10.0)]:
+        achados = [a['equipamento'] for _, a in indice.mais_proximos(lat, lng, k)]
+        assert achados == [e for _, e in forca_bruta(indice, lat, lng)[:k]]
+
+
+def test_mais_proximos_com_raio_e_filtro(indice):
+    tipo1 = lambda a: a['tipo_id'] == 1
+    achados = indice.mais_proximos(-23.55, -46.63, 10, raio=3000, filtro=tipo1)
+    esperado = [(d, e) for d, e in forca_bruta(indice, -23.55, -46.63, tipo1) if d <= 3000][:10]
+    assert [(d, a['equipamento']) for d, a in achados] == esperado
+    assert all(a['tipo_id'] == 1 for _, a in achados)
+
+
+def test_ingestao_move_o_ativo_e_ignora_ponto_atrasado(indice):
+    # Tuplas de atualizar_posicoes_atuais: (id, equipamento, lat, lng, data_hora, sincronizado_em, observacao, cor)
+    indice.atualizar([(1000, 'CAM-000', 10.0, 10.0, T0 + timedelta(minutes=1), T0, '', '#000')])
+    assert [a['equipamento'] for _, a in indice.no_raio(10.0, 10.0, 10)] == ['CAM-000']
+    indice.atualizar([(1001, 'CAM-000', -23.55, -46.63, T0 - timedelta(hours=1), T0, '', '#000')])
+    assert indice._ativos['CAM-000']['latitude'] == 10.0
+    assert indice._ativos['CAM-000']['tipo_id'] == 0  # Tipo continua o do cadastro
+    # Célula antiga não guarda mais o ativo, e células vazias somem
+    assert sum('CAM-000' in s for s in indice._celulas.values()) == 1
+    assert all(indice._celulas.values())
+
+
+def test_antes_de_carregar_a_ingestao_nao_mexe():
+    i = maprix.IndiceProximos(0.01, 3600)
+    i.atualizar([(1, 'CAM-001', 0.0, 0.0, T0, T0, '', '#000')])
+    assert i.estatisticas()['ativos'] == 0
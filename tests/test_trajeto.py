@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+import app as maprix
+
+
+def xy(*pontos):
+    return np.array(pontos, dtype=float)
+
+
+@pytest.mark.parametrize('n', [0, 1, 2])
+def test_poucos_pontos_ficam_todos(n):
+    assert maprix.douglas_peucker(xy(*[(i, 0) for i in range(n)]).reshape(-1, 2), 5).tolist() == list(range(n))
+
+
+def test_reta_fica_so_com_as_pontas():
+    assert maprix.douglas_peucker(xy(*[(i * 10, 0.5) for i in range(50)]), 1).tolist() == [0, 49]
+
+
+def test_mantem_o_desvio_acima_da_tolerancia():
+    trajeto = xy((0, 0), (10, 15.2), (20, 30), (30, 15.1), (40, 0))
+    assert maprix.douglas_peucker(trajeto, 1).tolist() == [0, 2, 4]
+    assert maprix.douglas_peucker(trajeto, 50).tolist() == [0, 4]
+
+
+def test_volta_ao_ponto_de_partida():
+    # Pontas iguais (comprimento zero): a distância é até a ponta, não até a reta
+    ida_e_volta = xy((0, 0), (50, 0), (100, 0), (50, 0.1), (0, 0))
+    assert maprix.douglas_peucker(ida_e_volta, 10).tolist() == [0, 2, 4]
+    quadrado = xy((0, 0), (100, 0), (100, 100), (0, 100), (0, 0))
+    assert maprix.douglas_peucker(quadrado, 10).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_indices_crescentes_e_pontas_sempre_mantidas():
+    rnd = np.random.default_rng(7)
+    trajeto = np.cumsum(rnd.normal(0, 20, (500, 2)), axis=0)
+    indices = maprix.douglas_peucker(trajeto, 25)
+    assert indices[0] == 0 and indices[-1] == 499
+    assert np.all(np.diff(indices) > 0)
+    # Tolerância maior nunca mantém mais pontos
+    assert len(maprix.douglas_peucker(trajeto, 100)) <= len(indices)
+
+
+def test_para_epoch():
+    from datetime import datetime, timezone
+    assert maprix.para_epoch(datetime(2026, 10, 18, tzinfo=timezone.utc)) == 1792281600
+    assert maprix.para_epoch('2026-10-18T00:00:00Z') == 1792281600
+    assert np.isnan(maprix.para_epoch('lixo'))